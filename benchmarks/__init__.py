@@ -0,0 +1,4 @@
+"""
+Benchmarks of pymmrouting, run as modules from the root of the repository,
+e.g. python -m benchmarks.startup
+"""
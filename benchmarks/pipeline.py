@@ -0,0 +1,203 @@
+"""
+Measure every stage of the routing pipeline on the scenarios of the option
+files in sample-options/, and write the results as JSON so runs can be
+compared
+
+    python -m benchmarks.pipeline --repeat 20 --output pipeline.json
+    python -m benchmarks.pipeline --engine python --snapshot graph.mmgs
+
+Stages are run one by one in the same order as in batch_find_path. For every
+stage the runner reports p50/p95/p99 latency in milliseconds and the number
+of database queries per run. The native engine needs libmmspa4pg; the python
+engine searches a graph snapshot instead (see pymmrouting/pyengine.py). Both
+infer the plans and build the GeoJSON with the database of config.json.
+The peak RSS of a scenario is that of the runner process up to the end of
+the scenario, so it never goes down from one scenario to the next.
+"""
+
+from ctypes import c_longlong
+from pymmrouting.inferenceengine import RoutingPlanInferer
+from pymmrouting.queryprofile import profile_queries
+from pymmrouting.routeplanner import MultimodalRoutePlanner, assemble_result
+import argparse
+import glob
+import json
+import os
+import platform
+import resource
+import sys
+import time
+import numpy as np
+
+DEFAULT_SCENARIO_DIR = 'sample-options'
+PERCENTILES = (50, 95, 99)
+
+
+class StageRecorder(object):
+
+    """ Collect the latencies and query counts of the stages of a scenario,
+    the queries being those recorded into a QueryProfile
+    """
+
+    def __init__(self, profile):
+        self.profile = profile
+        self.samples = {}
+        self.order = []
+
+    def run(self, stage, func, *args, **kwargs):
+        if stage not in self.samples:
+            self.samples[stage] = ([], [])
+            self.order.append(stage)
+        queries_before = self.profile.count
+        t = time.time()
+        value = func(*args, **kwargs)
+        self.samples[stage][0].append(time.time() - t)
+        self.samples[stage][1].append(self.profile.count - queries_before)
+        return value
+
+    def report(self):
+        report = []
+        for stage in self.order:
+            seconds, queries = self.samples[stage]
+            ms = np.array(seconds) * 1000.0
+            summary = {'stage': stage, 'runs': len(ms),
+                       'mean_ms': float(ms.mean()),
+                       'queries_per_run': float(np.mean(queries))}
+            for p in PERCENTILES:
+                summary['p%d_ms' % p] = float(np.percentile(ms, p))
+            report.append(summary)
+        return report
+
+
+def _find_native(recorder, planner, plan):
+    source = c_longlong(plan.source['properties']['id'])
+    target = c_longlong(plan.target['properties']['id'])
+    recorder.run('prepare_routingplan', planner.prepare_routingplan, plan)
+    if planner.graphs_assembled:
+        # Kept routing plan, searched as in find_routing_result
+        recorder.run('search', planner.msp_twoq, source)
+        final_path = planner.msp_getfinalpath(source, target)
+    else:
+        final_path = recorder.run('search', planner.msp_findpath, source,
+                                  target)
+        planner.graphs_assembled = True
+    vertex_lists, costs = recorder.run(
+        'read_final_path', planner._read_final_path, plan, final_path)
+    if vertex_lists is not None:
+        planner.msp_clearpaths(final_path)
+    planner.end_search()
+    return vertex_lists, costs
+
+
+def _find_python(recorder, planner, plan):
+    target = plan.target['properties']['id']
+    tree = recorder.run('search', planner.engine.search, plan,
+                        plan.source['properties']['id'], [target])
+
+    def read(target):
+        vertex_lists = tree.vertex_lists(target)
+        if vertex_lists is None:
+            return None, None
+        return vertex_lists, tree.final_costs(target)
+    return recorder.run('read_final_path', read, target)
+
+
+def run_scenario(options_file, planner, repeat, find):
+    plan_count = 0
+    with profile_queries() as profile:
+        recorder = StageRecorder(profile)
+        for _ in range(repeat):
+            inferer = RoutingPlanInferer()
+            inferer.load_routing_options_from_file(options_file)
+            locations = [inferer._get_lon_lat_position(inferer.options[k])
+                         for k in ('source', 'target')]
+            snapped = recorder.run('snap_locations', inferer.snap_locations,
+                                   locations)
+            # generate_routing_plan snaps the locations itself, so it is
+            # given the snapped points to measure the plan inference alone
+            inferer.snap_locations = lambda locations: snapped
+            plans = recorder.run('generate_routing_plan',
+                                 inferer.generate_routing_plan)
+            plan_count = len(plans)
+            for plan in plans:
+                vertex_lists, costs = find(recorder, planner, plan)
+                result = recorder.run('construct_result', assemble_result,
+                                      plan, vertex_lists, costs, unfold=False)
+                recorder.run('unfold_sub_paths', result.unfold_sub_paths)
+                route = recorder.run('to_dict', result.to_dict)
+                recorder.run('json_dumps', json.dumps, route)
+    return {
+        'scenario': os.path.splitext(os.path.basename(options_file))[0],
+        'plans': plan_count,
+        'stages': recorder.report(),
+        # High-water mark of the whole process so far, i.e. of this and
+        # every earlier scenario. ru_maxrss is in kilobytes on Linux and in
+        # bytes on macOS
+        'process_peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', nargs='*',
+                        default=sorted(glob.glob(os.path.join(
+                            DEFAULT_SCENARIO_DIR, '*.json'))),
+                        help="routing option files")
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--engine', choices=['native', 'python'],
+                        default='native')
+    parser.add_argument('--snapshot', help="graph snapshot of the python "
+                                           "engine")
+    parser.add_argument('--no-reuse-routing-plan', dest='reuse_routing_plan',
+                        action='store_false', default=None,
+                        help="clear the routing plan of the native engine "
+                             "after every plan, instead of keeping it for "
+                             "the next plan of the same configuration")
+    parser.add_argument('--output', help="file of the JSON results")
+    args = parser.parse_args()
+
+    if args.engine == 'python':
+        # Imported here so the native runs do not need the engine module
+        from pymmrouting.pyengine import PythonRoutePlanner
+        if not args.snapshot:
+            parser.error("--snapshot is required by the python engine")
+        planner = PythonRoutePlanner('SNAPSHOT', args.snapshot)
+        find = _find_python
+    else:
+        planner = MultimodalRoutePlanner(
+            reuse_routing_plan=args.reuse_routing_plan)
+        find = _find_native
+    try:
+        scenarios = [run_scenario(f, planner, args.repeat, find)
+                     for f in args.scenarios]
+    finally:
+        planner.cleanup()
+
+    results = {
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python':     sys.version.split()[0],
+        'platform':   platform.platform(),
+        'engine':     args.engine,
+        'repeat':     args.repeat,
+        'routing_plans': {'builds': planner.routing_plan_builds,
+                          'reuses': planner.routing_plan_reuses},
+        'scenarios':  scenarios
+    }
+    for s in scenarios:
+        print("%s (%s plans, process peak RSS so far %s)" % (
+            s['scenario'], s['plans'], s['process_peak_rss']))
+        print("  %-22s %9s %9s %9s %9s" % ('stage', 'p50 ms', 'p95 ms',
+                                           'p99 ms', 'queries'))
+        for st in s['stages']:
+            print("  %-22s %9.2f %9.2f %9.2f %9.1f" % (
+                st['stage'], st['p50_ms'], st['p95_ms'], st['p99_ms'],
+                st['queries_per_run']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+Measure the cold start of pymmrouting in fresh interpreters: the import of
+the package and, with --with-database, the first uses which initialize it,
+i.e. loading the modes, mapping the reflected tables and creating a planner.
+
+    python -m benchmarks.startup --runs 10 --with-database
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+
+STAGES_SCRIPT = r'''
+import json
+import time
+timings = []
+t = time.time()
+import pymmrouting
+timings.append(('import', time.time() - t))
+if %(with_database)s:
+    from pymmrouting.orm_graphmodel import MODES, prepare_mappings
+    from pymmrouting.routeplanner import MultimodalRoutePlanner
+    t = time.time()
+    len(MODES)
+    timings.append(('load_modes', time.time() - t))
+    t = time.time()
+    prepare_mappings()
+    timings.append(('map_reflected_tables', time.time() - t))
+    t = time.time()
+    planner = MultimodalRoutePlanner()
+    timings.append(('create_planner', time.time() - t))
+    planner.cleanup()
+print(json.dumps(timings))
+'''
+
+
+def measure(runs, with_database=False):
+    """ Return a list of (stage, [seconds of every run]) """
+    script = STAGES_SCRIPT % {'with_database': bool(with_database)}
+    stages = []
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, '-c', script])
+        timings = json.loads(output.decode('utf-8').splitlines()[-1])
+        if not stages:
+            stages = [(name, []) for name, _ in timings]
+        for (_, samples), (_, seconds) in zip(stages, timings):
+            samples.append(seconds)
+    return stages
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--with-database', action='store_true',
+                        help="also measure the first uses of the database "
+                             "and of libmmspa4pg")
+    args = parser.parse_args()
+    print("%-24s %10s %10s %10s" % ('stage', 'min (ms)', 'median', 'max'))
+    for name, samples in measure(args.runs, args.with_database):
+        samples = sorted(samples)
+        print("%-24s %10.1f %10.1f %10.1f" % (
+            name, samples[0] * 1000, samples[len(samples) // 2] * 1000,
+            samples[-1] * 1000))
+
+
+if __name__ == '__main__':
+    main()
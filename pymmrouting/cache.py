@@ -0,0 +1,111 @@
+"""
+Bounded in-process caches shared by the components of pymmrouting
+"""
+
+from collections import OrderedDict
+import threading
+import time
+
+
+class LRUCache(object):
+
+    """ Thread-safe least-recently-used cache bounded by the total weight of
+    its values
+
+    The weight of a value is given by the weigher function, e.g. the number
+    of coordinates of a line or its estimated size in bytes. Every value
+    counts 1 if no weigher is given. Entries older than ttl seconds are
+    treated as missing if ttl is set.
+    """
+
+    def __init__(self, max_weight, ttl=None, weigher=None):
+        self.max_weight = max_weight
+        self.ttl = ttl
+        self._weigher = weigher if weigher is not None else lambda v: 1
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._weight = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._lookup(key, time.time()) is not None
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._lookup(key, time.time())
+            if entry is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return entry[0]
+
+    def get_many(self, keys):
+        """ Return a dict of the cached values of the keys found """
+        found = {}
+        now = time.time()
+        with self._lock:
+            for key in keys:
+                entry = self._lookup(key, now)
+                if entry is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+                    found[key] = entry[0]
+        return found
+
+    def put(self, key, value):
+        weight = self._weigher(value)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            if weight > self.max_weight:
+                # Never let a single value flush the whole cache
+                return
+            self._entries[key] = (value, weight, time.time())
+            self._weight += weight
+            while self._weight > self.max_weight:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._weight = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries':     len(self._entries),
+                'weight':      self._weight,
+                'max_weight':  self.max_weight,
+                'hits':        self.hits,
+                'misses':      self.misses,
+                'evictions':   self.evictions,
+                'expirations': self.expirations,
+                'hit_ratio':   float(self.hits) / lookups if lookups else 0.0
+            }
+
+    def _lookup(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if self.ttl is not None and now - entry[2] > self.ttl:
+            self._remove(key)
+            self.expirations += 1
+            return None
+        # Move the entry to the most recently used end
+        del self._entries[key]
+        self._entries[key] = entry
+        return entry
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._weight -= entry[1]
@@ -35,6 +35,175 @@ CVertex._fields_ = [("id",               c_longlong),
 
 VERTEX_VALIDATION_CHECKER = CFUNCTYPE(c_int, POINTER(CVertex))
 
+
+class Constraint(object):
+
+    """ Declarative constraint on the vertices reached by a search
+
+    Constraints are plain values, so plans carrying them can be pickled and
+    sent to other processes. The callback passed to libmmspa4pg is created
+    by to_checker() in the process running the plan. Constraints are
+    combined with & and |, or with And and Or.
+    """
+
+    def __and__(self, other):
+        return And(self, other)
+
+    def __or__(self, other):
+        return Or(self, other)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self._key() == other._key()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((type(self).__name__, self._key()))
+
+    def _key(self):
+        raise NotImplementedError
+
+    def accepts(self, vertex):
+        """ Tell whether a CVertex satisfies the constraint """
+        raise NotImplementedError
+
+    def bounds(self):
+        """ Return the upper bounds of (distance, elapsed_time,
+            walking_distance) equivalent to the constraint, or None if it
+            can not be expressed as such bounds
+        """
+        return None
+
+    def to_checker(self):
+        bounds = self.bounds()
+        if bounds is not None:
+            return _threshold_checker(*bounds)
+        # Generic fallback evaluating the whole expression for every vertex
+        return VERTEX_VALIDATION_CHECKER(
+            lambda v: 0 if self.accepts(v[0]) else -1)
+
+
+def _threshold_checker(max_distance, max_duration, max_walking):
+    inf = float('inf')
+    if max_duration == inf and max_walking == inf:
+        return VERTEX_VALIDATION_CHECKER(
+            lambda v: 0 if v[0].distance <= max_distance else -1)
+
+    def check(v):
+        v = v[0]
+        return 0 if (v.distance <= max_distance and
+                     v.elapsed_time <= max_duration and
+                     v.walking_distance <= max_walking) else -1
+    return VERTEX_VALIDATION_CHECKER(check)
+
+
+class _Threshold(Constraint):
+
+    # Position of the bound in the tuple returned by bounds()
+    bound_index = None
+    field = None
+
+    def __init__(self, limit):
+        self.limit = float(limit)
+
+    def __repr__(self):
+        return "%s(%r)" % (type(self).__name__, self.limit)
+
+    def _key(self):
+        return self.limit
+
+    def accepts(self, vertex):
+        return getattr(vertex, self.field) <= self.limit
+
+    def bounds(self):
+        bounds = [float('inf')] * 3
+        bounds[self.bound_index] = self.limit
+        return tuple(bounds)
+
+
+class MaxDistance(_Threshold):
+
+    """ Accept the vertices reached within a distance in meters """
+
+    bound_index = 0
+    field = 'distance'
+
+    @property
+    def meters(self):
+        return self.limit
+
+
+class MaxDuration(_Threshold):
+
+    """ Accept the vertices reached within a duration in minutes """
+
+    bound_index = 1
+    field = 'elapsed_time'
+
+    @property
+    def minutes(self):
+        return self.limit
+
+
+class MaxWalking(_Threshold):
+
+    """ Accept the vertices reached after walking at most some meters """
+
+    bound_index = 2
+    field = 'walking_distance'
+
+    @property
+    def meters(self):
+        return self.limit
+
+
+class And(Constraint):
+
+    """ Accept the vertices satisfying all the constraints """
+
+    def __init__(self, *constraints):
+        self.constraints = tuple(constraints)
+
+    def __repr__(self):
+        return "And(%s)" % ", ".join(repr(c) for c in self.constraints)
+
+    def _key(self):
+        return self.constraints
+
+    def accepts(self, vertex):
+        return all(c.accepts(vertex) for c in self.constraints)
+
+    def bounds(self):
+        # A conjunction of bounds is the tightest bound of every field
+        all_bounds = [c.bounds() for c in self.constraints]
+        if None in all_bounds:
+            return None
+        return tuple(min(b) for b in zip(*all_bounds)) if all_bounds \
+            else (float('inf'),) * 3
+
+
+class Or(Constraint):
+
+    """ Accept the vertices satisfying any of the constraints """
+
+    def __init__(self, *constraints):
+        self.constraints = tuple(constraints)
+
+    def __repr__(self):
+        return "Or(%s)" % ", ".join(repr(c) for c in self.constraints)
+
+    def _key(self):
+        return self.constraints
+
+    def accepts(self, vertex):
+        return any(c.accepts(vertex) for c in self.constraints)
+
+    def bounds(self):
+        if len(self.constraints) == 1:
+            return self.constraints[0].bounds()
+        return None
+
 """
 from pymmspa4pg import connect_db, create_routing_plan, set_mode, \
     set_public_transit_mode, set_cost_factor, parse, dispose, \
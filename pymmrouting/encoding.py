@@ -0,0 +1,95 @@
+"""
+Compact encodings of the LineString geometries of routes, computed with
+numpy over whole coordinate arrays
+
+polyline
+    Google encoded polyline string of the (lat, lon) pairs, as read by the
+    map SDKs of mobile clients, e.g. PolyUtil.decode on Android
+quantized
+    Flat list of integers [x0, y0, dx1, dy1, ...] of the coordinates scaled
+    by 10 ** precision, the first point absolute and the others as deltas
+    from their predecessor
+"""
+
+import numpy as np
+
+GEOJSON = 'geojson'
+POLYLINE = 'polyline'
+QUANTIZED = 'quantized'
+ENCODINGS = (GEOJSON, POLYLINE, QUANTIZED)
+DEFAULT_PRECISION = {POLYLINE: 5, QUANTIZED: 6}
+
+
+def _quantized_deltas(coordinates, precision):
+    points = np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)
+    quantized = np.round(points * 10 ** precision).astype(np.int64)
+    deltas = np.empty_like(quantized)
+    deltas[:1] = quantized[:1]
+    deltas[1:] = np.diff(quantized, axis=0)
+    return deltas
+
+
+def encode_polyline(coordinates, precision=5):
+    """ Encode a list of [lon, lat] into a polyline string """
+    deltas = _quantized_deltas(coordinates, precision)
+    if len(deltas) == 0:
+        return ''
+    values = deltas[:, ::-1].ravel()
+    # Zigzag encoding, i.e. ~(v << 1) for negative values
+    values = (values << 1) ^ (values >> 63)
+    n_chunks = max(1, (int(values.max()).bit_length() + 4) // 5)
+    shifts = np.arange(n_chunks, dtype=np.int64) * 5
+    shifted = values[:, None] >> shifts
+    # Every value has its first chunk and those up to its highest bit
+    present = np.ones(shifted.shape, dtype=bool)
+    present[:, 1:] = shifted[:, 1:] > 0
+    follows = np.zeros(shifted.shape, dtype=bool)
+    follows[:, :-1] = shifted[:, 1:] > 0
+    chars = (shifted & 0x1f) + np.where(follows, 0x20, 0) + 63
+    return chars[present].astype(np.uint8).tobytes().decode('ascii')
+
+
+def decode_polyline(polyline, precision=5):
+    """ Decode a polyline string into a list of [lon, lat] """
+    values = []
+    value = shift = 0
+    for c in bytearray(polyline.encode('ascii')):
+        c -= 63
+        value |= (c & 0x1f) << shift
+        shift += 5
+        if c < 0x20:
+            values.append(~(value >> 1) if value & 1 else value >> 1)
+            value = shift = 0
+    lat_lon = np.cumsum(np.array(values, dtype=np.int64).reshape(-1, 2),
+                        axis=0) / float(10 ** precision)
+    return lat_lon[:, ::-1].tolist()
+
+
+def quantize_coordinates(coordinates, precision=6):
+    """ Encode a list of [lon, lat] into quantized deltas """
+    return _quantized_deltas(coordinates, precision).ravel().tolist()
+
+
+def dequantize_coordinates(values, precision=6):
+    """ Decode quantized deltas into a list of [lon, lat] """
+    deltas = np.array(values, dtype=np.int64).reshape(-1, 2)
+    return (np.cumsum(deltas, axis=0) / float(10 ** precision)).tolist()
+
+
+def encode_geometry(geometry, encoding=GEOJSON, precision=None):
+    """ Encode the coordinates of a GeoJSON LineString. GeoJSON geometries
+        are returned as they are.
+    """
+    if encoding == GEOJSON:
+        return geometry
+    if encoding not in ENCODINGS:
+        raise ValueError("Unknown geometry encoding: %s" % encoding)
+    if precision is None:
+        precision = DEFAULT_PRECISION[encoding]
+    if encoding == POLYLINE:
+        return {'type': 'EncodedPolyline', 'precision': precision,
+                'polyline': encode_polyline(geometry['coordinates'],
+                                            precision)}
+    return {'type': 'QuantizedLineString', 'precision': precision,
+            'deltas': quantize_coordinates(geometry['coordinates'],
+                                           precision)}
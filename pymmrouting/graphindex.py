@@ -0,0 +1,281 @@
+"""
+Compact in-memory indexes over the tables of the multimodal graph, so that
+paths can be translated without one database query per vertex
+"""
+
+from sqlalchemy import select, func, tuple_
+from .orm_graphmodel import Session, Vertex, Edge
+from .lazy import LazyObject
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Number of rows fetched at a time when bulk-loading an index from database
+BULK_LOAD_BATCH_SIZE = 100000
+
+
+def fetch_in_batches(statement, dtypes, batch_size=BULK_LOAD_BATCH_SIZE):
+    """ Run a statement and return its columns as arrays of the given dtypes
+    """
+    result = Session.execute(statement)
+    chunks = [[] for _ in dtypes]
+    while True:
+        rows = result.fetchmany(batch_size)
+        if not rows:
+            break
+        for chunk, column, dtype in zip(chunks, zip(*rows), dtypes):
+            chunk.append(np.array(column, dtype=dtype))
+    return [np.concatenate(c) if c else np.empty(0, dtype=d)
+            for c, d in zip(chunks, dtypes)]
+
+
+class VertexModeIndex(object):
+
+    """ Map vertex ids to mode ids with binary search over a sorted int64
+    array of vertex ids and a parallel int8 array of mode ids
+
+    Vertex ids not in the index are looked up in the database and
+    remembered, so an index built before the graph has changed still works.
+    """
+
+    def __init__(self, vertex_ids=(), mode_ids=()):
+        vertex_ids = np.asarray(vertex_ids, dtype=np.int64)
+        mode_ids = np.asarray(mode_ids)
+        if len(vertex_ids) != len(mode_ids):
+            raise ValueError("Vertex ids and mode ids differ in length")
+        if len(mode_ids) > 0 and \
+                (mode_ids.min() < np.iinfo(np.int8).min or
+                 mode_ids.max() > np.iinfo(np.int8).max):
+            raise ValueError("Mode ids out of the range of int8")
+        order = np.argsort(vertex_ids, kind='mergesort')
+        self.vertex_ids = vertex_ids[order]
+        self.mode_ids = mode_ids.astype(np.int8)[order]
+        self._fallback = {}
+
+    @classmethod
+    def from_database(cls, batch_size=BULK_LOAD_BATCH_SIZE):
+        """ Bulk-load the whole vertices table """
+        vertex_ids, mode_ids = fetch_in_batches(
+            select([Vertex.vertex_id, Vertex.mode_id]),
+            [np.int64, np.int64], batch_size)
+        logger.info("Loaded %s vertices into the vertex mode index",
+                    len(vertex_ids))
+        return cls(vertex_ids, mode_ids)
+
+    @classmethod
+    def load(cls, index_file):
+        with np.load(index_file) as arrays:
+            return cls(arrays['vertex_ids'], arrays['mode_ids'])
+
+    def save(self, index_file):
+        np.savez(index_file, vertex_ids=self.vertex_ids,
+                 mode_ids=self.mode_ids)
+
+    def __len__(self):
+        return len(self.vertex_ids)
+
+    def __contains__(self, vertex_id):
+        return bool(self._find(np.array([vertex_id], dtype=np.int64))[1][0])
+
+    def _find(self, vertex_ids):
+        if len(self.vertex_ids) == 0:
+            return (np.zeros(len(vertex_ids), dtype=np.intp),
+                    np.zeros(len(vertex_ids), dtype=bool))
+        pos = np.searchsorted(self.vertex_ids, vertex_ids)
+        pos = np.minimum(pos, len(self.vertex_ids) - 1)
+        return pos, self.vertex_ids[pos] == vertex_ids
+
+    def lookup(self, vertex_ids):
+        """ Return the mode ids of the vertices as an int8 array """
+        vertex_ids = np.asarray(vertex_ids, dtype=np.int64)
+        pos, found = self._find(vertex_ids)
+        modes = np.empty(len(vertex_ids), dtype=np.int8)
+        modes[found] = self.mode_ids[pos[found]]
+        if not found.all():
+            missing = vertex_ids[~found]
+            fallback = self._load_fallback(np.unique(missing).tolist())
+            modes[~found] = [fallback[v] for v in missing.tolist()]
+        return modes
+
+    def mode_of(self, vertex_id):
+        return int(self.lookup([vertex_id])[0])
+
+    def _load_fallback(self, vertex_ids):
+        unknown = [v for v in vertex_ids if v not in self._fallback]
+        if unknown:
+            logger.debug("Look up modes of %s vertices not indexed",
+                         len(unknown))
+            for v, m in Session.query(Vertex.vertex_id, Vertex.mode_id).filter(
+                    Vertex.vertex_id.in_(unknown)):
+                self._fallback[v] = m
+            not_found = [v for v in unknown if v not in self._fallback]
+            if not_found:
+                raise KeyError("Vertices not found: %s" % not_found)
+        return self._fallback
+
+    def split_by_mode(self, vertex_ids):
+        """ Split a vertex list into runs of consecutive vertices of the same
+            mode, returned as a list of (mode_id, vertex_id_list)
+        """
+        if len(vertex_ids) == 0:
+            return []
+        modes = self.lookup(vertex_ids)
+        boundaries = (np.flatnonzero(np.diff(modes)) + 1).tolist()
+        starts = [0] + boundaries
+        ends = boundaries + [len(vertex_ids)]
+        vertex_ids = list(vertex_ids)
+        return [(int(modes[s]), vertex_ids[s:e]) for s, e in zip(starts, ends)]
+
+
+class EdgeIndex(object):
+
+    """ Map (from_id, to_id) vertex pairs to edge_id, link_id, length and
+    speed_factor of the edges, stored in parallel numpy arrays
+
+    Every pair is packed into one int64 key made of the ranks of both
+    vertices among all the vertex ids of the edges. Keys are sorted, so a
+    whole path is translated with binary search in one vectorized pass.
+    Links of edges without link_id are stored as NO_LINK.
+    """
+
+    NO_LINK = -1
+
+    def __init__(self, from_ids=(), to_ids=(), edge_ids=(), link_ids=(),
+                 lengths=(), speed_factors=()):
+        from_ids = np.asarray(from_ids, dtype=np.int64)
+        to_ids = np.asarray(to_ids, dtype=np.int64)
+        self.vertex_ids = np.unique(np.concatenate((from_ids, to_ids)))
+        keys = self._pack(np.searchsorted(self.vertex_ids, from_ids),
+                          np.searchsorted(self.vertex_ids, to_ids))
+        # A stable sort keeps the first one of duplicated vertex pairs at
+        # the position found by searchsorted
+        order = np.argsort(keys, kind='mergesort')
+        self.keys = keys[order]
+        self.edge_ids = np.asarray(edge_ids, dtype=np.int64)[order]
+        self.link_ids = np.asarray(link_ids, dtype=np.int64)[order]
+        self.lengths = np.asarray(lengths, dtype=np.float64)[order]
+        self.speed_factors = np.asarray(speed_factors,
+                                        dtype=np.float64)[order]
+        self._fallback = {}
+
+    @classmethod
+    def from_database(cls, batch_size=BULK_LOAD_BATCH_SIZE):
+        """ Bulk-load the whole edges table """
+        columns = fetch_in_batches(
+            select([Edge.from_id, Edge.to_id, Edge.edge_id,
+                    func.coalesce(Edge.link_id, cls.NO_LINK),
+                    Edge.length, Edge.speed_factor]),
+            [np.int64, np.int64, np.int64, np.int64, np.float64, np.float64],
+            batch_size)
+        logger.info("Loaded %s edges into the edge index", len(columns[0]))
+        return cls(*columns)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _pack(self, from_ranks, to_ranks):
+        return from_ranks.astype(np.int64) * len(self.vertex_ids) + to_ranks
+
+    def _ranks(self, vertex_ids):
+        if len(self.vertex_ids) == 0:
+            return (np.zeros(len(vertex_ids), dtype=np.intp),
+                    np.zeros(len(vertex_ids), dtype=bool))
+        ranks = np.minimum(np.searchsorted(self.vertex_ids, vertex_ids),
+                           len(self.vertex_ids) - 1)
+        return ranks, self.vertex_ids[ranks] == vertex_ids
+
+    def find(self, from_ids, to_ids):
+        """ Return the positions of the vertex pairs in the arrays and a
+            mask telling which pairs are found
+        """
+        from_ranks, from_found = self._ranks(
+            np.asarray(from_ids, dtype=np.int64))
+        to_ranks, to_found = self._ranks(np.asarray(to_ids, dtype=np.int64))
+        keys = self._pack(from_ranks, to_ranks)
+        if len(self.keys) == 0:
+            return np.zeros(len(keys), dtype=np.intp), from_found
+        pos = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        return pos, from_found & to_found & (self.keys[pos] == keys)
+
+    def path_attributes(self, vertex_ids):
+        """ Translate a vertex list into the arrays of edge_ids, link_ids,
+            lengths and speed_factors of the edges between every two
+            consecutive vertices
+        """
+        vertex_ids = np.asarray(vertex_ids, dtype=np.int64)
+        if len(vertex_ids) < 2:
+            return (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64),
+                    np.empty(0, dtype=np.float64),
+                    np.empty(0, dtype=np.float64))
+        from_ids, to_ids = vertex_ids[:-1], vertex_ids[1:]
+        pos, found = self.find(from_ids, to_ids)
+        if len(self.keys) > 0:
+            attributes = (self.edge_ids[pos], self.link_ids[pos],
+                          self.lengths[pos], self.speed_factors[pos])
+        else:
+            attributes = (np.zeros(len(pos), dtype=np.int64),
+                          np.zeros(len(pos), dtype=np.int64),
+                          np.zeros(len(pos), dtype=np.float64),
+                          np.zeros(len(pos), dtype=np.float64))
+        if not found.all():
+            missing = list(zip(from_ids[~found].tolist(),
+                               to_ids[~found].tolist()))
+            fallback = self._load_fallback(missing)
+            for i, pair in zip(np.flatnonzero(~found), missing):
+                for array, value in zip(attributes, fallback[pair]):
+                    array[i] = value
+        return attributes
+
+    def edge_ids_of_path(self, vertex_ids):
+        return self.path_attributes(vertex_ids)[0].tolist()
+
+    def link_ids_of_path(self, vertex_ids):
+        return [None if l == self.NO_LINK else l
+                for l in self.path_attributes(vertex_ids)[1].tolist()]
+
+    def _load_fallback(self, pairs):
+        unknown = list(set(p for p in pairs if p not in self._fallback))
+        if unknown:
+            logger.debug("Look up %s edges not indexed", len(unknown))
+            for row in Session.query(
+                    Edge.from_id, Edge.to_id, Edge.edge_id,
+                    func.coalesce(Edge.link_id, self.NO_LINK),
+                    Edge.length, Edge.speed_factor).filter(
+                        tuple_(Edge.from_id, Edge.to_id).in_(unknown)):
+                self._fallback.setdefault(
+                    (row[0], row[1]),
+                    tuple(float('nan') if x is None else x for x in row[2:]))
+            not_found = [p for p in unknown if p not in self._fallback]
+            if not_found:
+                raise KeyError("Edges not found: %s" % not_found)
+        return self._fallback
+
+
+_VERTEX_MODE_INDEX = LazyObject(VertexModeIndex.from_database)
+_EDGE_INDEX = LazyObject(EdgeIndex.from_database)
+
+
+def get_vertex_mode_index():
+    """ Return the process-wide vertex mode index, building it from the
+        vertices table at the first call
+    """
+    return _VERTEX_MODE_INDEX.get()
+
+
+def set_vertex_mode_index(index):
+    """ Replace the process-wide vertex mode index, e.g. with one loaded from
+        a file
+    """
+    _VERTEX_MODE_INDEX.set(index)
+
+
+def get_edge_index():
+    """ Return the process-wide edge index, building it from the edges table
+        at the first call
+    """
+    return _EDGE_INDEX.get()
+
+
+def set_edge_index(index):
+    _EDGE_INDEX.set(index)
@@ -0,0 +1,260 @@
+"""
+Compact binary snapshot of the multimodal graph, exported from the database
+and memory-mapped when opened, so that a process can load the whole graph
+from a local file
+
+Layout of a snapshot file:
+
+    magic (8 bytes) | format version (uint32) | TOC length (uint32) | TOC
+
+The TOC is a JSON document with the metadata of the graph and the dtype,
+shape and offset of every array. Arrays are little-endian and aligned to
+ALIGNMENT bytes. Edges are stored as CSR adjacency: the outgoing edges of
+the i-th vertex are edges[offsets[i]:offsets[i + 1]], and edge_targets are
+positions of vertices. Ids are int64 and weights float32.
+"""
+
+from sqlalchemy import select, func
+from .orm_graphmodel import Vertex, Edge, SwitchPoint, MODES, SWITCH_TYPES
+from .graphindex import fetch_in_batches, VertexModeIndex, EdgeIndex
+import argparse
+import json
+import logging
+import struct
+import time
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'MMGRAPH\0'
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+_HEADER = struct.Struct('<8sII')
+
+NO_LINK = EdgeIndex.NO_LINK
+
+# Name and dtype of every array of a snapshot
+ARRAY_DTYPES = (
+    ('vertex_ids',           np.int64),
+    ('vertex_modes',         np.int8),
+    ('vertex_xs',            np.float64),
+    ('vertex_ys',            np.float64),
+    ('offsets',              np.int64),
+    ('edge_targets',         np.int32),
+    ('edge_ids',             np.int64),
+    ('edge_link_ids',        np.int64),
+    ('edge_lengths',         np.float32),
+    ('edge_speed_factors',   np.float32),
+    ('switch_from_ids',      np.int64),
+    ('switch_to_ids',        np.int64),
+    ('switch_from_modes',    np.int8),
+    ('switch_to_modes',      np.int8),
+    ('switch_type_ids',      np.int16),
+    ('switch_costs',         np.float32),
+    ('switch_ref_poi_ids',   np.int64),
+)
+
+
+def _little_endian(dtype):
+    return np.dtype(dtype).newbyteorder('<')
+
+
+def build_csr(vertex_ids, from_ids, to_ids):
+    """ Sort the edges by source vertex and return the CSR offsets, the
+        positions of the target vertices and the order of the edges. Edges
+        with an unknown end are dropped from the order.
+    """
+    n = len(vertex_ids)
+    if n >= np.iinfo(np.int32).max:
+        raise ValueError("Too many vertices for int32 edge targets")
+    sources = np.minimum(np.searchsorted(vertex_ids, from_ids), max(n - 1, 0))
+    targets = np.minimum(np.searchsorted(vertex_ids, to_ids), max(n - 1, 0))
+    known = (vertex_ids[sources] == from_ids) & \
+        (vertex_ids[targets] == to_ids) if n else \
+        np.zeros(len(from_ids), dtype=bool)
+    if not known.all():
+        logger.warning("Drop %s edges of unknown vertices",
+                       int((~known).sum()))
+    kept = np.flatnonzero(known)
+    order = kept[np.lexsort((targets[kept], sources[kept]))]
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources[order], minlength=n), out=offsets[1:])
+    return offsets, targets[order].astype(np.int32), order
+
+
+def write_graph_snapshot(snapshot_file, arrays, metadata=None):
+    """ Write a dict of arrays named as in ARRAY_DTYPES and a JSON-able
+        metadata dict into a snapshot file
+    """
+    arrays = dict(
+        (name, np.ascontiguousarray(arrays[name], dtype=_little_endian(dtype)))
+        for name, dtype in ARRAY_DTYPES)
+    toc = {'metadata': metadata or {}, 'arrays': {}}
+    # Offsets depend on the length of the TOC, so leave room for them by
+    # laying out the arrays after an upper bound of it
+    draft = json.dumps(dict(toc, arrays=dict(
+        (name, {'dtype': a.dtype.str, 'shape': list(a.shape),
+                'offset': 10 ** 18}) for name, a in arrays.items())))
+    offset = _align(_HEADER.size + len(draft.encode('utf-8')))
+    for name, _ in ARRAY_DTYPES:
+        a = arrays[name]
+        toc['arrays'][name] = {'dtype': a.dtype.str, 'shape': list(a.shape),
+                               'offset': offset}
+        offset = _align(offset + a.nbytes)
+    toc_bytes = json.dumps(toc).encode('utf-8')
+    with open(snapshot_file, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, FORMAT_VERSION, len(toc_bytes)))
+        f.write(toc_bytes)
+        for name, _ in ARRAY_DTYPES:
+            f.write(b'\0' * (toc['arrays'][name]['offset'] - f.tell()))
+            f.write(arrays[name].tobytes())
+    logger.info("Wrote graph snapshot %s of %s vertices and %s edges",
+                snapshot_file, len(arrays['vertex_ids']),
+                len(arrays['edge_ids']))
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def export_graph_snapshot(snapshot_file):
+    """ Dump vertices, edges, switch points, modes and switch types from the
+        database into a snapshot file
+    """
+    t1 = time.time()
+    vertex_ids, vertex_modes, xs, ys = fetch_in_batches(
+        select([Vertex.vertex_id, Vertex.mode_id, Vertex.x, Vertex.y]),
+        [np.int64, np.int64, np.float64, np.float64])
+    order = np.argsort(vertex_ids, kind='mergesort')
+    vertex_ids = vertex_ids[order]
+    from_ids, to_ids, edge_ids, link_ids, lengths, speed_factors = \
+        fetch_in_batches(
+            select([Edge.from_id, Edge.to_id, Edge.edge_id,
+                    func.coalesce(Edge.link_id, NO_LINK),
+                    Edge.length, Edge.speed_factor]),
+            [np.int64, np.int64, np.int64, np.int64, np.float64, np.float64])
+    offsets, targets, edge_order = build_csr(vertex_ids, from_ids, to_ids)
+    switch_columns = fetch_in_batches(
+        select([SwitchPoint.from_vertex_id, SwitchPoint.to_vertex_id,
+                SwitchPoint.from_mode_id, SwitchPoint.to_mode_id,
+                SwitchPoint.type_id, func.coalesce(SwitchPoint.cost, 0.0),
+                func.coalesce(SwitchPoint.ref_poi_id, -1)]).where(
+                    SwitchPoint.is_available.isnot(False)),
+        [np.int64, np.int64, np.int64, np.int64, np.int64, np.float64,
+         np.int64])
+    arrays = {
+        'vertex_ids':         vertex_ids,
+        'vertex_modes':       vertex_modes[order],
+        'vertex_xs':          xs[order],
+        'vertex_ys':          ys[order],
+        'offsets':            offsets,
+        'edge_targets':       targets,
+        'edge_ids':           edge_ids[edge_order],
+        'edge_link_ids':      link_ids[edge_order],
+        'edge_lengths':       lengths[edge_order],
+        'edge_speed_factors': speed_factors[edge_order]
+    }
+    arrays.update(zip(
+        ['switch_from_ids', 'switch_to_ids', 'switch_from_modes',
+         'switch_to_modes', 'switch_type_ids', 'switch_costs',
+         'switch_ref_poi_ids'], switch_columns))
+    write_graph_snapshot(snapshot_file, arrays, {
+        'created_at':   time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'modes':        dict(MODES),
+        'switch_types': dict(SWITCH_TYPES)
+    })
+    logger.info("Exported graph snapshot in %s seconds", time.time() - t1)
+
+
+class GraphSnapshot(object):
+
+    """ Read-only view of a snapshot file. The arrays are memory-mapped, so
+    opening a snapshot does not read the whole graph into memory.
+    """
+
+    def __init__(self, snapshot_file, metadata, arrays):
+        self.snapshot_file = snapshot_file
+        self.metadata = metadata
+        self.arrays = arrays
+        for name, array in arrays.items():
+            setattr(self, name, array)
+
+    @classmethod
+    def open(cls, snapshot_file):
+        with open(snapshot_file, 'rb') as f:
+            header = f.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                raise ValueError("Not a graph snapshot: %s" % snapshot_file)
+            magic, version, toc_length = _HEADER.unpack(header)
+            if magic != MAGIC:
+                raise ValueError("Not a graph snapshot: %s" % snapshot_file)
+            if version != FORMAT_VERSION:
+                raise ValueError(
+                    "Unsupported version %s of graph snapshot %s" %
+                    (version, snapshot_file))
+            toc = json.loads(f.read(toc_length).decode('utf-8'))
+        arrays = {}
+        for name, spec in toc['arrays'].items():
+            shape = tuple(spec['shape'])
+            if 0 in shape:
+                # Empty arrays can not be memory-mapped
+                arrays[name] = np.empty(shape, dtype=np.dtype(spec['dtype']))
+            else:
+                arrays[name] = np.memmap(
+                    snapshot_file, dtype=np.dtype(spec['dtype']), mode='r',
+                    offset=spec['offset'], shape=shape)
+        logger.info("Opened graph snapshot %s of %s vertices and %s edges",
+                    snapshot_file, len(arrays['vertex_ids']),
+                    len(arrays['edge_ids']))
+        return cls(snapshot_file, toc['metadata'], arrays)
+
+    def close(self):
+        # Let the memory maps be released with the last reference
+        self.arrays = {}
+        for name, _ in ARRAY_DTYPES:
+            setattr(self, name, None)
+
+    @property
+    def modes(self):
+        return self.metadata.get('modes', {})
+
+    @property
+    def switch_types(self):
+        return self.metadata.get('switch_types', {})
+
+    def __len__(self):
+        return len(self.vertex_ids)
+
+    def position_of(self, vertex_id):
+        """ Return the position of a vertex id, or -1 if it is unknown """
+        i = int(np.searchsorted(self.vertex_ids, vertex_id))
+        if i < len(self.vertex_ids) and self.vertex_ids[i] == vertex_id:
+            return i
+        return -1
+
+    def edge_sources(self):
+        """ Return the position of the source vertex of every edge """
+        return np.repeat(np.arange(len(self.vertex_ids), dtype=np.int32),
+                         np.diff(self.offsets))
+
+    def vertex_mode_index(self):
+        return VertexModeIndex(self.vertex_ids, self.vertex_modes)
+
+    def edge_index(self):
+        return EdgeIndex(self.vertex_ids[self.edge_sources()],
+                         self.vertex_ids[self.edge_targets], self.edge_ids,
+                         self.edge_link_ids, self.edge_lengths,
+                         self.edge_speed_factors)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Export the multimodal graph into a snapshot file")
+    parser.add_argument('snapshot_file')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    export_graph_snapshot(args.snapshot_file)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,24 +2,18 @@
 Infer feasible routing plans according to user preferences
 """
 
-from .datamodel import VERTEX_VALIDATION_CHECKER
-from .orm_graphmodel import SwitchType, StreetJunction, Mode, Session, Vertex
+from .datamodel import MaxDistance
+from .orm_graphmodel import StreetJunction, Session, Vertex, MODES, \
+    SWITCH_TYPES
 from geoalchemy2.functions import ST_AsGeoJSON as st_asgeojson
+from .spatialindex import get_street_junction_index
+from . import metrics
 import logging
 import json
 
 logger = logging.getLogger(__name__)
 
 INTERNAL_SRID = 4326
-# Read modes and switch_types from database instead of hard coding it here
-MODES = {
-    str(m_name): m_id
-    for m_name, m_id in Session.query(Mode.mode_name, Mode.mode_id)
-}
-SWITCH_TYPES = {
-    str(t_name): t_id
-    for t_name, t_id in Session.query(SwitchType.type_name, SwitchType.type_id)
-}
 
 
 class RoutingPlan(object):
@@ -70,14 +64,36 @@ class RoutingPlan(object):
         return True if MODES['public_transportation'] in self.mode_list \
                     else False
 
+    @property
+    def configuration_key(self):
+        """ Everything assembled into libmmspa4pg for this plan except the
+            source and target
+        """
+        return (tuple(self.mode_list), tuple(self.public_transit_set),
+                tuple(self.switch_condition_list),
+                tuple(self.switch_constraint_list), self.target_constraint,
+                self.cost_factor)
+
 
 class RoutingPlanInferer(object):
     """
     Infer the feasible routing plans according to routing options
     """
 
-    def __init__(self):
+    def __init__(self, junction_index=None):
+        """ junction_index is an optional StreetJunctionIndex used to snap
+            locations to the graph without querying the database. It
+            defaults to the index of the street_junction_index file of the
+            config, see get_street_junction_index() in spatialindex.py.
+        """
         self.options = {}
+        self._junction_index = junction_index
+
+    @property
+    def junction_index(self):
+        if self._junction_index is None:
+            return get_street_junction_index()
+        return self._junction_index
 
     def load_routing_options_from_file(self, options_file_path):
         with open(options_file_path) as options_file:
@@ -107,6 +123,9 @@ class RoutingPlanInferer(object):
         return {"lon": lon, "lat": lat}
 
     def _find_nearest_point(self, location):
+        if self.junction_index is not None:
+            return self.junction_index.nearest(location['lon'],
+                                               location['lat'])
         point = 'POINT(' + str(location['lon']) + ' ' + \
             str(location['lat']) + ')'
         nearest_neighbor = Session.query(StreetJunction).order_by(
@@ -117,6 +136,15 @@ class RoutingPlanInferer(object):
         logger.debug("found nearest neighbor, osm_id is " + str(raw_point_id))
         return {'point_id': raw_point_id, 'geometry': point_geom}
 
+    @metrics.timed('snap_locations')
+    def snap_locations(self, locations):
+        """ Find the nearest points of a list of lon/lat locations """
+        if self.junction_index is not None:
+            return self.junction_index.nearest_many(
+                [l['lon'] for l in locations], [l['lat'] for l in locations])
+        return [self._find_nearest_point(l) for l in locations]
+
+    @metrics.timed('find_candidate_vertices')
     def _find_candidate_vertices(self, raw_point_id):
         candidate_vertices = Session.query(Vertex).filter(
             Vertex.raw_point_id == raw_point_id).all()
@@ -124,6 +152,20 @@ class RoutingPlanInferer(object):
         logger.debug("candidate vertices: " + ','.join(v_id_list))
         return {v.mode_id: v.vertex_id for v in candidate_vertices}
 
+    @metrics.timed('find_candidate_vertices')
+    def find_candidate_vertices_of_points(self, raw_point_ids):
+        """ Bulk version of _find_candidate_vertices, returning the candidate
+            vertices of each raw point keyed by point id and mode id
+        """
+        candidates = dict((p, {}) for p in raw_point_ids)
+        if candidates:
+            for point_id, mode_id, vertex_id in Session.query(
+                    Vertex.raw_point_id, Vertex.mode_id,
+                    Vertex.vertex_id).filter(
+                        Vertex.raw_point_id.in_(list(candidates))):
+                candidates[point_id][mode_id] = vertex_id
+        return candidates
+
     def _get_cost_factor(self, objective):
         if objective == 'shortest': return 'length'
         elif objective == 'fastest': return 'speed'
@@ -150,8 +192,8 @@ class RoutingPlanInferer(object):
                            for m in public_transit_modes + [MODES['foot']] \
                            if m in sources]
             if (not target is None) and (len(source_list) > 0):
-                st_pairs = map(lambda s: {"source": s, "target": target},
-                                    source_list)
+                st_pairs = [{"source": s, "target": target}
+                            for s in source_list]
         elif (s_mode != MODES['public_transportation']) and \
                 (t_mode == MODES['public_transportation']):
             source = sources[s_mode] if s_mode in sources else None
@@ -159,8 +201,8 @@ class RoutingPlanInferer(object):
                            for m in public_transit_modes + [MODES['foot']] \
                            if m in targets]
             if (not source is None) and (len(target_list) > 0):
-                st_pairs = map(lambda t: {"source": source, "target": t},
-                                    target_list)
+                st_pairs = [{"source": source, "target": t}
+                            for t in target_list]
         elif (s_mode == MODES['public_transportation']) and \
                 (t_mode == MODES['public_transportation']):
             source_list = [sources[m] \
@@ -174,13 +216,14 @@ class RoutingPlanInferer(object):
                                  for t in target_list]
         return st_pairs
 
+    @metrics.timed('generate_routing_plan')
     def generate_routing_plan(self):
         if self.options == {}:
             raise Exception('Empty routing options!')
         source_lon_lat = self._get_lon_lat_position(self.options['source'])
         target_lon_lat = self._get_lon_lat_position(self.options['target'])
-        nearest_source = self._find_nearest_point(source_lon_lat)
-        nearest_target = self._find_nearest_point(target_lon_lat)
+        nearest_source, nearest_target = self.snap_locations(
+            [source_lon_lat, target_lon_lat])
         candidate_sources = self._find_candidate_vertices(nearest_source[
             'point_id'])
         candidate_targets = self._find_candidate_vertices(nearest_target[
@@ -233,8 +276,8 @@ class RoutingPlanInferer(object):
                             'Take a car', routing_src, routing_tgt,
                             [MODES['private_car']], cost_factor)
                         if 'driving_distance_limit' in self.options:
-                            car_plan.target_constraint = VERTEX_VALIDATION_CHECKER(
-                                lambda v: 0 if v[0].distance <= float(self.options['driving_distance_limit']) * 1000.0 else -1)
+                            car_plan.target_constraint = MaxDistance(
+                                float(self.options['driving_distance_limit']) * 1000.0)
                         plans.append(car_plan)
                     # 2nd: foot only
                     st_pairs = self._find_valid_source_target_pairs(
@@ -282,8 +325,8 @@ class RoutingPlanInferer(object):
                         # remaining_gas_factor = 0.75
                         if 'driving_distance_limit' in self.options:
                             car_foot_plan.switch_constraint_list = [
-                                VERTEX_VALIDATION_CHECKER(
-                                    lambda v: 0 if v[0].distance <= float(self.options['driving_distance_limit']) * 1000.0 else -1)
+                                MaxDistance(
+                                    float(self.options['driving_distance_limit']) * 1000.0)
                             ]
                         else:
                             car_foot_plan.switch_constraint_list = [None]
@@ -339,8 +382,9 @@ class RoutingPlanInferer(object):
                         remaining_gas_factor = 0.5
                         if 'driving_distance_limit' in self.options:
                             car_foot_plan.switch_constraint_list = [
-                                VERTEX_VALIDATION_CHECKER(
-                                    lambda v: 0 if v[0].distance <= float(self.options['driving_distance_limit']) * 1000.0 * remaining_gas_factor else -1)
+                                MaxDistance(
+                                    float(self.options['driving_distance_limit']) * 1000.0 *
+                                    remaining_gas_factor)
                             ]
                         else:
                             car_foot_plan.switch_constraint_list = [None]
@@ -427,8 +471,8 @@ class RoutingPlanInferer(object):
                                            routing_tgt, [MODES['private_car']],
                                            cost_factor)
                     if 'driving_distance_limit' in self.options:
-                        car_plan.target_constraint = VERTEX_VALIDATION_CHECKER(
-                            lambda v: 0 if v[0].distance <= float(self.options['driving_distance_limit']) * 1000.0 else -1)
+                        car_plan.target_constraint = MaxDistance(
+                            float(self.options['driving_distance_limit']) * 1000.0)
                     plans.append(car_plan)
                 # 2: foot only
                 st_pairs = self._find_valid_source_target_pairs(
@@ -471,8 +515,8 @@ class RoutingPlanInferer(object):
                         ["type_id=" + str(type_id) + " AND is_available=true"])
                     if 'driving_distance_limit' in self.options:
                         car_foot_plan.switch_constraint_list = [
-                            VERTEX_VALIDATION_CHECKER(
-                                lambda v: 0 if v[0].distance <= float(self.options['driving_distance_limit']) * 1000.0 else -1)
+                            MaxDistance(
+                                float(self.options['driving_distance_limit']) * 1000.0)
                         ]
                     else:
                         car_foot_plan.switch_constraint_list = [None]
@@ -528,8 +572,8 @@ class RoutingPlanInferer(object):
                     car_public_plan1.public_transit_set = public_modes
                     if 'driving_distance_limit' in self.options:
                         car_public_plan1.switch_constraint_list = [
-                            VERTEX_VALIDATION_CHECKER(
-                                lambda v: 0 if v[0].distance <= float(self.options['driving_distance_limit']) * 1000.0 else -1)
+                            MaxDistance(
+                                float(self.options['driving_distance_limit']) * 1000.0)
                         ]
                     else:
                         car_public_plan1.switch_constraint_list = [None]
@@ -562,8 +606,8 @@ class RoutingPlanInferer(object):
                     car_public_plan2.public_transit_set = public_modes
                     if 'driving_distance_limit' in self.options:
                         car_public_plan2.switch_constraint_list = [
-                            VERTEX_VALIDATION_CHECKER(
-                                lambda v: 0 if v[0].distance <= float(self.options['driving_distance_limit']) * 1000.0 else -1)
+                            MaxDistance(
+                                float(self.options['driving_distance_limit']) * 1000.0)
                         ]
                     else:
                         car_public_plan2.switch_constraint_list = [None]
@@ -622,8 +666,9 @@ class RoutingPlanInferer(object):
                     remaining_gas_factor = 0.5
                     if 'driving_distance_limit' in self.options:
                         car_foot_plan.switch_constraint_list = [
-                            VERTEX_VALIDATION_CHECKER(
-                                lambda v: 0 if v[0].distance <= float(self.options['driving_distance_limit']) * 1000.0 * remaining_gas_factor else -1)
+                            MaxDistance(
+                                float(self.options['driving_distance_limit']) * 1000.0 *
+                                remaining_gas_factor)
                         ]
                     else:
                         car_foot_plan.switch_constraint_list = [None]
@@ -680,8 +725,9 @@ class RoutingPlanInferer(object):
                     remaining_gas_factor = 0.5
                     if 'driving_distance_limit' in self.options:
                         car_public_plan1.switch_constraint_list = [
-                            VERTEX_VALIDATION_CHECKER(
-                                lambda v: 0 if v[0].distance <= float(self.options['driving_distance_limit']) * 1000.0 * remaining_gas_factor else -1)
+                            MaxDistance(
+                                float(self.options['driving_distance_limit']) * 1000.0 *
+                                remaining_gas_factor)
                         ]
                     else:
                         car_public_plan1.switch_constraint_list = [None]
@@ -714,8 +760,8 @@ class RoutingPlanInferer(object):
                     car_public_plan1.public_transit_set = public_modes
                     if 'driving_distance_limit' in self.options:
                         car_public_plan1.switch_constraint_list = [
-                            VERTEX_VALIDATION_CHECKER(
-                                lambda v: 0 if v[0].distance <= float(self.options['driving_distance_limit']) * 1000.0 else -1)
+                            MaxDistance(
+                                float(self.options['driving_distance_limit']) * 1000.0)
                         ]
                     else:
                         car_public_plan1.switch_constraint_list = [None]
@@ -763,8 +809,8 @@ class RoutingPlanInferer(object):
                                 'Take a car', routing_src, routing_tgt,
                                 [MODES['private_car']], cost_factor)
                             if 'driving_distance_limit' in self.options:
-                                car_plan.target_constraint = VERTEX_VALIDATION_CHECKER(
-                                    lambda v: 0 if v[0].distance <= float(self.options['driving_distance_limit']) * 1000.0 else -1)
+                                car_plan.target_constraint = MaxDistance(
+                                    float(self.options['driving_distance_limit']) * 1000.0)
                             plans.append(car_plan)
                         # foot
                         st_pairs = self._find_valid_source_target_pairs(
@@ -0,0 +1,83 @@
+"""
+Holders of objects built at their first use, so that importing pymmrouting
+neither reads the configuration nor touches the database
+"""
+
+try:
+    from collections.abc import Mapping
+except ImportError:  # Python 2
+    from collections import Mapping
+import threading
+
+
+class LazyObject(object):
+
+    """ Holder of an object built by a builder function at the first call of
+    get() and shared by all the threads of the process
+    """
+
+    def __init__(self, builder):
+        self._builder = builder
+        self._object = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_built(self):
+        return self._object is not None
+
+    def get(self):
+        if self._object is None:
+            with self._lock:
+                if self._object is None:
+                    self._object = self._builder()
+        return self._object
+
+    def set(self, obj):
+        self._object = obj
+
+    def reset(self):
+        """ Drop the object, so that it is built again at the next use """
+        self._object = None
+
+
+class LazyMapping(Mapping):
+
+    """ Read-only dict whose items are loaded by a loader function at the
+    first access
+
+    A mapping derived from others, e.g. their inverse, names them in
+    derived_from, so that it is reset whenever they are set or reset.
+    """
+
+    def __init__(self, loader, derived_from=()):
+        self._items = LazyObject(lambda: dict(loader()))
+        self._derived = []
+        for mapping in derived_from:
+            mapping._derived.append(self)
+
+    def __getitem__(self, key):
+        return self._items.get()[key]
+
+    def __iter__(self):
+        return iter(self._items.get())
+
+    def __len__(self):
+        return len(self._items.get())
+
+    def __repr__(self):
+        if not self._items.is_built:
+            return "<%s not loaded>" % type(self).__name__
+        return repr(self._items.get())
+
+    def reset(self):
+        self._items.reset()
+        self._reset_derived()
+
+    def set(self, items):
+        """ Replace the items, e.g. with those of a graph snapshot """
+        self._items.set(dict(items))
+        self._reset_derived()
+
+    def _reset_derived(self):
+        for mapping in self._derived:
+            mapping.reset()
@@ -0,0 +1,415 @@
+"""
+Registry of counters and latency histograms of the routing pipeline, exposed
+in the Prometheus text format by render() or by a local HTTP endpoint
+
+Metrics are disabled by default. While they are, stage(), native_call() and
+timed() return before reading the clock, so the instrumented code pays one
+function call. Enable them in the process serving the requests:
+
+    from pymmrouting import metrics
+    metrics.enable(port=9464)
+
+Stages nest, e.g. snap_locations runs within generate_routing_plan, and the
+database queries are counted against the innermost stage.
+"""
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:  # Python 3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+from bisect import bisect_left
+from collections import OrderedDict
+from functools import wraps
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# Upper bounds in seconds of the latency buckets
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0)
+# Stage label of the queries sent outside of any stage
+NO_STAGE = 'none'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _escape(label_value):
+    return str(label_value).replace('\\', r'\\').replace('"', r'\"') \
+        .replace('\n', r'\n')
+
+
+def _format_sample(name, labels, value):
+    if labels:
+        name += '{%s}' % ','.join('%s="%s"' % (k, _escape(v))
+                                  for k, v in labels)
+    return '%s %s' % (name, _format_value(value))
+
+
+class Counter(object):
+
+    """ Monotonic counter with one value per combination of labels """
+
+    type_name = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(n, '')) for n in self.labelnames)
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def reset(self):
+        with self._lock:
+            self._values = {}
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield self.name, list(zip(self.labelnames, key)), value
+
+
+class Histogram(object):
+
+    """ Histogram of observed values, e.g. latencies in seconds, with one
+    set of buckets per combination of labels
+    """
+
+    type_name = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Non-cumulative count of every bucket and of +Inf, sum and count
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(n, '')) for n in self.labelnames)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = \
+                    [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def count(self, **labels):
+        entry = self._values.get(self._key(labels))
+        return 0 if entry is None else entry[2]
+
+    def sum(self, **labels):
+        entry = self._values.get(self._key(labels))
+        return 0.0 if entry is None else entry[1]
+
+    def reset(self):
+        with self._lock:
+            self._values = {}
+
+    def samples(self):
+        with self._lock:
+            values = sorted((k, (list(v[0]), v[1], v[2]))
+                            for k, v in self._values.items())
+        for key, (bucket_counts, total, count) in values:
+            labels = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float('inf'),),
+                                bucket_counts):
+                cumulative += n
+                yield (self.name + '_bucket',
+                       labels + [('le', _format_value(float(bound)))],
+                       cumulative)
+            yield self.name + '_sum', labels, total
+            yield self.name + '_count', labels, count
+
+
+class MetricsRegistry(object):
+
+    """ Named metrics of a process and the collectors called at rendering
+    time, e.g. to read the statistics of the caches
+    """
+
+    def __init__(self):
+        self._metrics = OrderedDict()
+        self._collectors = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            if metric.name not in self._metrics:
+                self._metrics[metric.name] = metric
+            return self._metrics[metric.name]
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(),
+                  buckets=DEFAULT_BUCKETS):
+        return self._register(
+            Histogram(name, documentation, labelnames, buckets))
+
+    def register_collector(self, name, collector):
+        """ Register a function returning a list of (metric name, type,
+            documentation, [(labels, value)]) to be rendered with the
+            metrics. A collector registered again under the same name
+            replaces the previous one.
+        """
+        self._collectors[name] = collector
+
+    def reset(self):
+        for metric in self._metrics.values():
+            metric.reset()
+
+    def render(self):
+        """ Return all the metrics in the Prometheus text format """
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.append('# HELP %s %s' % (metric.name, metric.documentation))
+            lines.append('# TYPE %s %s' % (metric.name, metric.type_name))
+            lines.extend(_format_sample(*s) for s in metric.samples())
+        # Collectors may report samples of the same metric, e.g. the hits
+        # of several caches, which are rendered as one family
+        families = OrderedDict()
+        for name, collector in list(self._collectors.items()):
+            try:
+                collected = collector()
+            except Exception:
+                logger.exception("Metrics collector %s failed", name)
+                continue
+            for metric_name, type_name, documentation, samples in collected:
+                families.setdefault(
+                    metric_name, (type_name, documentation, []))[2].extend(
+                        samples)
+        for metric_name, (type_name, documentation, samples) in \
+                families.items():
+            lines.append('# HELP %s %s' % (metric_name, documentation))
+            lines.append('# TYPE %s %s' % (metric_name, type_name))
+            lines.extend(_format_sample(metric_name, sorted(labels.items()),
+                                        value)
+                         for labels, value in samples)
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    'pymmrouting_stage_seconds',
+    "Latency of the stages of the routing pipeline by plan description",
+    ('stage', 'plan'))
+NATIVE_CALL_SECONDS = REGISTRY.histogram(
+    'pymmrouting_native_call_seconds',
+    "Latency of the calls into libmmspa4pg", ('call',))
+DB_QUERIES = REGISTRY.counter(
+    'pymmrouting_db_queries_total',
+    "Statements sent to the database by stage", ('stage',))
+ROUTES = REGISTRY.counter(
+    'pymmrouting_routes_total',
+    "Routes found by plan description and existence", ('plan', 'existent'))
+ROUTING_PLANS = REGISTRY.counter(
+    'pymmrouting_routing_plans_total',
+    "Routing plans prepared in libmmspa4pg, either assembled or reused",
+    ('outcome',))
+
+_enabled = False
+_listening = False
+_local = threading.local()
+
+
+def _stage_stack():
+    stack = getattr(_local, 'stages', None)
+    if stack is None:
+        stack = _local.stages = []
+    return stack
+
+
+def current_stage():
+    stack = _stage_stack()
+    return stack[-1] if stack else NO_STAGE
+
+
+def _count_query(*args):
+    if _enabled:
+        DB_QUERIES.inc(stage=current_stage())
+
+
+class _NullTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        return False
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer(object):
+
+    def __init__(self, histogram, labels, stage=None):
+        self._histogram = histogram
+        self._labels = labels
+        self._stage = stage
+
+    def __enter__(self):
+        if self._stage is not None:
+            _stage_stack().append(self._stage)
+        self._start = time.time()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self._histogram.observe(time.time() - self._start, **self._labels)
+        if self._stage is not None:
+            _stage_stack().pop()
+        return False
+
+
+def is_enabled():
+    return _enabled
+
+
+def enable(port=None, host='127.0.0.1'):
+    """ Start collecting metrics, and serve them over HTTP on a local port
+        if port is given. Return the HTTP server, if any.
+    """
+    global _enabled, _listening
+    if not _listening:
+        # Listening on the Engine class does not create the engine
+        event.listen(Engine, 'before_cursor_execute', _count_query)
+        _listening = True
+    _enabled = True
+    if port is not None:
+        return serve(port, host)
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def stage(name, plan=None):
+    """ Context manager timing a stage of the pipeline, labelled with the
+        description of the plan if any
+    """
+    if not _enabled:
+        return _NULL_TIMER
+    return _Timer(STAGE_SECONDS, {'stage': name, 'plan': plan or ''}, name)
+
+
+def native_call(name):
+    """ Context manager timing a call into libmmspa4pg """
+    if not _enabled:
+        return _NULL_TIMER
+    return _Timer(NATIVE_CALL_SECONDS, {'call': name})
+
+
+def timed(name):
+    """ Decorator timing every call of a function as a stage """
+    def decorate(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with _Timer(STAGE_SECONDS, {'stage': name, 'plan': ''}, name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def count_route(plan, is_existent):
+    if _enabled:
+        ROUTES.inc(plan=plan or '', existent=str(bool(is_existent)).lower())
+
+
+def count_routing_plan(reused):
+    if _enabled:
+        ROUTING_PLANS.inc(outcome='reused' if reused else 'assembled')
+
+
+def register_cache(name, stats):
+    """ Expose the statistics of a cache, given by a function returning the
+        stats() dict of an LRUCache or None if the cache is not built
+    """
+    REGISTRY.register_collector('cache:' + name,
+                                lambda: _cache_families(name, stats()))
+
+
+def _cache_families(name, stats):
+    if stats is None:
+        return []
+    labels = {'cache': name}
+    return [
+        ('pymmrouting_cache_hits_total', 'counter', "Hits of the caches",
+         [(labels, stats['hits'])]),
+        ('pymmrouting_cache_misses_total', 'counter', "Misses of the caches",
+         [(labels, stats['misses'])]),
+        ('pymmrouting_cache_hit_ratio', 'gauge',
+         "Ratio of the lookups of the caches that hit",
+         [(labels, stats['hit_ratio'])]),
+        ('pymmrouting_cache_entries', 'gauge', "Entries of the caches",
+         [(labels, stats['entries'])])
+    ]
+
+
+def render():
+    return REGISTRY.render()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def serve(port, host='127.0.0.1'):
+    """ Serve the metrics at /metrics from a daemon thread. Port 0 picks a
+        free port, see server.server_address. Stop it with shutdown().
+    """
+    server = HTTPServer((host, port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever,
+                              name='pymmrouting-metrics')
+    thread.daemon = True
+    thread.start()
+    logger.info("Serving metrics on http://%s:%s/metrics",
+                *server.server_address[:2])
+    return server
@@ -1,23 +1,77 @@
 """
 ORM definitions for mapping multimodal graph data stored in PostgreSQL database
 
+The engine is created at the first use of a session. The tables used on the
+hot paths are declared with explicit columns, the others are reflected by
+prepare_mappings() from a snapshot file of the schema, which is refreshed
+when the columns of the tables in the database have changed.
 """
 
-from sqlalchemy import create_engine, Column, BigInteger, String
+from sqlalchemy import create_engine, Column, BigInteger, Integer, String, \
+    Float, Boolean, DateTime, MetaData, text, func
 from sqlalchemy.orm import sessionmaker, scoped_session
-from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.ext.declarative import declarative_base, DeferredReflection
 from sqlalchemy.engine.url import URL
 from geoalchemy2 import Geometry
 from geoalchemy2.functions import ST_AsGeoJSON as st_asgeojson
-from .settings import PG_DB_CONF
+from .settings import PG_DB_CONF, get_schema_snapshot_file
+from .lazy import LazyObject, LazyMapping
+import sqlalchemy
+import hashlib
+import pickle
+import threading
 import json
 import logging
+import os
 
 logger = logging.getLogger(__name__)
 
-engine = create_engine(URL(**PG_DB_CONF))
-Base = declarative_base(bind=engine)
-Session = scoped_session(sessionmaker(engine))
+# Bump it whenever the layout of the schema snapshot file changes
+SCHEMA_SNAPSHOT_VERSION = 1
+
+_ENGINE = LazyObject(lambda: create_engine(URL(**PG_DB_CONF)))
+
+
+def get_engine():
+    return _ENGINE.get()
+
+
+def dispose_engine():
+    """ Close the pooled connections of the engine if it has been created """
+    if _ENGINE.is_built:
+        _ENGINE.get().dispose()
+
+
+_session_factory = sessionmaker()
+
+
+def _create_session(**kwargs):
+    kwargs.setdefault('bind', get_engine())
+    return _session_factory(**kwargs)
+
+Base = declarative_base()
+Session = scoped_session(_create_session)
+
+
+class SnapshotReflection(DeferredReflection):
+
+    """ Mixin of the classes mapped to tables reflected by prepare_mappings()
+
+    The columns of a table are copied from the schema snapshot if there is
+    a valid one, otherwise they are reflected from the database.
+    """
+
+    _snapshot = None
+
+    @classmethod
+    def _reflect_table(cls, table, engine):
+        snapshot = SnapshotReflection._snapshot
+        if snapshot is not None and table.key in snapshot.tables:
+            for column in snapshot.tables[table.key].columns:
+                if column.key not in table.columns:
+                    table.append_column(column.copy())
+        else:
+            super(SnapshotReflection, cls)._reflect_table(table, engine)
 
 
 class CarParking(Base):
@@ -58,7 +112,7 @@ class CarParking(Base):
     geom = Column(Geometry(geometry_type='POINT', srid=4326))
 
 
-class ParkAndRide(Base):
+class ParkAndRide(SnapshotReflection, Base):
     """ mapping of existing table park_and_rides
     Columns:
         id         integer NOT NULL,
@@ -95,10 +149,9 @@ class ParkAndRide(Base):
         geom   geometry,
     """
     __tablename__ = 'park_and_rides'
-    __table_args__ = {'autoload': True}
 
 
-class SuburbanJunction(Base):
+class SuburbanJunction(SnapshotReflection, Base):
     """ mapping of existing table suburban_junctions
     Columns:
         id       integer NOT NULL,
@@ -109,10 +162,9 @@ class SuburbanJunction(Base):
         geom geometry,
     """
     __tablename__ = 'suburban_junctions'
-    __table_args__ = {'autoload': True}
 
 
-class SuburbanLine(Base):
+class SuburbanLine(SnapshotReflection, Base):
     """ mapping of existing table suburban_lines
     Columns:
         id         integer NOT NULL,
@@ -137,10 +189,9 @@ class SuburbanLine(Base):
         geom   geometry,
     """
     __tablename__ = 'suburban_lines'
-    __table_args__ = {'autoload': True}
 
 
-class SuburbanStation(Base):
+class SuburbanStation(SnapshotReflection, Base):
     """ mapping of existing table suburban_stations
     Columns:
         id       integer NOT NULL DEFAULT,
@@ -157,10 +208,9 @@ class SuburbanStation(Base):
         geom geometry,
     """
     __tablename__ = 'suburban_stations'
-    __table_args__ = {'autoload': True}
 
 
-class TramJuction(Base):
+class TramJuction(SnapshotReflection, Base):
     """ mapping of existing table tram_junctions
     Columns:
         id       integer NOT NULL,
@@ -171,10 +221,9 @@ class TramJuction(Base):
         geom geometry,
     """
     __tablename__ = 'tram_junctions'
-    __table_args__ = {'autoload': True}
 
 
-class TramLine(Base):
+class TramLine(SnapshotReflection, Base):
     """ mapping of existing table tram_lines
     Columns:
         id         integer NOT NULL,
@@ -199,10 +248,9 @@ class TramLine(Base):
         geom   geometry,
     """
     __tablename__ = 'tram_lines'
-    __table_args__ = {'autoload': True}
 
 
-class TramStation(Base):
+class TramStation(SnapshotReflection, Base):
     """ mapping of existing table tram_stations
     Columns:
         id       integer NOT NULL,
@@ -219,15 +267,13 @@ class TramStation(Base):
         geom geometry,
     """
     __tablename__ = 'tram_stations'
-    __table_args__ = {'autoload': True}
 
 
-class UndergroundPlatform(Base):
+class UndergroundPlatform(SnapshotReflection, Base):
     __tablename__ = 'underground_platforms'
-    __table_args__ = {'autoload': True}
 
 
-class UndergroundJunction(Base):
+class UndergroundJunction(SnapshotReflection, Base):
     """ mapping of existing table underground_junctions
     Columns:
         id       integer NOT NULL,
@@ -238,10 +284,9 @@ class UndergroundJunction(Base):
         geom geometry,
     """
     __tablename__ = 'underground_junctions'
-    __table_args__ = {'autoload': True}
 
 
-class UndergroundLine(Base):
+class UndergroundLine(SnapshotReflection, Base):
     """ mapping of existing table underground_lines
     Columns:
         id         integer NOT NULL,
@@ -266,10 +311,9 @@ class UndergroundLine(Base):
         geom   geometry,
     """
     __tablename__ = 'underground_lines'
-    __table_args__ = {'autoload': True}
 
 
-class UndergroundStation(Base):
+class UndergroundStation(SnapshotReflection, Base):
     """ mapping of existing table underground_stations
     Columns:
         id       integer NOT NULL,
@@ -286,7 +330,6 @@ class UndergroundStation(Base):
         geom geometry,
     """
     __tablename__ = 'underground_stations'
-    __table_args__ = {'autoload': True}
 
 
 class Edge(Base):
@@ -301,9 +344,19 @@ class Edge(Base):
         from_id      bigint NOT NULL,
         to_id        bigint NOT NULL,
         edge_id      bigint NOT NULL,
+        link_id      bigint,
     """
     __tablename__ = 'edges'
-    __table_args__ = {'autoload': True}
+    id = Column(Integer, primary_key=True)
+    length = Column(Float)
+    speed_factor = Column(Float)
+    created_at = Column(DateTime)
+    updated_at = Column(DateTime)
+    mode_id = Column(Integer, nullable=False)
+    from_id = Column(BigInteger, nullable=False)
+    to_id = Column(BigInteger, nullable=False)
+    edge_id = Column(BigInteger, nullable=False)
+    link_id = Column(BigInteger)
 
 
 class Vertex(Base):
@@ -317,9 +370,19 @@ class Vertex(Base):
         mode_id    integer NOT NULL,
         x          double precision,
         y          double precision,
+        raw_point_id bigint,
     """
     __tablename__ = 'vertices'
-    __table_args__ = {'autoload': True}
+    id = Column(Integer, primary_key=True)
+    out_degree = Column(Integer)
+    created_at = Column(DateTime)
+    updated_at = Column(DateTime)
+    first_edge = Column(Float)
+    vertex_id = Column(BigInteger, nullable=False)
+    mode_id = Column(Integer, nullable=False)
+    x = Column(Float)
+    y = Column(Float)
+    raw_point_id = Column(BigInteger)
 
 
 class SwitchPoint(Base):
@@ -339,7 +402,18 @@ class SwitchPoint(Base):
         ref_poi_id      bigint,
     """
     __tablename__ = 'switch_points'
-    __table_args__ = {'autoload': True}
+    id = Column(Integer, primary_key=True)
+    cost = Column(Float)
+    is_available = Column(Boolean)
+    created_at = Column(DateTime)
+    updated_at = Column(DateTime)
+    from_mode_id = Column(Integer, nullable=False)
+    to_mode_id = Column(Integer, nullable=False)
+    type_id = Column(Integer, nullable=False)
+    from_vertex_id = Column(BigInteger, nullable=False)
+    to_vertex_id = Column(BigInteger, nullable=False)
+    switch_point_id = Column(BigInteger)
+    ref_poi_id = Column(BigInteger)
 
 
 class SwitchType(Base):
@@ -352,7 +426,11 @@ class SwitchType(Base):
         type_id    integer NOT NULL,
     """
     __tablename__ = 'switch_types'
-    __table_args__ = {'autoload': True}
+    id = Column(Integer, primary_key=True)
+    type_name = Column(String(255))
+    created_at = Column(DateTime)
+    updated_at = Column(DateTime)
+    type_id = Column(Integer, nullable=False)
 
 
 class Mode(Base):
@@ -365,7 +443,11 @@ class Mode(Base):
         mode_id    integer NOT NULL,
     """
     __tablename__ = 'modes'
-    __table_args__ = {'autoload': True}
+    id = Column(Integer, primary_key=True)
+    mode_name = Column(String(255))
+    created_at = Column(DateTime)
+    updated_at = Column(DateTime)
+    mode_id = Column(Integer, nullable=False)
 
 
 class OSMLine(Base):
@@ -556,8 +638,123 @@ class StreetJunction(Base):
     osm_id = Column(BigInteger, primary_key=True)
     geom = Column(Geometry(geometry_type='POINT', srid=4326))
 
+REFLECTED_TABLES = sorted(
+    c.__tablename__ for c in [
+        ParkAndRide, SuburbanJunction, SuburbanLine, SuburbanStation,
+        TramJuction, TramLine, TramStation, UndergroundPlatform,
+        UndergroundJunction, UndergroundLine, UndergroundStation])
+
+_REFLECTION_LOCK = threading.Lock()
+_mappings_prepared = False
+
+
+def _schema_fingerprint(engine, table_names):
+    rows = engine.execute(text(
+        "SELECT table_name, column_name, data_type, udt_name, "
+        "ordinal_position FROM information_schema.columns "
+        "WHERE table_schema = current_schema() AND table_name = ANY(:names)"),
+        names=list(table_names)).fetchall()
+    fingerprint = hashlib.md5(
+        repr(sorted(tuple(str(c) for c in r) for r in rows)).encode('utf-8'))
+    return fingerprint.hexdigest()
+
+
+def _load_schema_snapshot(snapshot_file, fingerprint):
+    if not os.path.exists(snapshot_file):
+        return None
+    try:
+        with open(snapshot_file, 'rb') as f:
+            snapshot = pickle.load(f)
+    except Exception:
+        logger.warning("Can not read schema snapshot %s", snapshot_file,
+                       exc_info=True)
+        return None
+    if snapshot.get('version') != SCHEMA_SNAPSHOT_VERSION or \
+            snapshot.get('sqlalchemy') != sqlalchemy.__version__ or \
+            snapshot.get('fingerprint') != fingerprint:
+        logger.info("Schema snapshot %s is out of date", snapshot_file)
+        return None
+    return snapshot['metadata']
+
+
+def _save_schema_snapshot(snapshot_file, fingerprint, table_names):
+    metadata = MetaData()
+    for name in table_names:
+        Base.metadata.tables[name].tometadata(metadata)
+    snapshot = {
+        'version':     SCHEMA_SNAPSHOT_VERSION,
+        'sqlalchemy':  sqlalchemy.__version__,
+        'fingerprint': fingerprint,
+        'metadata':    metadata
+    }
+    tmp_file = snapshot_file + '.tmp'
+    try:
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(snapshot, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_file, snapshot_file)
+        logger.info("Saved schema snapshot to %s", snapshot_file)
+    except Exception:
+        logger.warning("Can not save schema snapshot %s", snapshot_file,
+                       exc_info=True)
+
+
+def prepare_mappings():
+    """ Map the classes of REFLECTED_TABLES. It has to be called before
+        using them, and does nothing after the first call.
+    """
+    global _mappings_prepared
+    if _mappings_prepared:
+        return
+    with _REFLECTION_LOCK:
+        if _mappings_prepared:
+            return
+        engine = get_engine()
+        snapshot_file = get_schema_snapshot_file()
+        fingerprint = _schema_fingerprint(engine, REFLECTED_TABLES)
+        snapshot = _load_schema_snapshot(snapshot_file, fingerprint)
+        SnapshotReflection._snapshot = snapshot
+        try:
+            SnapshotReflection.prepare(engine)
+        finally:
+            SnapshotReflection._snapshot = None
+        if snapshot is None:
+            _save_schema_snapshot(snapshot_file, fingerprint,
+                                  REFLECTED_TABLES)
+        _mappings_prepared = True
+
+
+# Modes and switch types, loaded from database once at the first use and
+# shared by all the modules
+MODES = LazyMapping(lambda: (
+    (str(m_name), m_id)
+    for m_name, m_id in Session.query(Mode.mode_name, Mode.mode_id)))
+INV_MODES = LazyMapping(lambda: (
+    (m_id, m_name) for m_name, m_id in MODES.items()), derived_from=[MODES])
+SWITCH_TYPES = LazyMapping(lambda: (
+    (str(t_name), t_id)
+    for t_name, t_id in Session.query(SwitchType.type_name,
+                                      SwitchType.type_id)))
+
+
+def graph_data_version():
+    """ Version of the graph data, i.e. the time of the last update of the
+        edges, vertices and switch points
+    """
+    row = Session.query(
+        Session.query(func.max(Edge.updated_at)).as_scalar(),
+        Session.query(func.max(Vertex.updated_at)).as_scalar(),
+        Session.query(func.max(SwitchPoint.updated_at)).as_scalar()).one()
+    return '|'.join(str(v) for v in row)
+
+
 def get_waypoints(way_geom):
-    geom_json = json.loads(Session.scalar(st_asgeojson(way_geom)))
+    return parse_waypoints(Session.scalar(st_asgeojson(way_geom)))
+
+def parse_waypoints(geojson_str):
+    """ Flatten the coordinates of a (multi)linestring GeoJSON string into a
+        single list of way points
+    """
+    geom_json = json.loads(geojson_str)
     coord_list = []
     if geom_json['type'].upper() == 'LINESTRING':
         coord_list = geom_json['coordinates']
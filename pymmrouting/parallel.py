@@ -0,0 +1,101 @@
+"""
+Find the paths of routing plans in a pool of worker processes. libmmspa4pg
+keeps global state, so each worker owns one warm MultimodalRoutePlanner.
+"""
+
+from multiprocessing import Pool
+from multiprocessing.util import Finalize
+from .orm_graphmodel import Session, dispose_engine
+from .spatialindex import get_street_junction_index
+from .routeplanner import MultimodalRoutePlanner, POSTGRESQL_DATASOURCES, \
+    materialize_routes, results_document, refine_results, prune_results, \
+    group_plans, stream_routes
+import logging
+try:
+    from itertools import izip as zip
+except ImportError:  # Python 3
+    pass
+
+logger = logging.getLogger(__name__)
+
+# Planner owned by the current worker process
+_worker_planner = None
+
+
+def _init_worker(planner_class, datasource_type, datasource_url):
+    global _worker_planner
+    # Never share the database connections inherited from the parent
+    Session.remove()
+    dispose_engine()
+    _worker_planner = planner_class(datasource_type, datasource_url)
+    Finalize(_worker_planner, _worker_planner.cleanup, exitpriority=10)
+    logger.info("Worker planner is ready")
+
+
+def _find_routing_results(plans):
+    return _worker_planner.find_routing_results(plans)
+
+
+class PlannerPool(object):
+
+    """ Pool of worker processes with one initialized planner each
+
+    The pool should be created before any planner is opened in the parent
+    process, so that the workers do not inherit its native state. The
+    planners are instances of planner_class, e.g. PythonRoutePlanner. Plans
+    sharing one search (see group_plans) are dispatched together, and the
+    routing results come back in the order of the plans.
+    """
+
+    def __init__(self, processes=None, datasource_type='POSTGRESQL',
+                 datasource_url=None, planner_class=MultimodalRoutePlanner):
+        if datasource_type.upper() in POSTGRESQL_DATASOURCES:
+            # The street junction index of the config is loaded before the
+            # workers are forked, so that they share it. Pools on graph
+            # snapshots need no config.
+            get_street_junction_index()
+        self._pool = Pool(processes, _init_worker,
+                          (planner_class, datasource_type, datasource_url))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def find_routing_results(self, plans):
+        groups = group_plans(plans)
+        group_results = self._pool.map(
+            _find_routing_results, [[plans[i] for i in g] for g in groups],
+            chunksize=1)
+        routing_results = [None] * len(plans)
+        for group, results in zip(groups, group_results):
+            for i, r in zip(group, results):
+                routing_results[i] = r
+        return routing_results
+
+    def batch_find_path(self, plans, geometry_options=None):
+        """ Same as MultimodalRoutePlanner.batch_find_path, but the paths of
+            the plans are found in parallel
+        """
+        routing_results = prune_results(plans,
+                                        self.find_routing_results(plans))
+        routes = materialize_routes(plans, routing_results, geometry_options)
+        return refine_results(
+            results_document(plans, routes),
+            [p for p, r in zip(plans, routes) if r is not None])
+
+    def iter_find_path(self, plans, sort_by_duration=False,
+                       geometry_options=None):
+        """ Same as MultimodalRoutePlanner.iter_find_path, but the paths of
+            the plans are found in parallel. The routes of a group are
+            yielded once all the groups before it are done.
+        """
+        groups = [[plans[i] for i in g] for g in group_plans(plans)]
+        return stream_routes(
+            zip(groups, self._pool.imap(_find_routing_results, groups)),
+            sort_by_duration, geometry_options)
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
@@ -0,0 +1,352 @@
+"""
+Pure Python engine of multimodal shortest paths over the CSR graph of a graph
+snapshot, so that the Python layers can be run, profiled and scale-tested
+without libmmspa4pg and PostgreSQL
+"""
+
+from ctypes import pointer
+from heapq import heappush, heappop
+from .datamodel import CVertex
+from .routeplanner import MultimodalRoutePlanner, SNAPSHOT_DATASOURCES, \
+    FINAL_COST_FIELDS, assemble_result
+from .orm_graphmodel import MODES, SWITCH_TYPES
+from .graphsnapshot import GraphSnapshot
+from .graphindex import set_vertex_mode_index, set_edge_index
+from . import metrics
+import logging
+import re
+import time
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Minutes to travel one meter at 1 km/h. The speed_factor of edges is the
+# speed in km/h, as in libmmspa4pg.
+MINUTES_PER_METER_AT_1_KMH = 0.06
+
+# Columns of switch points usable in switch conditions and the arrays of a
+# graph snapshot holding them
+SWITCH_CONDITION_COLUMNS = {
+    'type_id':      'switch_type_ids',
+    'from_mode_id': 'switch_from_modes',
+    'to_mode_id':   'switch_to_modes',
+    'ref_poi_id':   'switch_ref_poi_ids'
+}
+_CONDITION_TERM = re.compile(r"^\s*(\w+)\s*(=|!=|<>)\s*'?([\w.-]+)'?\s*$")
+
+
+def switch_condition_mask(graph, condition):
+    """ Evaluate a switch condition of a plan, i.e. a conjunction of
+        comparisons like "type_id=3 AND is_available=true", over the switch
+        points of a graph snapshot
+    """
+    mask = np.ones(len(graph.switch_from_ids), dtype=bool)
+    if not condition:
+        return mask
+    for term in re.split(r"\s+AND\s+", condition.strip(), flags=re.I):
+        match = _CONDITION_TERM.match(term)
+        if match is None:
+            raise ValueError("Unsupported switch condition: %s" % condition)
+        column, op, value = match.groups()
+        if column == 'is_available':
+            # Snapshots only hold the available switch points
+            term_mask = np.full(len(mask), value.lower() == 'true')
+        elif column in SWITCH_CONDITION_COLUMNS:
+            term_mask = getattr(
+                graph, SWITCH_CONDITION_COLUMNS[column]) == int(value)
+        else:
+            raise ValueError("Unsupported switch condition: %s" % condition)
+        mask &= term_mask if op == '=' else ~term_mask
+    return mask
+
+
+def compile_constraint(constraint):
+    """ Turn a constraint of a plan into a predicate of (distance,
+        elapsed_time, walking_distance), or None if there is no constraint
+    """
+    if constraint is None:
+        return None
+    bounds = constraint.bounds() if hasattr(constraint, 'bounds') else None
+    if bounds is not None:
+        max_distance, max_duration, max_walking = bounds
+        return lambda d, t, w: \
+            d <= max_distance and t <= max_duration and w <= max_walking
+
+    def vertex(d, t, w):
+        return CVertex(distance=d, elapsed_time=t, walking_distance=w)
+    if hasattr(constraint, 'accepts'):
+        return lambda d, t, w: constraint.accepts(vertex(d, t, w))
+    # A VERTEX_VALIDATION_CHECKER callback
+    return lambda d, t, w: constraint(pointer(vertex(d, t, w))) == 0
+
+
+class SearchTree(object):
+
+    """ Labels of the vertices settled by a search, one per vertex and layer
+
+    Layer i of a search holds the vertices of the i-th mode of the plan.
+    """
+
+    def __init__(self, graph, n_layers, costs, labels, parents):
+        self._graph = graph
+        self._n_layers = n_layers
+        self._costs = costs
+        self._labels = labels
+        self._parents = parents
+
+    def _final_state(self, target_id):
+        i = self._graph.position_of(target_id)
+        if i < 0:
+            return None
+        state = (self._n_layers - 1) * len(self._graph) + i
+        return state if state in self._labels else None
+
+    def final_costs(self, target_id):
+        """ Return the final costs keyed by the attributes of RoutingResult,
+            or None if the target is unreachable
+        """
+        state = self._final_state(target_id)
+        if state is None:
+            return None
+        return dict(zip([attr for attr, _ in FINAL_COST_FIELDS],
+                        self._labels[state]))
+
+    def vertex_lists(self, target_id):
+        """ Return the vertex ids of the path to a target split by layer, or
+            None if the target is unreachable
+        """
+        state = self._final_state(target_id)
+        if state is None:
+            return None
+        n = len(self._graph)
+        vertex_lists = [[] for _ in range(self._n_layers)]
+        while state is not None:
+            vertex_lists[state // n].append(int(self._graph.vertex_ids[
+                state % n]))
+            state = self._parents[state]
+        for vertices in vertex_lists:
+            vertices.reverse()
+        return vertex_lists
+
+
+class PythonEngine(object):
+
+    """ Label-setting (Dijkstra) search over the layers of a multimodal graph
+
+    Layer i of a plan holds the vertices of its i-th mode, or of foot and the
+    public transit modes for public transportation. Edges of the graph link
+    vertices of the same layer, switch points matching the i-th switch
+    condition link layer i to layer i + 1. Switch points between the modes
+    of a public transportation layer are free transitions within it.
+    """
+
+    def __init__(self, graph):
+        self.graph = graph
+        # Python lists are much faster than numpy arrays element by element
+        self._offsets = graph.offsets.tolist()
+        self._targets = graph.edge_targets.tolist()
+        self._lengths = graph.edge_lengths.astype(np.float64).tolist()
+        self._minutes = (
+            graph.edge_lengths.astype(np.float64) *
+            MINUTES_PER_METER_AT_1_KMH /
+            graph.edge_speed_factors.astype(np.float64)).tolist()
+        self._vertex_modes = graph.vertex_modes.tolist()
+        self._switch_from = np.searchsorted(graph.vertex_ids,
+                                            graph.switch_from_ids)
+        self._switch_to = np.searchsorted(graph.vertex_ids,
+                                          graph.switch_to_ids)
+        self._transitions = {}
+
+    def _layer_modes(self, plan):
+        modes = self.graph.modes
+        layers = []
+        for m in plan.mode_list:
+            if m == modes.get('public_transportation'):
+                layers.append(frozenset([modes['foot']] +
+                                        list(plan.public_transit_set)))
+            else:
+                layers.append(frozenset([m]))
+        return layers
+
+    def _switches(self, mask):
+        """ Return a dict of the switch points of a mask keyed by the
+            position of the from vertex
+        """
+        switches = {}
+        for u, v, cost in zip(self._switch_from[mask].tolist(),
+                              self._switch_to[mask].tolist(),
+                              self.graph.switch_costs[mask].tolist()):
+            switches.setdefault(u, []).append((v, cost))
+        return switches
+
+    def transitions(self, plan):
+        """ Return the switch points within every layer and between every
+            two consecutive layers of a plan
+        """
+        layers = self._layer_modes(plan)
+        key = (tuple(layers), tuple(plan.switch_condition_list))
+        if key not in self._transitions:
+            from_modes = self.graph.switch_from_modes
+            to_modes = self.graph.switch_to_modes
+            within = []
+            for modes in layers:
+                mask = np.isin(from_modes, list(modes)) & \
+                    np.isin(to_modes, list(modes))
+                within.append(self._switches(mask) if len(modes) > 1 else {})
+            between = []
+            for i in range(len(layers) - 1):
+                mask = np.isin(from_modes, list(layers[i])) & \
+                    np.isin(to_modes, list(layers[i + 1])) & \
+                    switch_condition_mask(
+                        self.graph, plan.switch_condition_list[i])
+                between.append(self._switches(mask))
+            self._transitions[key] = (layers, within, between)
+        return self._transitions[key]
+
+    @metrics.timed('python_search')
+    def search(self, plan, source_id, target_ids=None):
+        """ Search from a source vertex with the modes, switch conditions and
+            constraints of a plan. The search stops once all the targets are
+            settled if target_ids is given.
+        """
+        t1 = time.time()
+        layers, within, between = self.transitions(plan)
+        n = len(self.graph)
+        n_layers = len(layers)
+        by_length = plan.cost_factor == 'length'
+        foot = self.graph.modes.get('foot')
+        switch_checks = [compile_constraint(c)
+                         for c in plan.switch_constraint_list]
+        switch_checks += [None] * (n_layers - 1 - len(switch_checks))
+        target_check = compile_constraint(plan.target_constraint)
+        offsets, targets = self._offsets, self._targets
+        lengths, minutes = self._lengths, self._minutes
+        vertex_modes = self._vertex_modes
+
+        costs, labels, parents = {}, {}, {}
+        heap = []
+
+        def relax(state, cost, label, parent):
+            if cost < costs.get(state, float('inf')):
+                costs[state] = cost
+                labels[state] = label
+                parents[state] = parent
+                heappush(heap, (cost, state))
+
+        pending = None
+        if target_ids is not None:
+            pending = set((n_layers - 1) * n + i for i in
+                          (self.graph.position_of(t) for t in target_ids)
+                          if i >= 0)
+        source = self.graph.position_of(source_id)
+        if source >= 0 and vertex_modes[source] in layers[0]:
+            relax(source, 0.0, (0.0, 0.0, 0.0, 0.0), None)
+        settled = set()
+        while heap:
+            cost, state = heappop(heap)
+            if state in settled or cost > costs[state]:
+                continue
+            layer, u = divmod(state, n)
+            d, t, wd, wt = labels[state]
+            if layer == n_layers - 1 and target_check is not None and \
+                    not target_check(d, t, wd):
+                # Invalid vertices are neither reached nor expanded
+                del labels[state]
+                continue
+            settled.add(state)
+            if pending is not None:
+                pending.discard(state)
+                if not pending:
+                    break
+            base = layer * n
+            modes = layers[layer]
+            walking = vertex_modes[u] == foot
+            for e in range(offsets[u], offsets[u + 1]):
+                v = targets[e]
+                if vertex_modes[v] not in modes:
+                    continue
+                length, minute = lengths[e], minutes[e]
+                label = (d + length, t + minute,
+                         wd + length if walking else wd,
+                         wt + minute if walking else wt)
+                relax(base + v, cost + (length if by_length else minute),
+                      label, state)
+            for v, switch_cost in within[layer].get(u, ()):
+                relax(base + v, cost + (0.0 if by_length else switch_cost),
+                      (d, t + switch_cost, wd, wt), state)
+            if layer < n_layers - 1 and u in between[layer]:
+                check = switch_checks[layer]
+                if check is not None and not check(d, t, wd):
+                    continue
+                for v, switch_cost in between[layer][u]:
+                    relax(base + n + v,
+                          cost + (0.0 if by_length else switch_cost),
+                          (d, t + switch_cost, wd, wt), state)
+        # Only the settled labels are final
+        for state in list(labels):
+            if state not in settled:
+                del labels[state]
+        logger.debug("Settled %s labels in %s seconds", len(settled),
+                     time.time() - t1)
+        return SearchTree(self.graph, n_layers, costs, labels, parents)
+
+
+class PythonRoutePlanner(MultimodalRoutePlanner):
+
+    """ Planner with the same API as MultimodalRoutePlanner, finding paths
+    with PythonEngine over a graph snapshot instead of libmmspa4pg. The
+    modes, switch types, vertex and edge indexes of the process are taken
+    from the snapshot, so paths are found without any database.
+    """
+
+    def __init__(self, datasource_type='SNAPSHOT', datasource_url=None):
+        self._constraint_checkers = []
+        self.graph_snapshot = None
+        self.open_datasource(datasource_type, datasource_url)
+        MODES.set(self.graph_snapshot.modes)
+        SWITCH_TYPES.set(self.graph_snapshot.switch_types)
+        self.engine = PythonEngine(self.graph_snapshot)
+
+    def open_datasource(self, ds_type, ds_url):
+        if ds_type.upper() not in SNAPSHOT_DATASOURCES:
+            raise ValueError("PythonRoutePlanner needs a graph snapshot")
+        self.data_source_type = ds_type.upper()
+        self.graph_snapshot = GraphSnapshot.open(ds_url)
+        # Paths are translated with the graph of the snapshot instead of
+        # the database
+        set_vertex_mode_index(self.graph_snapshot.vertex_mode_index())
+        set_edge_index(self.graph_snapshot.edge_index())
+
+    def cleanup(self):
+        self.graph_snapshot.close()
+
+    def find_routing_result(self, plan):
+        return self._find_routing_results_from_source([plan])[0]
+
+    def _find_routing_results_from_source(self, plans):
+        tree = self.engine.search(
+            plans[0], plans[0].source['properties']['id'],
+            [p.target['properties']['id'] for p in plans])
+        routing_results = []
+        for p in plans:
+            target = p.target['properties']['id']
+            vertex_lists = tree.vertex_lists(target)
+            routing_results.append(assemble_result(
+                p, vertex_lists,
+                None if vertex_lists is None else tree.final_costs(target)))
+        return routing_results
+
+    def _prepare_searches(self, plan):
+        # Every search of the engine takes the plan itself
+        pass
+
+    def _final_costs_from_source(self, plan, source, targets):
+        tree = self.engine.search(plan, source, targets)
+        costs = dict((field, np.full(len(targets), np.nan))
+                     for _, field in FINAL_COST_FIELDS)
+        for j, target in enumerate(targets):
+            final_costs = tree.final_costs(target)
+            if final_costs is not None:
+                for attr, field in FINAL_COST_FIELDS:
+                    costs[field][j] = final_costs[attr]
+        return costs
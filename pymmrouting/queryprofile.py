@@ -0,0 +1,222 @@
+"""
+Opt-in profiler of the SQL statements sent through the engine of
+orm_graphmodel.py, counting queries and their time per scope and flagging
+statements repeated within one scope as likely N+1 patterns
+
+    with profile_queries() as profile:
+        results = planner.batch_find_path(plans)
+    print(profile.report())
+
+Tests can assert query budgets with query_budget(). In debug mode, enabled
+by set_debug(True) or the environment variable PYMMROUTING_DEBUG_QUERIES=1,
+every RoutingResult carries the profile of its search and materialization
+as query_profile, and its dict has it under "query_profile".
+"""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import logging
+import os
+import re
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Times a statement shape may run in one scope before it is flagged
+DEFAULT_REPEAT_THRESHOLD = 3
+
+_PARAMETER = re.compile(
+    r"%\(\w+\)s|(?<!:):\w+|\?|'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_PARAMETER_LIST = re.compile(r"\?(?:\s*,\s*\?)+")
+_SQLALCHEMY_DIR = os.sep + 'sqlalchemy' + os.sep
+_THIS_FILE = os.path.splitext(os.path.abspath(__file__))[0]
+
+_debug = os.environ.get('PYMMROUTING_DEBUG_QUERIES', '') not in ('', '0')
+_listening = False
+_local = threading.local()
+
+
+def statement_shape(statement):
+    """ Replace the literals and bound parameters of a statement by ?, so
+        that the same query with other values has the same shape
+    """
+    shape = _PARAMETER.sub('?', ' '.join(statement.split()))
+    return _PARAMETER_LIST.sub('?, ...', shape)
+
+
+def _call_site():
+    """ Return the innermost caller outside of SQLAlchemy and this module """
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = os.path.abspath(frame.f_code.co_filename)
+        if _SQLALCHEMY_DIR not in filename and \
+                os.path.splitext(filename)[0] != _THIS_FILE:
+            return '%s:%s in %s' % (os.path.relpath(filename),
+                                    frame.f_lineno, frame.f_code.co_name)
+        frame = frame.f_back
+    return '<unknown>'
+
+
+class QueryProfile(object):
+
+    """ Statements run within a scope, as (shape, seconds, call site) """
+
+    def __init__(self, name='', repeat_threshold=DEFAULT_REPEAT_THRESHOLD):
+        self.name = name
+        self.repeat_threshold = repeat_threshold
+        self.queries = []
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def seconds(self):
+        return sum(q[1] for q in self.queries)
+
+    def copy(self, name=None):
+        profile = QueryProfile(self.name if name is None else name,
+                               self.repeat_threshold)
+        profile.queries = list(self.queries)
+        return profile
+
+    def shapes(self):
+        """ Return the count, time and call sites of every statement shape,
+            in the order of their first run
+        """
+        shapes = OrderedDict()
+        for shape, seconds, call_site in self.queries:
+            entry = shapes.setdefault(
+                shape, {'count': 0, 'seconds': 0.0,
+                        'call_sites': OrderedDict()})
+            entry['count'] += 1
+            entry['seconds'] += seconds
+            entry['call_sites'][call_site] = \
+                entry['call_sites'].get(call_site, 0) + 1
+        return shapes
+
+    def suspected_n_plus_one(self):
+        """ Return the statement shapes run at least repeat_threshold times,
+            the most frequent first
+        """
+        repeated = [dict(entry, shape=shape, call_sites=list(
+                        entry['call_sites'].items()))
+                    for shape, entry in self.shapes().items()
+                    if entry['count'] >= self.repeat_threshold]
+        repeated.sort(key=lambda r: -r['count'])
+        return repeated
+
+    def to_dict(self):
+        return {
+            'name':     self.name,
+            'queries':  self.count,
+            'seconds':  self.seconds,
+            'shapes':   len(self.shapes()),
+            'repeated': self.suspected_n_plus_one()
+        }
+
+    def report(self):
+        lines = ["%s queries of %s shapes in %.3f seconds%s" % (
+            self.count, len(self.shapes()), self.seconds,
+            ' (%s)' % self.name if self.name else '')]
+        for r in self.suspected_n_plus_one():
+            lines.append("  %s times, %.3f seconds: %s" % (
+                r['count'], r['seconds'], r['shape']))
+            for call_site, n in r['call_sites']:
+                lines.append("    %s times at %s" % (n, call_site))
+        return '\n'.join(lines)
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def _active_profiles():
+    profiles = getattr(_local, 'profiles', None)
+    if profiles is None:
+        profiles = _local.profiles = []
+    return profiles
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    if _active_profiles():
+        conn.info.setdefault('query_start_times', []).append(time.time())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    profiles = _active_profiles()
+    start_times = conn.info.get('query_start_times')
+    if not profiles or not start_times:
+        return
+    query = (statement_shape(statement), time.time() - start_times.pop(),
+             _call_site())
+    for profile in profiles:
+        profile.queries.append(query)
+
+
+def _listen():
+    global _listening
+    if not _listening:
+        # Listening on the Engine class does not create the engine
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        _listening = True
+
+
+@contextmanager
+def profile_queries(profile=None, name=''):
+    """ Record the statements run by the current thread into a new profile,
+        or into the given one. Scopes nest, and a statement is recorded into
+        every enclosing profile.
+    """
+    _listen()
+    profile = QueryProfile(name) if profile is None else profile
+    profiles = _active_profiles()
+    profiles.append(profile)
+    try:
+        yield profile
+    finally:
+        profiles.remove(profile)
+
+
+@contextmanager
+def query_budget(max_queries, max_repeats=None):
+    """ Raise QueryBudgetExceeded if the scope runs more than max_queries
+        statements, or a statement shape more than max_repeats times
+    """
+    with profile_queries() as profile:
+        yield profile
+    if profile.count > max_queries:
+        raise QueryBudgetExceeded("%s queries over a budget of %s\n%s" % (
+            profile.count, max_queries, profile.report()))
+    if max_repeats is not None:
+        for shape, entry in profile.shapes().items():
+            if entry['count'] > max_repeats:
+                raise QueryBudgetExceeded(
+                    "%s runs of one statement over a budget of %s: %s\n%s" %
+                    (entry['count'], max_repeats, shape, profile.report()))
+
+
+def is_debug():
+    return _debug
+
+
+def set_debug(debug):
+    global _debug
+    _debug = bool(debug)
+
+
+@contextmanager
+def debug_scope(profile=None, name=''):
+    """ Same as profile_queries in debug mode, otherwise yield None """
+    if not _debug:
+        yield None
+        return
+    with profile_queries(profile, name) as profile:
+        yield profile
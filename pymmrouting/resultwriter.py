@@ -0,0 +1,127 @@
+"""
+Write routes into a file or socket one at a time as they are found, without
+holding the whole document in memory
+
+    with open('results.json', 'w') as f, ResultWriter(f) as writer:
+        for route in planner.iter_find_path(plans):
+            writer.write_route(route)
+        writer.write_endpoints(plans[0])
+
+ResultWriter writes the same document as batch_find_path, and
+FeatureCollectionWriter writes the features of all the routes as a single
+GeoJSON FeatureCollection. A socket can be written through
+socket.makefile('w').
+"""
+
+import json
+
+
+def endpoint_features(plan):
+    """ Return copies of the source and target features of a plan without
+        the vertex ids internal to the planner
+    """
+    features = []
+    for feature in (plan.source, plan.target):
+        feature = dict(feature)
+        feature['properties'] = dict(
+            (k, v) for k, v in feature.get('properties', {}).items()
+            if k != 'id')
+        features.append(feature)
+    return features
+
+
+class _StreamWriter(object):
+
+    def __init__(self, stream, indent=None):
+        self.stream = stream
+        self._encoder = json.JSONEncoder(indent=indent)
+        self._started = False
+        self._count = 0
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        # Leave an invalid document on errors rather than hide them
+        if type is None:
+            self.close()
+
+    @property
+    def count(self):
+        return self._count
+
+    def _write_item(self, item):
+        if not self._started:
+            self.stream.write(self._head())
+            self._started = True
+        if self._count > 0:
+            self.stream.write(', ')
+        for chunk in self._encoder.iterencode(item):
+            self.stream.write(chunk)
+        self._count += 1
+
+    def close(self):
+        if self._closed:
+            return
+        if not self._started:
+            self.stream.write(self._head())
+        self.stream.write(self._tail())
+        self._closed = True
+
+
+class ResultWriter(_StreamWriter):
+
+    """ Incremental writer of {"routes": [...], "source": ..., "target": ...}
+    """
+
+    def __init__(self, stream, indent=None):
+        super(ResultWriter, self).__init__(stream, indent)
+        self._endpoints = None
+
+    def _head(self):
+        return '{"routes": ['
+
+    def _tail(self):
+        tail = ']'
+        if self._endpoints is not None:
+            tail += ', "source": %s, "target": %s' % tuple(
+                self._encoder.encode(f) for f in self._endpoints)
+        return tail + '}\n'
+
+    def write_route(self, route):
+        self._write_item(route)
+
+    def write_endpoints(self, plan):
+        """ Write the source and target of the plans at closing """
+        self._endpoints = endpoint_features(plan)
+
+
+class FeatureCollectionWriter(_StreamWriter):
+
+    """ Incremental writer of a GeoJSON FeatureCollection of the paths and
+    switch points of routes. Every feature gets the index and summary of its
+    route in its properties.
+    """
+
+    def __init__(self, stream, indent=None):
+        super(FeatureCollectionWriter, self).__init__(stream, indent)
+        self._routes = 0
+
+    def _head(self):
+        return '{"type": "FeatureCollection", "features": ['
+
+    def _tail(self):
+        return ']}\n'
+
+    def write_feature(self, feature):
+        self._write_item(feature)
+
+    def write_route(self, route):
+        for feature in route['geojson']['features']:
+            feature = dict(feature)
+            feature['properties'] = dict(feature.get('properties', {}),
+                                         route=self._routes,
+                                         summary=route['summary'])
+            self.write_feature(feature)
+        self._routes += 1
@@ -0,0 +1,377 @@
+"""
+In-process cache of materialized routes keyed by the signature of their
+plans, so that repeated requests skip the search and the geometry queries
+
+The signature of a plan is made of everything deciding its route: the
+snapped source and target vertices, the modes, public transit modes, switch
+types and conditions, constraints and cost factor, plus the description,
+which is the summary of the route. Routes are kept as JSON text, so the
+cached routes can not be modified through those handed out, and the cache
+is bounded by the size of the text. The whole cache is dropped when the
+version of the graph data changes, see graph_data_version() in
+orm_graphmodel.py.
+
+DiskRouteCache is a second tier shared by all the planner processes of a
+host and kept across restarts. It is an SQLite file in WAL mode, so that
+readers never wait for writers, holding the zlib-compressed JSON of the
+routes tagged with the data version they were built from. Routes of
+another data version are never served, and they are swept away together
+with the least recently used routes beyond max_bytes.
+"""
+
+from .cache import LRUCache
+from .datamodel import Constraint
+from .lazy import LazyObject
+from .orm_graphmodel import graph_data_version
+from .settings import ROUTE_CACHE_CONF
+from . import metrics
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_VERSION_CHECK_INTERVAL = 60.0
+DEFAULT_SWEEP_INTERVAL = 60.0
+# Seconds to wait for the lock of the file held by another process
+DEFAULT_DISK_TIMEOUT = 30.0
+# The access time of a disk entry is only updated when it is older than
+# this, so that most hits do not write
+ACCESS_TIME_RESOLUTION = 60.0
+
+
+class _Uncacheable(Exception):
+    pass
+
+
+def _constraint_signature(constraint):
+    if constraint is None:
+        return None
+    if not isinstance(constraint, Constraint):
+        # Raw callbacks of libmmspa4pg can not be compared
+        raise _Uncacheable()
+    return repr(constraint)
+
+
+def plan_signature(plan):
+    """ Return the canonical signature of a plan as a list of plain values,
+        or None if the plan can not be cached
+    """
+    try:
+        return [plan.description,
+                plan.source['properties']['id'],
+                plan.target['properties']['id'],
+                list(plan.mode_list),
+                sorted(plan.public_transit_set),
+                list(plan.switch_type_list),
+                list(plan.switch_condition_list),
+                [_constraint_signature(c)
+                 for c in plan.switch_constraint_list],
+                _constraint_signature(plan.target_constraint),
+                plan.cost_factor]
+    except _Uncacheable:
+        return None
+
+
+def route_key(plan, geometry_options=None):
+    """ Return the key of the route of a plan built with geometry_options,
+        or None if the plan can not be cached
+    """
+    signature = plan_signature(plan)
+    if signature is None:
+        return None
+    text = json.dumps([signature, geometry_options or {}], sort_keys=True)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class DataVersion(object):
+
+    """ Version of the graph data given by a function, e.g.
+    graph_data_version, which is called at most once every interval seconds
+    """
+
+    def __init__(self, version, interval=DEFAULT_VERSION_CHECK_INTERVAL):
+        self._version = version
+        self.interval = interval
+        self._value = None
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock:
+            now = time.time()
+            if self._checked_at is None or \
+                    now - self._checked_at >= self.interval:
+                self._value = self._version()
+                self._checked_at = now
+            return self._value
+
+    def refresh(self):
+        """ Call the function at the next use """
+        with self._lock:
+            self._checked_at = None
+
+
+class RouteCache(object):
+
+    """ LRU cache of JSON values, e.g. the route entries of the planner,
+    bounded by the size of their JSON text
+
+    data_version is a function returning the version of the graph data, see
+    DataVersion. The cache is cleared whenever the version changes. Entries
+    older than ttl seconds are treated as missing if ttl is set. The routes
+    missing in memory are looked up in the DiskRouteCache disk if it is
+    given, and the routes put are written to both.
+    """
+
+    def __init__(self, max_bytes, ttl=None, data_version=None, disk=None):
+        self._routes = LRUCache(max_bytes, ttl, weigher=len)
+        self._data_version = data_version
+        self.disk = disk
+        self.version = None
+        self.invalidations = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._routes)
+
+    def get(self, key):
+        """ Return a fresh copy of the cached value of a key, or None """
+        self.check_data_version()
+        text = self._routes.get(key)
+        if text is not None:
+            return json.loads(text)
+        if self.disk is None:
+            return None
+        route = self.disk.get(key)
+        if route is not None:
+            self._routes.put(key, json.dumps(route))
+        return route
+
+    def put(self, key, route):
+        text = json.dumps(route)
+        self._routes.put(key, text)
+        if self.disk is not None:
+            self.disk.put_text(key, text)
+
+    def clear(self):
+        self._routes.clear()
+
+    def check_data_version(self):
+        """ Clear the cache if the version of the graph data has changed
+            since it was checked last time
+        """
+        if self._data_version is None:
+            return
+        version = self._data_version()
+        with self._lock:
+            if version != self.version:
+                if self.version is not None:
+                    logger.info("Graph data version changed from %s to %s, "
+                                "%s cached routes are dropped",
+                                self.version, version, len(self._routes))
+                    self._routes.clear()
+                    self.invalidations += 1
+                self.version = version
+
+    def stats(self):
+        stats = self._routes.stats()
+        stats['invalidations'] = self.invalidations
+        return stats
+
+
+class DiskRouteCache(object):
+
+    """ Route cache in an SQLite file shared by the processes of a host
+
+    data_version is a function returning the version of the graph data, see
+    DataVersion. Only the entries of the current version are served. The
+    file is swept every sweep_interval seconds by the process putting
+    routes, dropping the entries of other versions, those older than ttl
+    seconds if ttl is set, and the least recently used ones beyond
+    max_bytes of compressed routes. hits and misses are counted by this
+    process.
+    """
+
+    def __init__(self, path, max_bytes, ttl=None, data_version=None,
+                 sweep_interval=DEFAULT_SWEEP_INTERVAL,
+                 timeout=DEFAULT_DISK_TIMEOUT):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._data_version = data_version
+        self.sweep_interval = sweep_interval
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._swept_at = time.time()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        with self._connection() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS routes ("
+                "key TEXT PRIMARY KEY, data_version TEXT NOT NULL, "
+                "payload BLOB NOT NULL, size INTEGER NOT NULL, "
+                "created_at REAL NOT NULL, accessed_at REAL NOT NULL)")
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS routes_accessed_at "
+                "ON routes (accessed_at)")
+
+    def _connection(self):
+        """ Return the connection of the current thread. Connections are
+            never shared with the threads or the processes forked after
+            they were opened.
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=self.timeout)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def _version(self):
+        return '' if self._data_version is None \
+            else str(self._data_version())
+
+    def get(self, key):
+        """ Return the cached value of a key, or None """
+        now = time.time()
+        connection = self._connection()
+        row = connection.execute(
+            "SELECT payload, created_at, accessed_at FROM routes "
+            "WHERE key = ? AND data_version = ?",
+            (key, self._version())).fetchone()
+        if row is None or (self.ttl is not None and now - row[1] > self.ttl):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        if now - row[2] > ACCESS_TIME_RESOLUTION:
+            with connection:
+                connection.execute(
+                    "UPDATE routes SET accessed_at = ? WHERE key = ?",
+                    (now, key))
+        return json.loads(zlib.decompress(bytes(row[0])).decode('utf-8'))
+
+    def put(self, key, route):
+        self.put_text(key, json.dumps(route))
+
+    def put_text(self, key, text):
+        """ Put the JSON text of a value """
+        payload = zlib.compress(text.encode('utf-8'))
+        if len(payload) > self.max_bytes:
+            return
+        now = time.time()
+        connection = self._connection()
+        with connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO routes VALUES (?, ?, ?, ?, ?, ?)",
+                (key, self._version(), sqlite3.Binary(payload),
+                 len(payload), now, now))
+        if now - self._swept_at >= self.sweep_interval:
+            self.sweep()
+
+    def sweep(self):
+        """ Drop the stale entries and the least recently used ones beyond
+            max_bytes. Return the number of entries dropped.
+        """
+        self._swept_at = time.time()
+        connection = self._connection()
+        with connection:
+            dropped = connection.execute(
+                "DELETE FROM routes WHERE data_version != ?",
+                (self._version(),)).rowcount
+            if self.ttl is not None:
+                dropped += connection.execute(
+                    "DELETE FROM routes WHERE created_at < ?",
+                    (self._swept_at - self.ttl,)).rowcount
+            total = 0
+            evicted = []
+            for key, size in connection.execute(
+                    "SELECT key, size FROM routes "
+                    "ORDER BY accessed_at DESC, rowid DESC"):
+                total += size
+                if total > self.max_bytes:
+                    evicted.append((key,))
+            connection.executemany("DELETE FROM routes WHERE key = ?",
+                                   evicted)
+        with self._lock:
+            self.evictions += len(evicted)
+        if dropped or evicted:
+            logger.info("Swept %s stale and %s least recently used routes "
+                        "from %s", dropped, len(evicted), self.path)
+        return dropped + len(evicted)
+
+    def clear(self):
+        connection = self._connection()
+        with connection:
+            connection.execute("DELETE FROM routes")
+
+    def stats(self):
+        entries, size = self._connection().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM routes").fetchone()
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries':    entries,
+                'weight':     size,
+                'max_weight': self.max_bytes,
+                'hits':       self.hits,
+                'misses':     self.misses,
+                'evictions':  self.evictions,
+                'hit_ratio':  float(self.hits) / lookups if lookups else 0.0
+            }
+
+    def close(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None and self._local.pid == os.getpid():
+            connection.close()
+        self._local.connection = None
+
+
+def from_config(conf):
+    """ Create the route cache of a route_cache config section, or return
+        None if the section does not enable it. The disk tier is given by
+        its optional disk section.
+    """
+    max_bytes = int(conf.get('max_bytes', 0))
+    disk_conf = conf.get('disk') or {}
+    if max_bytes <= 0 and 'path' not in disk_conf:
+        return None
+    data_version = DataVersion(
+        graph_data_version,
+        conf.get('version_check_interval', DEFAULT_VERSION_CHECK_INTERVAL))
+    disk = None
+    if 'path' in disk_conf:
+        disk = DiskRouteCache(
+            disk_conf['path'], int(disk_conf['max_bytes']),
+            ttl=disk_conf.get('ttl'), data_version=data_version,
+            sweep_interval=disk_conf.get('sweep_interval',
+                                         DEFAULT_SWEEP_INTERVAL))
+    return RouteCache(max(max_bytes, 0), ttl=conf.get('ttl'),
+                      data_version=data_version, disk=disk)
+
+# Process-wide route cache created at the first use, or None if the config
+# does not enable it
+_ROUTE_CACHE = LazyObject(lambda: from_config(ROUTE_CACHE_CONF))
+
+
+def get_route_cache():
+    return _ROUTE_CACHE.get()
+
+metrics.register_cache(
+    'route', lambda: _ROUTE_CACHE.get().stats()
+    if _ROUTE_CACHE.is_built else None)
+metrics.register_cache(
+    'route_disk', lambda: _ROUTE_CACHE.get().disk.stats()
+    if _ROUTE_CACHE.is_built and _ROUTE_CACHE.get().disk is not None
+    else None)
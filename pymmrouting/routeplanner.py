@@ -5,37 +5,323 @@
 
 from ctypes import CDLL, POINTER, \
     c_double, c_char_p, c_int, c_void_p, c_longlong
-from .routingresult import RoutingResult, RawMultimodalPath, ModePath
-from .orm_graphmodel import Session, Mode, SwitchType
+from .routingresult import RoutingResult, RawMultimodalPath, ModePath, \
+    SegmentGeometryResolver, PUBLIC_TRANSIT_MODES
+from .orm_graphmodel import MODES
 from .settings import PGBOUNCER_CONF, LIB_MMSPA_CONF
+from .lazy import LazyObject
+from .routecache import get_route_cache, route_key
+from . import metrics, queryprofile
 from operator import itemgetter
+from collections import OrderedDict
 import time
 import logging
+import numpy as np
 
 logger = logging.getLogger(__name__)
 
-c_mmspa_lib = CDLL(LIB_MMSPA_CONF["filename"])
-# Read modes and switch_types from database instead of hard coding it here
-MODES = {
-    str(m_name): m_id
-    for m_name, m_id in
-    Session.query(Mode.mode_name, Mode.mode_id)
-}
-SWITCH_TYPES = {
-    str(t_name): t_id
-    for t_name, t_id in
-    Session.query(SwitchType.type_name, SwitchType.type_id)
-}
+# Attributes of RoutingResult and the cost fields of MSPgetFinalCost they
+# are read from
+FINAL_COST_FIELDS = (('length',         'distance'),
+                     ('time',           'duration'),
+                     ('walking_length', 'walking_distance'),
+                     ('walking_time',   'walking_duration'))
+
+POSTGRESQL_DATASOURCES = ("POSTGRESQL", "POSTGRES")
+# Graph snapshots are only searched by pyengine.PythonRoutePlanner
+SNAPSHOT_DATASOURCES = ("SNAPSHOT",)
+
+# Final costs at least this large are taken as unreachable targets
+UNREACHABLE_COST = 1.0e300
+
+# libmmspa4pg is loaded when the first planner is created
+_MMSPA_LIB = LazyObject(lambda: CDLL(LIB_MMSPA_CONF["filename"]))
+
+# Configuration of a routing plan whose assembly has not completed
+_PARTIAL_CONFIGURATION = object()
+
+
+def _c_string(s):
+    """ Encode a string argument of libmmspa4pg, which takes bytes under
+        Python 3
+    """
+    if s is None or isinstance(s, bytes):
+        return s
+    return s.encode('utf-8')
+
+
+def group_plans(plans):
+    """ Group the indices of the plans sharing the source vertex and the
+        configuration, so that one search from the source serves them all
+    """
+    groups = OrderedDict()
+    for i, p in enumerate(plans):
+        key = (p.source['properties']['id'], p.configuration_key)
+        groups.setdefault(key, []).append(i)
+    for (source, _), indices in groups.items():
+        if len(indices) > 1:
+            logger.debug("Plans %s share one search from source %s",
+                         indices, source)
+    logger.debug("%s plans are grouped into %s searches",
+                 len(plans), len(groups))
+    return list(groups.values())
+
+
+def assemble_result(plan, vertex_lists, final_costs, unfold=True):
+    """ Construct a bundle of routing plan and result from the vertex list
+        of every planned mode and the final costs keyed by the attributes
+        of RoutingResult. The result is non-existent if vertex_lists is None.
+        The public transportation paths are split into the paths of the
+        concrete modes unless unfold is False.
+    """
+    result = RoutingResult()
+    result.planned_mode_list = plan.mode_list
+    result.description = plan.description
+    result.planned_switch_type_list = plan.switch_type_list
+    if vertex_lists is None:
+        result.is_existent = False
+        return result
+    result.is_existent = True
+    for m, vertex_ids in zip(plan.mode_list, vertex_lists):
+        logger.info("Constructing path for mode %s", m)
+        mp = ModePath(m, vertex_ids)
+        logger.debug("vertex id list for mode %s: %s", m, mp.vertex_id_list)
+        result.mode_paths.append(mp)
+    if unfold:
+        logger.debug("vertex id list before unfolding: %s",
+                     result.path_by_vertices)
+        result.unfold_sub_paths()
+        logger.debug("vertex id list after unfolding: %s",
+                     result.path_by_vertices)
+    for attr, cost in final_costs.items():
+        setattr(result, attr, cost)
+    return result
+
+
+def resolve_segment_geometries(routing_results):
+    """ Resolve the way points of every path segment in all the routing
+        results at once
+    """
+    resolver = SegmentGeometryResolver()
+    for r in routing_results:
+        resolver.add_result(r)
+    with metrics.stage('resolve_segment_geometries'):
+        return resolver.resolve()
+
+
+def materialize_route(plan, routing_result, segment_geometries=None,
+                      geometry_options=None):
+    """ Build the route dict of the routing result of a plan.
+        geometry_options are keyword arguments of RoutingResult.to_dict,
+        e.g. {'geometry_encoding': 'polyline'}.
+    """
+    with metrics.stage('to_dict', plan.description), \
+            queryprofile.debug_scope(routing_result.query_profile,
+                                     plan.description) as profile:
+        route = routing_result.to_dict(segment_geometries,
+                                       **(geometry_options or {}))
+    if profile is not None:
+        routing_result.query_profile = profile
+        route['query_profile'] = profile.to_dict()
+        if profile.suspected_n_plus_one():
+            logger.warning("Repeated queries in %s", profile.report())
+    return route
+
+
+def count_routes(plans, routing_results):
+    """ Count the routing results found for the plans by existence, before
+        any of them is pruned
+    """
+    for p, r in zip(plans, routing_results):
+        metrics.count_route(p.description, r.is_existent)
+
+
+def materialize_results(plans, routing_results, geometry_options=None):
+    """ Build the result dict of the routing results of all the plans """
+    count_routes(plans, routing_results)
+    return results_document(
+        plans, materialize_routes(plans, routing_results, geometry_options))
+
+
+def materialize_routes(plans, routing_results, geometry_options=None):
+    """ Build the route dicts of the routing results of all the plans, and
+        None for the results pruned by prune_results. The way points of
+        every path segment in all the results are resolved at once before
+        any GeoJSON is built.
+    """
+    segment_geometries = resolve_segment_geometries(
+        [r for r in routing_results if r is not None])
+    return [None if r is None else
+            materialize_route(p, r, segment_geometries, geometry_options)
+            for p, r in zip(plans, routing_results)]
+
+
+def results_document(plans, routes):
+    """ Build the result dict of the route dicts of all the plans. The
+        routes pruned by find_routes, i.e. None, are left out.
+    """
+    result_dict = {"routes": []}
+    for p, route in zip(plans, routes):
+        if route is not None:
+            result_dict["routes"].append(route)
+        del p.source['properties']['id']
+        del p.target['properties']['id']
+        result_dict['source'] = p.source
+        result_dict['target'] = p.target
+    return result_dict
+
+
+@metrics.timed('refine_results')
+def refine_results(results, plans):
+    """ Drop the non-existent routes and those claiming to use public transit
+        without any public transit leg, then sort the rest by duration
+    """
+    refined_results = [r for i, r in enumerate(results['routes'])
+                       if is_refined_route(r, plans[i])]
+    refined_results.sort(key=itemgetter('duration'))
+    results['routes'] = refined_results
+    return results
+
+
+def is_refined_route(route, plan):
+    """ Tell whether a route dict is kept by refine_results """
+    if route['existence'] is False:
+        return False
+    if MODES['public_transportation'] in plan.mode_list:
+        # Claim using public transit
+        real_modes = [f['properties']['mode']
+                      for f in route['geojson']['features']
+                      if f['properties']['type'] == 'path']
+        pt_modes = ['suburban', 'underground', 'tram', 'bus']
+        # Eliminate the result claiming using public transit but
+        # actually does not
+        if (set(real_modes).isdisjoint(set(pt_modes))):
+            # It claims using public transit but no public transit
+            # station is found in the result path. Such a path will
+            # be eliminated.
+            return False
+    return True
+
+
+def is_refined_result(routing_result, plan):
+    """ Tell whether the route of a routing result would be kept by
+        refine_results, from its mode paths alone
+    """
+    if routing_result.is_existent is False:
+        return False
+    if MODES['public_transportation'] in plan.mode_list:
+        real_modes = set(mp.mode for mp in routing_result.mode_paths)
+        if real_modes.isdisjoint(PUBLIC_TRANSIT_MODES.values()):
+            return False
+    return True
+
+
+def prune_result(routing_result, plan, seen):
+    """ Tell whether refine_results would drop the route of a routing
+        result, deciding from its mode paths before any geometry is built.
+        Return (pruned, fingerprint of the path), the fingerprint being None
+        for the routes dropped on their own, i.e. non-existent or not using
+        the public transit they claim. The fingerprints of the routes kept
+        are added to seen, so that the later routes taking the same path
+        are dropped as duplicates.
+    """
+    if not is_refined_result(routing_result, plan):
+        return True, None
+    path = routing_result.path_fingerprint()
+    if path in seen:
+        return True, path
+    seen.add(path)
+    return False, path
+
+
+def prune_results(plans, routing_results, seen=None):
+    """ Return the routing results of the plans, with None for those whose
+        routes would be dropped by refine_results, see prune_result
+    """
+    seen = set() if seen is None else seen
+    count_routes(plans, routing_results)
+    return [None if prune_result(r, p, seen)[0] else r
+            for p, r in zip(plans, routing_results)]
+
+
+def _cached_existence(entry):
+    """ Tell whether the route of a route cache entry of the planner exists
+    """
+    if entry['route'] is not None:
+        return entry['route']['existence']
+    # Entries of pruned routes cached before their existence was kept
+    return entry.get('existent', entry['path'] is not None)
+
+
+def stream_routes(grouped_results, sort_by_duration=False,
+                  geometry_options=None):
+    """ Materialize and refine the routing results of groups of plans one
+        group at a time, and yield the route dicts kept by refine_results.
+
+        grouped_results is an iterable of (plans, routing_results). Routes
+        come in the order of the groups unless sort_by_duration is True,
+        which buffers all of them to sort them as refine_results does.
+    """
+    return refine_stream(_materialize_groups(grouped_results,
+                                             geometry_options),
+                         sort_by_duration)
+
+
+def refine_stream(plan_routes, sort_by_duration=False):
+    """ Yield the route dicts of an iterable of (plan, route) kept by
+        refine_results, sorted by duration if sort_by_duration is True
+    """
+    routes = (r for p, r in plan_routes if is_refined_route(r, p))
+    if sort_by_duration:
+        return iter(sorted(routes, key=itemgetter('duration')))
+    return routes
+
+
+def _materialize_groups(grouped_results, geometry_options):
+    # Routes repeating the path of a route of an earlier group are pruned
+    seen = set()
+    for plans, routing_results in grouped_results:
+        routing_results = prune_results(plans, routing_results, seen)
+        for p, route in zip(plans, materialize_routes(
+                plans, routing_results, geometry_options)):
+            if route is not None:
+                yield p, route
 
 
 class MultimodalRoutePlanner(object):
 
     """ Multimodal optimal path planner """
 
-    def __init__(self, datasource_type='POSTGRESQL'):
+    # RouteCache in front of find_routes, see routecache.py. Planners on
+    # libmmspa4pg take the process-wide one of the config.
+    route_cache = None
+    # Whether the routing plan assembled in libmmspa4pg is kept after a
+    # search for the next plan of the same configuration, instead of being
+    # cleared, see __init__
+    reuse_routing_plan = False
+    # configuration_key of the routing plan assembled in libmmspa4pg
+    assembled_configuration = None
+    # Whether the graphs of the assembled routing plan are assembled too
+    graphs_assembled = False
+    routing_plan_builds = 0
+    routing_plan_reuses = 0
+
+    def __init__(self, datasource_type='POSTGRESQL', datasource_url=None,
+                 reuse_routing_plan=None):
+        """ datasource_type is POSTGRESQL, or PLAIN_TEXT for the graph file
+            given by datasource_url. Graph snapshots are searched by
+            pyengine.PythonRoutePlanner instead.
+
+            reuse_routing_plan keeps the assembled routing plan and its
+            graphs for the next search of the same configuration, which is
+            then run with MSPtwoq on the graphs assembled already. It
+            defaults to the reuse_routing_plan key of the mmspa config
+            section, or true.
+        """
         # For strict type checking, the arguments and returning types are
         # explictly listed here
 
+        c_mmspa_lib = _MMSPA_LIB.get()
         # v2 of mmspa library API
 
         # Function of initializing the library,preparing and caching mode
@@ -100,13 +386,20 @@ class MultimodalRoutePlanner(object):
         self.msp_clearroutingplan = c_mmspa_lib.MSPclearRoutingPlan
         # extern void MSPfinalize();
         self.msp_finalize = c_mmspa_lib.MSPfinalize
-        pg_conn_str = \
-            "host = '" + PGBOUNCER_CONF['host'] + "' " + \
-            "user = '" + PGBOUNCER_CONF['username'] + "' " + \
-            "port = '" + PGBOUNCER_CONF['port'] + "' " + \
-            "dbname = '" + PGBOUNCER_CONF['database'] + "'"
-        self.open_datasource(datasource_type, pg_conn_str)
-        self.graph_file = None
+        self._constraint_checkers = []
+        self.graph_snapshot = None
+        self.route_cache = get_route_cache()
+        self.reuse_routing_plan = bool(
+            LIB_MMSPA_CONF.get('reuse_routing_plan', True)
+            if reuse_routing_plan is None else reuse_routing_plan)
+        if datasource_url is None and \
+                datasource_type.upper() in POSTGRESQL_DATASOURCES:
+            datasource_url = \
+                "host = '" + PGBOUNCER_CONF['host'] + "' " + \
+                "user = '" + PGBOUNCER_CONF['username'] + "' " + \
+                "port = '" + PGBOUNCER_CONF['port'] + "' " + \
+                "dbname = '" + PGBOUNCER_CONF['database'] + "'"
+        self.open_datasource(datasource_type, datasource_url)
 
     def __enter__(self):
         return self
@@ -116,22 +409,99 @@ class MultimodalRoutePlanner(object):
 
     def open_datasource(self, ds_type, ds_url):
         self.data_source_type = ds_type.upper()
-        if ds_type.upper() in ["POSTGRESQL", "POSTGRES"]:
-            ret_code = self.msp_init(ds_url)
+        if ds_type.upper() in POSTGRESQL_DATASOURCES:
+            ret_code = self.msp_init(_c_string(ds_url))
             if ret_code != 0:
                 raise Exception(
                     "[FATAL] Open datasource and caching mode graphs failed")
         elif ds_type.upper() == "PLAIN_TEXT":
             self.graph_file = open(ds_url)
             # FIXME: here should return a status code
+        elif ds_type.upper() in SNAPSHOT_DATASOURCES:
+            raise ValueError(
+                "libmmspa4pg can not search graph snapshots, open %s with "
+                "pyengine.PythonRoutePlanner instead" % ds_url)
+        else:
+            raise ValueError("Unknown datasource type: %s" % ds_type)
 
     def cleanup(self):
-        if self.data_source_type in ["POSTGRESQL", "POSTGRES"]:
+        if self.data_source_type in POSTGRESQL_DATASOURCES:
+            self.release_routingplan()
             self.msp_finalize()
         elif self.data_source_type == "PLAIN_TEXT":
             self.graph_file.close()
 
+    def _check_native_datasource(self):
+        if self.graph_snapshot is not None:
+            raise NotImplementedError(
+                "libmmspa4pg only searches graphs loaded from PostgreSQL")
+
+    def _to_checker(self, constraint):
+        """ Turn a constraint of a plan into the callback of libmmspa4pg.
+            The callbacks are kept alive until another routing plan is
+            assembled.
+        """
+        if constraint is None or not hasattr(constraint, 'to_checker'):
+            return constraint
+        checker = constraint.to_checker()
+        self._constraint_checkers.append(checker)
+        return checker
+
     def prepare_routingplan(self, plan):
+        """ Assemble the routing plan of a plan in libmmspa4pg. The plan
+            assembled for the previous search is reused if it was kept by
+            end_search and its configuration is the same, i.e. only the
+            source or target differ.
+        """
+        self._check_native_datasource()
+        configuration = plan.configuration_key
+        if configuration == self.assembled_configuration:
+            logger.debug("Reuse the assembled routing plan")
+            self.routing_plan_reuses += 1
+            metrics.count_routing_plan(reused=True)
+            return
+        self.release_routingplan()
+        self.assembled_configuration = _PARTIAL_CONFIGURATION
+        with metrics.native_call('prepare_routingplan'):
+            self._prepare_routingplan(plan)
+        self.assembled_configuration = configuration
+        self.routing_plan_builds += 1
+        metrics.count_routing_plan(reused=False)
+
+    def release_routingplan(self):
+        """ Clear the graphs and the routing plan assembled in libmmspa4pg,
+            if any
+        """
+        if self.assembled_configuration is None:
+            return
+        self.assembled_configuration = None
+        self.graphs_assembled = False
+        with metrics.native_call('MSPclearGraphs'):
+            self.msp_cleargraphs()
+        self.msp_clearroutingplan()
+
+    def end_search(self):
+        """ Release the routing plan after a search, unless it is kept for
+            the next one
+        """
+        if not self.reuse_routing_plan:
+            self.release_routingplan()
+
+    def assemble_graphs(self):
+        """ Assemble the graphs of the prepared routing plan, which MSPtwoq
+            needs unlike MSPfindPath
+        """
+        if self.graphs_assembled:
+            return
+        logger.info("Start parsing multimodal networks...")
+        with metrics.native_call('MSPassembleGraphs'):
+            ret_code = self.msp_assemblegraphs()
+        if ret_code != 0:
+            raise Exception("Assembling multimodal networks failed!")
+        self.graphs_assembled = True
+
+    def _prepare_routingplan(self, plan):
+        self._constraint_checkers = []
         logger.info("Create a routing plan. ")
         self.msp_createroutingplan(
             len(plan.mode_list), len(plan.public_transit_set))
@@ -148,8 +518,10 @@ class MultimodalRoutePlanner(object):
         if len(plan.mode_list) > 1:
             logger.info("Set the switch conditions and constraints... ")
             for i in range(len(plan.mode_list) - 1):
-                self.msp_setswitchcondition(i, plan.switch_condition_list[i])
-                self.msp_setswitchconstraint(i, plan.switch_constraint_list[i])
+                self.msp_setswitchcondition(
+                    i, _c_string(plan.switch_condition_list[i]))
+                self.msp_setswitchconstraint(
+                    i, self._to_checker(plan.switch_constraint_list[i]))
 
         # set public transit modes if there are
         if plan.has_public_transit:
@@ -160,48 +532,299 @@ class MultimodalRoutePlanner(object):
 
         logger.info("Set the target constraints if there is... ")
         logger.debug("Target constraints are: %s", plan.target_constraint)
-        self.msp_settargetconstraint(plan.target_constraint)
+        self.msp_settargetconstraint(self._to_checker(plan.target_constraint))
         logger.info("Set the const factor ... ")
         logger.debug("Cost factor is: %s", plan.cost_factor)
-        self.msp_setcostfactor(plan.cost_factor)
+        self.msp_setcostfactor(_c_string(plan.cost_factor))
 
-        # logger.info("Start parsing multimodal networks...")
-        # if self.msp_assemblegraphs() != 0:
-            # raise Exception("Assembling multimodal networks failed!")
+    @metrics.timed('batch_find_path')
+    def batch_find_path(self, plans, geometry_options=None):
+        """ Find, refine and materialize the routes of the plans. Only the
+            routes kept by refine_results are materialized.
+            geometry_options are passed to RoutingResult.to_dict, e.g.
+            {'geometry_encoding': 'polyline'}.
+        """
+        routes = self.find_routes(plans, geometry_options, refine=True)
+        result_dict = results_document(plans, routes)
+        return self._refine_results(
+            result_dict, [p for p, r in zip(plans, routes) if r is not None])
 
-    def batch_find_path(self, plans):
-        result_dict = {"routes": []}
-        for p in plans:
-            result = self.find_path(p)
-            result_dict["routes"] += result["routes"]
-            result_dict['source'] = result['source']
-            result_dict['target'] = result['target']
-        return self._refine_results(result_dict, plans)
+    def iter_find_path(self, plans, sort_by_duration=False,
+                       geometry_options=None):
+        """ Same as batch_find_path, but yield every route as soon as it
+            is found and materialized, see stream_routes. The source and
+            target of the results are given by endpoint_features() in
+            resultwriter.py.
+        """
+        return refine_stream(
+            ((plans[i], route) for i, route in self._iter_routes(
+                plans, geometry_options, refine=True, stream=True)),
+            sort_by_duration)
 
     def _refine_results(self, results, plans):
-        refined_results = []
-        for i, r in enumerate(results['routes']):
-            if r['existence'] is False:
+        return refine_results(results, plans)
+
+    def find_path(self, plan, geometry_options=None):
+        return results_document(
+            [plan], self.find_routes([plan], geometry_options))
+
+    def _active_route_cache(self):
+        # Cached routes would hide the queries being profiled
+        if queryprofile.is_debug():
+            return None
+        return self.route_cache
+
+    def _route_keys(self, cache, plans, geometry_options):
+        if cache is None:
+            return [None] * len(plans)
+        return [route_key(p, geometry_options) for p in plans]
+
+    def find_routes(self, plans, geometry_options=None, refine=False):
+        """ Return the route dicts of the plans in their order. The routes
+            found in the route cache skip prepare_routingplan, the search
+            and the geometry queries, and the others are cached once they
+            are materialized.
+
+            If refine is True, the routes refine_results would drop are
+            None. They are decided before any geometry is built, from the
+            mode paths of the routing results, and so are the routes taking
+            the same path as another route of the plans.
+        """
+        routes = [None] * len(plans)
+        for i, route in self._iter_routes(plans, geometry_options, refine):
+            routes[i] = route
+        return routes
+
+    def _iter_routes(self, plans, geometry_options=None, refine=False,
+                     stream=False):
+        """ Yield (index of the plan, route dict) of the plans in their
+            order, or one group of plans at a time in the order of
+            group_plans if stream is True. The plans missing in the route
+            cache are searched all at once, or group by group.
+
+            The cache entries are dicts of the route and the fingerprint of
+            its path. The route of a plan pruned by refine is None, and so
+            is its fingerprint unless it was pruned as a duplicate, and the
+            entry tells whether the route exists. Every plan is counted by
+            metrics.count_route, whether it is searched or cached. Whether
+            a route is kept is decided in the same order with or without the
+            cache, so the cache never changes the routes returned.
+        """
+        cache = self._active_route_cache()
+        keys = self._route_keys(cache, plans, geometry_options)
+        entries = [None if k is None else cache.get(k) for k in keys]
+        groups = group_plans(plans) if stream else [list(range(len(plans)))]
+        seen = set()
+        for group in groups:
+            for i, route in self._iter_group_routes(
+                    cache, plans, group, keys, entries, seen,
+                    geometry_options, refine):
+                yield i, route
+
+    def _iter_group_routes(self, cache, plans, group, keys, entries, seen,
+                           geometry_options, refine):
+        # Paths taken by the routes kept before each plan of the group, as
+        # far as they are known without a search
+        known_paths = set(seen)
+        searches = []
+        for i in group:
+            e = entries[i]
+            if e is not None and e['route'] is not None:
+                if not refine or is_refined_route(e['route'], plans[i]):
+                    known_paths.add(e['path'])
+            elif e is None or not refine or \
+                    (e['path'] is not None and e['path'] not in known_paths):
+                # Not cached, or pruned as a duplicate of a route which may
+                # not be kept this time
+                searches.append(i)
+        found = dict(zip(searches, self.find_routing_results(
+            [plans[i] for i in searches]))) if searches else {}
+        for i in group:
+            if i in found:
+                metrics.count_route(plans[i].description,
+                                    found[i].is_existent)
+            else:
+                metrics.count_route(plans[i].description,
+                                    _cached_existence(entries[i]))
+        # (index, routing result or cached route dict, path, cached)
+        kept = []
+        for i in group:
+            e = entries[i]
+            if i in found:
+                r = found[i]
+                if refine:
+                    pruned, path = prune_result(r, plans[i], seen)
+                else:
+                    pruned = False
+                    path = r.path_fingerprint() if r.is_existent else None
+                if not pruned:
+                    kept.append((i, r, path, False))
+                elif keys[i] is not None:
+                    cache.put(keys[i], {'path': path, 'route': None,
+                                        'existent': bool(r.is_existent)})
+            elif e['route'] is not None:
+                if refine:
+                    if not is_refined_route(e['route'], plans[i]) or \
+                            e['path'] in seen:
+                        continue
+                    seen.add(e['path'])
+                kept.append((i, e['route'], e['path'], True))
+        segment_geometries = resolve_segment_geometries(
+            [r for _, r, _, cached in kept if not cached])
+        for i, r, path, cached in kept:
+            if cached:
+                yield i, r
                 continue
-            if MODES['public_transportation'] in plans[i].mode_list:
-                # Claim using public transit
-                real_modes = [f['properties']['mode']
-                              for f in r['geojson']['features']
-                              if f['properties']['type'] == 'path']
-                pt_modes = ['suburban', 'underground', 'tram', 'bus']
-                # Eliminate the result claiming using public transit but
-                # actually does not
-                if (set(real_modes).isdisjoint(set(pt_modes))):
-                    # It claims using public transit but no public transit
-                    # station is found in the result path. Such a path will
-                    # be eliminated.
-                    continue
-            refined_results.append(r)
-        refined_results.sort(key=itemgetter('duration'))
-        results['routes'] = refined_results
-        return results
-
-    def find_path(self, plan):
+            route = materialize_route(plans[i], r, segment_geometries,
+                                      geometry_options)
+            if keys[i] is not None:
+                cache.put(keys[i], {'path': path, 'route': route})
+            yield i, route
+
+    def find_routing_results(self, plans):
+        """ Find the paths of the plans without building any geometry. The
+            plans differing only in target share one search.
+        """
+        routing_results = [None] * len(plans)
+        for group in group_plans(plans):
+            with metrics.stage('find_routing_result',
+                               plans[group[0]].description), \
+                    queryprofile.debug_scope(
+                        name=plans[group[0]].description) as profile:
+                if len(group) == 1:
+                    group_results = [self.find_routing_result(
+                        plans[group[0]])]
+                else:
+                    group_results = self._find_routing_results_from_source(
+                        [plans[i] for i in group])
+            for i, r in zip(group, group_results):
+                if profile is not None:
+                    # Plans sharing one search share its queries
+                    r.query_profile = profile.copy(plans[i].description)
+                routing_results[i] = r
+        return routing_results
+
+    def _find_routing_results_from_source(self, plans):
+        """ Search once from the common source of the plans, then fetch the
+            path to the target of every plan
+        """
+        self.prepare_routingplan(plans[0])
+        routing_results = self._search_from_source(plans)
+        self.end_search()
+        return routing_results
+
+    def _search_from_source(self, plans):
+        """ Search with MSPtwoq from the common source of the plans on the
+            prepared routing plan, assembling its graphs if they are not yet
+        """
+        source = c_longlong(plans[0].source['properties']['id'])
+        logger.info("Calculating multimodal paths from %s to %s targets ... ",
+                    source.value, len(plans))
+        t1 = time.time()
+        self.assemble_graphs()
+        with metrics.native_call('MSPtwoq'):
+            self.msp_twoq(source)
+        t2 = time.time()
+        logger.info("Finish calculating multimodal paths, time consumed: %s seconds", (t2 - t1))
+        routing_results = []
+        for p in plans:
+            with metrics.native_call('MSPgetFinalPath'):
+                final_path = self.msp_getfinalpath(
+                    source, c_longlong(p.target['properties']['id']))
+            with metrics.stage('construct_result', p.description):
+                routing_result = self._construct_result(p, final_path)
+            if routing_result.is_existent is True:
+                self.msp_clearpaths(final_path)
+            routing_results.append(routing_result)
+        return routing_results
+
+    def cost_matrix(self, origins, destinations, plan_template,
+                    inferer=None, progress=None):
+        """ Calculate the final costs from every origin to every destination
+            with the modes of plan_template, without building any path or
+            geometry.
+
+            origins and destinations are lists of (lon, lat). The source and
+            target of plan_template are ignored. The result is a dict of
+            dense numpy arrays of shape (len(origins), len(destinations))
+            keyed by the cost fields, i.e. distance, duration,
+            walking_distance and walking_duration. Unreachable pairs are
+            NaN. progress is called with the number of origins done and
+            the number of origins after each one.
+        """
+        # Avoid importing inferenceengine at module level
+        from .inferenceengine import RoutingPlanInferer
+        inferer = RoutingPlanInferer() if inferer is None else inferer
+        points = inferer.snap_locations(
+            [{'lon': x, 'lat': y} for x, y in list(origins) + list(destinations)])
+        candidates = inferer.find_candidate_vertices_of_points(
+            set(p['point_id'] for p in points))
+        source_mode = self._endpoint_mode(plan_template.mode_list[0])
+        target_mode = self._endpoint_mode(plan_template.mode_list[-1])
+        sources = [candidates[p['point_id']].get(source_mode)
+                   for p in points[:len(origins)]]
+        targets = [candidates[p['point_id']].get(target_mode)
+                   for p in points[len(origins):]]
+        reachable = [j for j, t in enumerate(targets) if t is not None]
+        shape = (len(sources), len(targets))
+        matrix = dict((field, np.full(shape, np.nan))
+                      for _, field in FINAL_COST_FIELDS)
+        t1 = time.time()
+        try:
+            # One routing plan and its graphs serve the searches of all
+            # the origins
+            self._prepare_searches(plan_template)
+            for i, source in enumerate(sources):
+                if source is not None and reachable:
+                    costs = self._final_costs_from_source(
+                        plan_template, source,
+                        [targets[j] for j in reachable])
+                    for _, field in FINAL_COST_FIELDS:
+                        matrix[field][i, reachable] = costs[field]
+                if progress is not None:
+                    progress(i + 1, len(sources))
+                if (i + 1) % 100 == 0:
+                    logger.info(
+                        "Cost matrix: %s of %s origins done in %s seconds",
+                        i + 1, len(sources), time.time() - t1)
+        finally:
+            self.end_search()
+        return matrix
+
+    def _prepare_searches(self, plan):
+        """ Prepare the routing plan of a plan and assemble its graphs for
+            the searches of _final_costs_from_source
+        """
+        self.prepare_routingplan(plan)
+        self.assemble_graphs()
+
+    def _final_costs_from_source(self, plan, source, targets):
+        """ Search from a source vertex with the modes of a plan prepared by
+            _prepare_searches, and return a dict of the arrays of final
+            costs of the target vertices keyed by the cost fields.
+            Unreachable targets are NaN.
+        """
+        with metrics.native_call('MSPtwoq'):
+            self.msp_twoq(c_longlong(source))
+        costs = dict((field, np.empty(len(targets)))
+                     for _, field in FINAL_COST_FIELDS)
+        for j, target in enumerate(targets):
+            target = c_longlong(target)
+            for _, field in FINAL_COST_FIELDS:
+                costs[field][j] = self.msp_getfinalcost(target,
+                                                        _c_string(field))
+        for array in costs.values():
+            array[~((array >= 0.0) & (array < UNREACHABLE_COST))] = np.nan
+        return costs
+
+    def _endpoint_mode(self, mode):
+        # Paths of public transportation start and end on foot
+        return MODES['foot'] if mode == MODES['public_transportation'] \
+            else mode
+
+    def find_routing_result(self, plan):
+        """ Find the path of a plan without building any geometry of it
+        """
         logger.info("Start path finding...")
         logger.debug("source: %s", str(plan.source))
         logger.debug("target: %s", str(plan.target))
@@ -211,63 +834,55 @@ class MultimodalRoutePlanner(object):
         # t2 = time.time()
         # logger.info("done!")
         # logger.info("Finish assembling multimodal networks, time consumed: %s seconds", (t2 - t1))
+        if self.graphs_assembled:
+            # The graphs of the kept routing plan are assembled already,
+            # and MSPfindPath would assemble them again
+            routing_result = self._search_from_source([plan])[0]
+        else:
+            routing_result = self._find_path(plan)
+        self.end_search()
+        return routing_result
+
+    def _find_path(self, plan):
+        """ Search with MSPfindPath, which assembles the graphs of the
+            prepared routing plan itself
+        """
         logger.info("Calculating multimodal paths ... ")
         t1 = time.time()
         # self.msp_twoq(c_longlong(plan.source['properties']['id']))
-        final_path = self.msp_findpath(c_longlong(plan.source['properties']['id']),
-                                       c_longlong(plan.target['properties']['id']))
+        with metrics.native_call('MSPfindPath'):
+            final_path = self.msp_findpath(
+                c_longlong(plan.source['properties']['id']),
+                c_longlong(plan.target['properties']['id']))
+        # MSPfindPath assembles the graphs itself
+        self.graphs_assembled = True
         t2 = time.time()
         logger.info("Finish calculating multimodal paths, time consumed: %s seconds", (t2 - t1))
-        routing_result = self._construct_result(plan, final_path)
+        with metrics.stage('construct_result', plan.description):
+            routing_result = self._construct_result(plan, final_path)
         if routing_result.is_existent is True:
             self.msp_clearpaths(final_path)
-        self.msp_cleargraphs()
-        self.msp_clearroutingplan()
-        del plan.source['properties']['id']
-        del plan.target['properties']['id']
-        return {
-            "routes": [routing_result.to_dict()],
-            "source": plan.source,
-            "target": plan.target
-        }
+        return routing_result
 
     def _construct_result(self, plan, final_path):
         """ Construct a bundle of routing plan and result
         """
-        result = RoutingResult()
-        result.planned_mode_list = plan.mode_list
-        result.description = plan.description
-        result.planned_switch_type_list = plan.switch_type_list
+        return assemble_result(plan, *self._read_final_path(plan, final_path))
+
+    def _read_final_path(self, plan, final_path):
+        """ Copy the vertex list of every planned mode and the final costs
+            out of a native path, or return (None, None) if there is no path
+        """
         try:
             path_probe = final_path[0]
         except ValueError:
-            result.is_existent = False
-        else:
-            result.is_existent = True
-            m_index = 0
-            for m in plan.mode_list:
-                logger.info("Constructing path for mode %s", m)
-                mp = ModePath(m)
-                logger.debug("Mode path vertex id list before construction: %s",
-                             mp.vertex_id_list)
-                for i in range(final_path[m_index].path_segments[0].vertex_list_length):
-                    v = final_path[m_index].path_segments[0].vertex_list[i]
-                    mp.vertex_id_list.append(v)
-                m_index += 1
-                logger.debug("vertex id list for mode %s: %s",
-                             m, mp.vertex_id_list)
-                result.mode_paths.append(mp)
-            logger.debug("vertex id list before unfolding: %s",
-                         result.path_by_vertices)
-            result.unfold_sub_paths()
-            logger.debug("vertex id list after unfolding: %s",
-                         result.path_by_vertices)
-            result.length = self.msp_getfinalcost(
-                c_longlong(plan.target['properties']['id']), 'distance')
-            result.time = self.msp_getfinalcost(
-                c_longlong(plan.target['properties']['id']), 'duration')
-            result.walking_length = self.msp_getfinalcost(
-                c_longlong(plan.target['properties']['id']), 'walking_distance')
-            result.walking_time = self.msp_getfinalcost(
-                c_longlong(plan.target['properties']['id']), 'walking_duration')
-        return result
+            return None, None
+        return ([final_path[m_index].path_segments[0].vertex_ids()
+                 for m_index in range(len(plan.mode_list))],
+                self._read_final_costs(plan.target['properties']['id']))
+
+    def _read_final_costs(self, target_id):
+        """ Read all the final cost fields of the target in one pass """
+        target = c_longlong(target_id)
+        return dict((attr, self.msp_getfinalcost(target, _c_string(field)))
+                    for attr, field in FINAL_COST_FIELDS)
@@ -1,41 +1,40 @@
 """ RoutingResult class is a part of pymmrouting module """
 
 from ctypes import POINTER, Structure, c_longlong, c_int
-from itertools import tee, izip
+from itertools import tee
+try:
+    from itertools import izip
+except ImportError:  # Python 3
+    izip = zip
 from geoalchemy2.functions import ST_AsGeoJSON as st_asgeojson
-from .orm_graphmodel import Mode, Session, Vertex, Edge, StreetLine, \
+from sqlalchemy import tuple_, or_
+from .orm_graphmodel import Session, Edge, StreetLine, \
     CarParking, StreetJunction, ParkAndRide, UndergroundPlatform, \
-    SuburbanStation, TramStation, get_waypoints, SwitchPoint, SwitchType
+    SuburbanStation, TramStation, get_waypoints, SwitchPoint, \
+    UndergroundLine, SuburbanLine, TramLine, parse_waypoints, \
+    prepare_mappings, MODES, INV_MODES, SWITCH_TYPES
+from .cache import LRUCache
+from .lazy import LazyObject, LazyMapping
+from .graphindex import get_vertex_mode_index, get_edge_index
+from .settings import SEGMENT_CACHE_CONF
+from . import metrics
+from .encoding import encode_geometry, GEOJSON
+from .simplify import simplify_line, DOUGLAS_PEUCKER
 from os import path
+import copy
+import hashlib
 import json
 import logging
+import numpy as np
 
 logger = logging.getLogger(__name__)
 
-MODES = {
-    str(m_name): m_id
-    for m_name, m_id in
-    Session.query(Mode.mode_name, Mode.mode_id)
-}
-
-INV_MODES = {
-    m_id: str(m_name)
-    for m_name, m_id in
-    Session.query(Mode.mode_name, Mode.mode_id)
-}
-
-PUBLIC_TRANSIT_MODES = {
+PUBLIC_TRANSIT_MODES = LazyMapping(lambda: {
     'underground': MODES['underground'],
     'suburban':    MODES['suburban'],
     'tram':        MODES['tram'],
     'bus':         MODES['bus']
-}
-
-SWITCH_TYPES = {
-    t_name: t_id
-    for t_name, t_id in
-    Session.query(SwitchType.type_name, SwitchType.type_id)
-}
+}, derived_from=[MODES])
 
 DEFAULT_MODE_COLORS = {
     'private_car': '#26314c',
@@ -75,11 +74,59 @@ SWITCH_SYMBOL_COLOR = {
 # TODO: This mapping should not be place here in the source code. It should be
 # somewhere else in the persistant container like database
 TMP_DIR = "tmp/"
+# Upper bound of (from, to) pairs put into a single IN clause when resolving
+# segment geometries in bulk
+BULK_QUERY_CHUNK_SIZE = 5000
+# Rough size in bytes of a cached coordinate, i.e. a tuple of two floats
+COORDINATE_BYTES = 112
+DEFAULT_SEGMENT_CACHE_SIZE = 2000000
+
+
+def _create_segment_cache(conf):
+    if 'max_bytes' in conf:
+        max_coordinates = int(conf['max_bytes']) // COORDINATE_BYTES
+    else:
+        max_coordinates = int(conf.get('max_coordinates',
+                                       DEFAULT_SEGMENT_CACHE_SIZE))
+    return LRUCache(max_coordinates, ttl=conf.get('ttl'), weigher=len)
+
+# Process-wide cache of segment way points keyed by (mode, from_vertex_id,
+# to_vertex_id) and bounded by the total number of coordinates. The values
+# are tuples of coordinate tuples, so they can not be modified through the
+# lists handed out to the callers. It is created at the first use.
+_SEGMENT_GEOMETRY_CACHE = LazyObject(
+    lambda: _create_segment_cache(SEGMENT_CACHE_CONF))
+
+
+def get_segment_cache():
+    return _SEGMENT_GEOMETRY_CACHE.get()
+
+metrics.register_cache(
+    'segment_geometry', lambda: get_segment_cache().stats()
+    if _SEGMENT_GEOMETRY_CACHE.is_built else None)
+
+
+def _freeze_way_points(way_points):
+    return tuple(tuple(p) for p in way_points)
+
+
+def _thaw_way_points(way_points):
+    return [list(p) for p in way_points]
+
 
 class RawPath(Structure):
     _fields_ = [("vertex_list", POINTER(c_longlong)),
                 ("vertex_list_length", c_int)]
 
+    def vertex_ids(self):
+        """ Copy the native vertex list in one operation. It must be called
+            before the path is released with MSPclearPaths
+        """
+        if self.vertex_list_length <= 0:
+            return []
+        return np.ctypeslib.as_array(
+            self.vertex_list, shape=(self.vertex_list_length,)).tolist()
+
 class RawMultimodalPath(Structure):
     _fields_ = [("path_segments", POINTER(RawPath))]
 
@@ -112,19 +159,26 @@ class ModePath(object):
 
     @property
     def edge_id_list(self):
-        for i, j in self._pairwise(self.vertex_id_list):
-            self._edge_id_list.append(Session.query(Edge.edge_id).filter(
-                Edge.from_id == i, Edge.to_id == j).first().edge_id)
+        self._edge_id_list = get_edge_index().edge_ids_of_path(
+            self.vertex_id_list)
         return self._edge_id_list
 
     @property
     def link_id_list(self):
-        for i, j in self._pairwise(self.vertex_id_list):
-            self._link_id_list.append(Session.query(Edge.link_id).filter(
-                Edge.from_id == i, Edge.to_id == j).first().link_id)
+        self._link_id_list = get_edge_index().link_ids_of_path(
+            self.vertex_id_list)
         return self._link_id_list
 
     def _get_way_points_between_vertices(self, u, v):
+        key = (self.mode, u, v)
+        way_points = get_segment_cache().get(key)
+        if way_points is None:
+            way_points = _freeze_way_points(
+                self._query_way_points_between_vertices(u, v))
+            get_segment_cache().put(key, way_points)
+        return _thaw_way_points(way_points)
+
+    def _query_way_points_between_vertices(self, u, v):
         link_id = Session.query(Edge.link_id).filter(
         Edge.from_id == u, Edge.to_id == v).first()
         # FIXME: It is not reliable to find the line feature by
@@ -138,31 +192,34 @@ class ModePath(object):
         if self.mode in [MODES['private_car'], MODES['foot']]:
             return get_waypoints(Session.query(StreetLine.geom).filter(
                 StreetLine.link_id == link_id).first().geom)
-        elif self.mode == MODES['underground']:
-            raw_fnodeid = u % 10000000 - u % 1000000 + u % 100000
-            raw_tnodeid = v % 10000000 - u % 1000000 + u % 100000
+        raw_fnodeid, raw_tnodeid = raw_line_node_ids(self.mode, u, v)
+        if self.mode == MODES['underground']:
             sql = "SELECT ST_AsGeoJSON(underground_lines.geom, 4326) AS line_geom \
                 FROM underground_lines WHERE (fnodeid = :fnode AND tnodeid = :tnode) \
                 OR (fnodeid = :tnode AND tnodeid = :fnode) LIMIT 1;"
         elif self.mode == MODES['suburban']:
-            raw_fnodeid = u % 100000000
-            raw_tnodeid = v % 100000000
             sql = "SELECT ST_AsGeoJSON(suburban_lines.geom, 4326) AS line_geom \
                 FROM suburban_lines WHERE (fnodeid = :fnode AND tnodeid = :tnode) \
                 OR (fnodeid = :tnode AND tnodeid = :fnode) LIMIT 1;"
         elif self.mode == MODES['tram']:
-            raw_fnodeid = u % 100000000
-            raw_tnodeid = v % 100000000
             sql = "SELECT ST_AsGeoJSON(tram_lines.geom, 4326) AS line_geom \
                 FROM tram_lines WHERE (fnodeid = :fnode AND tnodeid = :tnode) \
                 OR (fnodeid = :tnode AND tnodeid = :fnode) LIMIT 1;"
         linestring = Session.execute(sql, {'fnode': raw_fnodeid,
                                            'tnode': raw_tnodeid}).fetchall()
-        coords = json.loads(linestring[0][0])['coordinates']
-        coord_list = [j for i in coords for j in i]
+        coord_list = flatten_line_coordinates(linestring[0][0])
         logger.debug("Coordinate list between %s and %s: %s", u, v, coord_list)
         return coord_list
 
+    def _get_segment_way_points(self, u, v, segment_geometries=None):
+        if segment_geometries is not None:
+            key = (self.mode, u, v)
+            if key in segment_geometries:
+                # Always hand out a copy because _concat_seg_points may
+                # reverse the segment in place
+                return _thaw_way_points(segment_geometries[key])
+        return self._get_way_points_between_vertices(u, v)
+
     def _geo_diff(self, p1, p2):
         x_diff = abs(p1[0] - p2[0])
         y_diff = abs(p1[1] - p2[1])
@@ -180,12 +237,24 @@ class ModePath(object):
 
     @property
     def point_list(self):
+        return self.build_point_list()
+
+    def build_point_list(self, segment_geometries=None):
+        """ Concatenate the way points of all the segments of this path.
+            Segments found in segment_geometries, a dict keyed by
+            (mode, from_vertex_id, to_vertex_id), are not queried again.
+        """
         self._point_list = []
         for index, (i, j) in enumerate(self._pairwise(self.vertex_id_list)):
-            way_points = self._get_way_points_between_vertices(i, j)
+            way_points = self._get_segment_way_points(i, j, segment_geometries)
             self._concat_seg_points(index, way_points)
         return self._point_list
 
+    @property
+    def segments(self):
+        return [(self.mode, i, j)
+                for i, j in self._pairwise(self.vertex_id_list)]
+
     def _pairwise(self, iterable):
         """ transform a list into a pairwise iterable container like this:
             [s0, s1, s2, s3, ...] -> [s0,s1], [s1,s2], [s2, s3], ...
@@ -194,26 +263,144 @@ class ModePath(object):
         next(b, None)
         return izip(a, b)
 
-    def to_geojson(self):
-        return {"type": "LineString", "coordinates": self.point_list}
+    def to_geojson(self, segment_geometries=None, tolerance=None, zoom=None,
+                   simplification=DOUGLAS_PEUCKER):
+        """ Build the LineString of this path, simplified with a tolerance
+            in meters or for a zoom level if either is given (see
+            simplify.py). The end points are always kept.
+        """
+        return {"type": "LineString",
+                "coordinates": simplify_line(
+                    self.build_point_list(segment_geometries), tolerance,
+                    zoom, simplification)}
 
-    # FIXME: I have some wierd feelings about this method, should be fixed
     def expand_mode_path(self):
+        """ Split a public transportation path into the paths of the
+            concrete modes, i.e. underground, suburban, tram and foot
+        """
         if self.is_multimodal:
-            first_mode = Session.query(Vertex.mode_id).filter(
-                Vertex.vertex_id == self.vertex_id_list[0]).first().mode_id
-            mp = ModePath(first_mode, [self.vertex_id_list[0]])
-            self.sub_mode_paths.append(mp)
-            last_mode = first_mode
-            for v in self.vertex_id_list[1:]:
-                vm = Session.query(Vertex.mode_id).filter(
-                    Vertex.vertex_id == v).first().mode_id
-                if vm != last_mode:
-                    mp = ModePath(vm, [v])
-                    self.sub_mode_paths.append(mp)
-                else:
-                    mp.vertex_id_list.append(v)
-                last_mode = vm
+            for m, vertices in get_vertex_mode_index().split_by_mode(
+                    self.vertex_id_list):
+                self.sub_mode_paths.append(ModePath(m, vertices))
+
+
+def raw_line_node_ids(mode, u, v):
+    """ Translate a pair of vertex ids in public transit networks to the
+        fnodeid/tnodeid pair used in the underlying line tables
+    """
+    if mode == MODES['underground']:
+        return (u % 10000000 - u % 1000000 + u % 100000,
+                v % 10000000 - u % 1000000 + u % 100000)
+    return u % 100000000, v % 100000000
+
+
+def flatten_line_coordinates(geojson_str):
+    coords = json.loads(geojson_str)['coordinates']
+    return [j for i in coords for j in i]
+
+
+def _chunks(items, size=BULK_QUERY_CHUNK_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class SegmentGeometryResolver(object):
+
+    """ Resolve the way points of path segments in bulk
+
+    Segments are collected as (mode, from_vertex_id, to_vertex_id) triples
+    from any number of routing results. Those not in the segment cache
+    are fetched with one query per mode table instead of several queries
+    per segment.
+    """
+
+    def __init__(self):
+        self._segments = set()
+        self.geometries = {}
+
+    def add_result(self, result):
+        for mp in result.mode_paths:
+            self.add_mode_path(mp)
+
+    def add_mode_path(self, mode_path):
+        self._segments.update(mode_path.segments)
+
+    def resolve(self):
+        missing = [seg for seg in self._segments
+                   if seg not in self.geometries]
+        if not missing:
+            return self.geometries
+        self.geometries.update(get_segment_cache().get_many(missing))
+        pending = {}
+        for m, u, v in missing:
+            if (m, u, v) not in self.geometries:
+                pending.setdefault(m, []).append((u, v))
+        street_segments = []
+        for m in [MODES['private_car'], MODES['foot']]:
+            street_segments += [(m, u, v) for u, v in pending.pop(m, [])]
+        if street_segments:
+            self._resolve_street_segments(street_segments)
+        line_tables = {
+            MODES['underground']: UndergroundLine,
+            MODES['suburban']:    SuburbanLine,
+            MODES['tram']:        TramLine
+        }
+        for m, pairs in pending.items():
+            if m in line_tables:
+                self._resolve_line_segments(m, pairs, line_tables[m])
+            else:
+                logger.warning("No line table for segments of mode %s", m)
+        logger.debug("Resolved %s of %s segment geometries",
+                     len(self.geometries), len(self._segments))
+        return self.geometries
+
+    def _resolve_street_segments(self, segments):
+        # Vertex ids are unique across modes, so car and foot segments can
+        # share one query on street_lines
+        modes_by_pair = {}
+        for m, u, v in segments:
+            modes_by_pair.setdefault((u, v), []).append(m)
+        pairs = list(modes_by_pair)
+        for chunk in _chunks(pairs):
+            rows = Session.query(
+                Edge.from_id, Edge.to_id, st_asgeojson(StreetLine.geom)).join(
+                    StreetLine, StreetLine.link_id == Edge.link_id).filter(
+                        tuple_(Edge.from_id, Edge.to_id).in_(chunk)).all()
+            for u, v, geojson_str in rows:
+                way_points = _freeze_way_points(parse_waypoints(geojson_str))
+                for m in modes_by_pair.get((u, v), []):
+                    if (m, u, v) not in self.geometries:
+                        self._store((m, u, v), way_points)
+
+    def _resolve_line_segments(self, mode, pairs, line_table):
+        prepare_mappings()
+        raw_pairs = {}
+        for u, v in pairs:
+            raw_pairs.setdefault(raw_line_node_ids(mode, u, v), []).append(
+                (u, v))
+        raw_keys = list(raw_pairs)
+        lines = {}
+        for chunk in _chunks(raw_keys):
+            rows = Session.query(
+                line_table.fnodeid, line_table.tnodeid,
+                st_asgeojson(line_table.geom, 4326)).filter(or_(
+                    tuple_(line_table.fnodeid, line_table.tnodeid).in_(chunk),
+                    tuple_(line_table.tnodeid, line_table.fnodeid).in_(chunk)
+                )).all()
+            for fnode, tnode, geojson_str in rows:
+                lines.setdefault((fnode, tnode), geojson_str)
+                lines.setdefault((tnode, fnode), geojson_str)
+        for raw_key, vertex_pairs in raw_pairs.items():
+            if raw_key not in lines:
+                continue
+            way_points = _freeze_way_points(
+                flatten_line_coordinates(lines[raw_key]))
+            for u, v in vertex_pairs:
+                self._store((mode, u, v), way_points)
+
+    def _store(self, segment, way_points):
+        self.geometries[segment] = way_points
+        get_segment_cache().put(segment, way_points)
 
 
 class RoutingResult(object):
@@ -224,13 +411,26 @@ class RoutingResult(object):
         self.is_existent               = False
         self.planned_mode_list         = []
         self.unfolded_mode_list        = []
-        self.mode_paths                = []
+        self._mode_paths               = []
+        self._switch_points            = None
         self.planned_switch_type_list  = []
         self.description               = ''
         self.length                    = 0.0
         self.time                      = 0.0
         self.walking_time              = 0.0
         self.walking_length            = 0.0
+        # QueryProfile of the search and materialization in debug mode, see
+        # queryprofile.py
+        self.query_profile             = None
+
+    @property
+    def mode_paths(self):
+        return self._mode_paths
+
+    @mode_paths.setter
+    def mode_paths(self, mode_paths):
+        self._mode_paths = mode_paths
+        self.invalidate_switch_points()
 
     @property
     def path_by_vertices(self):
@@ -259,6 +459,17 @@ class RoutingResult(object):
             links += mp.link_id_list
         return links
 
+    def path_fingerprint(self):
+        """ Hash of the modes and vertex lists of the mode paths, shared by
+            the results taking the same path with the same modes
+        """
+        digest = hashlib.sha1()
+        for mp in self.mode_paths:
+            digest.update(np.array(
+                [mp.mode, len(mp.vertex_id_list)] + list(mp.vertex_id_list),
+                dtype=np.int64).tobytes())
+        return digest.hexdigest()
+
     @property
     def path_by_points(self):
         #if not self.mode_paths: return []
@@ -270,39 +481,63 @@ class RoutingResult(object):
 
     @property
     def switch_points(self):
-        sp_list = []
+        """ Switch points between every two consecutive mode paths. They are
+            resolved at the first access and kept until the mode paths change
+        """
+        if self._switch_points is None:
+            with metrics.stage('resolve_switch_points', self.description):
+                self._switch_points = self._resolve_switch_points()
+        return self._switch_points
+
+    def invalidate_switch_points(self):
+        """ Drop the resolved switch points. It must be called whenever the
+            mode paths are modified in place
+        """
+        self._switch_points = None
+
+    def _resolve_switch_points(self):
         if len(self.mode_paths) < 2:
             return []
+        transitions = []
         from_vertex_id = self.mode_paths[0].vertex_id_list[-1]
         from_mode = self.mode_paths[0].mode
-        for i, mp in enumerate(self.mode_paths[1:]):
-            to_mode = mp.mode
+        for mp in self.mode_paths[1:]:
             to_vertex_id = mp.vertex_id_list[0]
-            if (set([from_mode, to_mode]).issubset(
-                set(PUBLIC_TRANSIT_MODES.values() + [MODES['foot']]))):
-                type_id = Session.query(SwitchPoint.type_id).filter(
-                    SwitchPoint.from_vertex_id == from_vertex_id,
-                    SwitchPoint.to_vertex_id == to_vertex_id,
-                    SwitchPoint.from_mode_id == from_mode,
-                    SwitchPoint.to_mode_id == to_mode).first().type_id
+            transitions.append((from_vertex_id, to_vertex_id,
+                                from_mode, mp.mode))
+            from_mode = mp.mode
+            from_vertex_id = mp.vertex_id_list[-1]
+        # All the candidate switch points of the transitions are fetched in
+        # one query, and then matched by modes and switch types here
+        candidates = {}
+        for row in Session.query(
+                SwitchPoint.from_vertex_id, SwitchPoint.to_vertex_id,
+                SwitchPoint.from_mode_id, SwitchPoint.to_mode_id,
+                SwitchPoint.type_id, SwitchPoint.ref_poi_id).filter(
+                    tuple_(SwitchPoint.from_vertex_id,
+                           SwitchPoint.to_vertex_id).in_(
+                               list(set((t[0], t[1]) for t in transitions)))):
+            candidates.setdefault(tuple(row[:4]), []).append(
+                (row.type_id, row.ref_poi_id))
+        pt_and_foot = set(PUBLIC_TRANSIT_MODES.values()) | set([MODES['foot']])
+        sp_list = []
+        for i, t in enumerate(transitions):
+            from_mode, to_mode = t[2], t[3]
+            matched = candidates[t]
+            if set([from_mode, to_mode]).issubset(pt_and_foot):
+                type_id = matched[0][0]
             else:
                 type_id = self.planned_switch_type_list[i]
-            ref_poi_id = Session.query(SwitchPoint.ref_poi_id).filter(
-                SwitchPoint.from_vertex_id == from_vertex_id,
-                SwitchPoint.to_vertex_id == to_vertex_id,
-                SwitchPoint.from_mode_id == from_mode,
-                SwitchPoint.to_mode_id == to_mode,
-                SwitchPoint.type_id == type_id).first().ref_poi_id
+            ref_poi_id = [r for tid, r in matched if tid == type_id][0]
             sp_list.append(self._get_switch_point_poi_info(from_mode, to_mode,
                                                            type_id, ref_poi_id))
-            from_mode = to_mode
-            from_vertex_id = mp.vertex_id_list[-1]
         return sp_list
 
     def _get_switch_point_poi_info(self, from_mode, to_mode,
                                    switch_type_id, ref_poi_id):
         logger.info("Find switch point between %s and %s, with type %s and poi id %s",
                     from_mode, to_mode, switch_type_id, ref_poi_id)
+        prepare_mappings()
         sp_info = {
             'type': 'Feature',
             'properties': {
@@ -313,7 +548,8 @@ class RoutingResult(object):
         }
         if switch_type_id == SWITCH_TYPES['car_parking']:
             logger.info("Find switch point around car parking lots")
-            poi = Session.query(CarParking).filter(
+            poi, poi_geom = Session.query(
+                CarParking, st_asgeojson(CarParking.geom)).filter(
                 CarParking.osm_id == ref_poi_id).first()
             sp_info['properties'].update({
                 "switch_type": "car_parking",
@@ -323,7 +559,8 @@ class RoutingResult(object):
             })
         elif switch_type_id == SWITCH_TYPES['geo_connection']:
             logger.info("Find switch point around geo connections in street network")
-            poi = Session.query(StreetJunction).filter(
+            poi, poi_geom = Session.query(
+                StreetJunction, st_asgeojson(StreetJunction.geom)).filter(
                 StreetJunction.osm_id == ref_poi_id).first()
             sp_info['properties'].update({
                 "switch_type": "geo_connection",
@@ -333,7 +570,8 @@ class RoutingResult(object):
             })
         elif switch_type_id == SWITCH_TYPES['park_and_ride']:
             logger.info("Find switch point around park and ride lots")
-            poi = Session.query(ParkAndRide).filter(
+            poi, poi_geom = Session.query(
+                ParkAndRide, st_asgeojson(ParkAndRide.geom)).filter(
                 ParkAndRide.poi_id == ref_poi_id).first()
             sp_info['properties'].update({
                 "switch_type": "park_and_ride",
@@ -345,7 +583,8 @@ class RoutingResult(object):
             (switch_type_id == SWITCH_TYPES['kiss_and_ride'] and \
              to_mode == MODES['underground']):
             logger.info("Find switch point around underground platforms ")
-            poi = Session.query(UndergroundPlatform).filter(
+            poi, poi_geom = Session.query(
+                UndergroundPlatform, st_asgeojson(UndergroundPlatform.geom)).filter(
                 UndergroundPlatform.platformid == ref_poi_id).first()
             sp_info['properties'].update({
                 "switch_type": "underground_station",
@@ -360,7 +599,8 @@ class RoutingResult(object):
             (switch_type_id == SWITCH_TYPES['kiss_and_ride'] and \
              to_mode == MODES['suburban']):
             logger.info("Find switch point around suburban stations ")
-            poi = Session.query(SuburbanStation).filter(
+            poi, poi_geom = Session.query(
+                SuburbanStation, st_asgeojson(SuburbanStation.geom)).filter(
                 SuburbanStation.type_id == ref_poi_id).first()
             sp_info['properties'].update({
                 "switch_type": "suburban_station",
@@ -374,7 +614,8 @@ class RoutingResult(object):
             (switch_type_id == SWITCH_TYPES['kiss_and_ride'] and \
              to_mode == MODES['tram']):
             logger.info("Find switch point around tram stations ")
-            poi = Session.query(TramStation).filter(
+            poi, poi_geom = Session.query(
+                TramStation, st_asgeojson(TramStation.geom)).filter(
                 TramStation.type_id == ref_poi_id).first()
             sp_info['properties'].update({
                 "switch_type": "tram_station",
@@ -390,8 +631,7 @@ class RoutingResult(object):
             poi = None
             sp_info = {}
         if (not poi is None):
-            geojson = json.loads(Session.scalar(st_asgeojson(poi.geom)))
-            sp_info['geometry'] = geojson
+            sp_info['geometry'] = json.loads(poi_geom)
         return sp_info
 
     def unfold_sub_paths(self):
@@ -403,15 +643,34 @@ class RoutingResult(object):
                 mp.expand_mode_path()
                 mode_paths += mp.sub_mode_paths
                 self.mode_paths = mode_paths
+        self.invalidate_switch_points()
         self.unfolded_mode_list = [mp.mode for mp in self.mode_paths]
 
-    def to_json(self):
-        return json.dumps(self.to_dict())
+    def to_json(self, segment_geometries=None, geometry_encoding=GEOJSON,
+                precision=None, tolerance=None, zoom=None,
+                simplification=DOUGLAS_PEUCKER):
+        return json.dumps(self.to_dict(segment_geometries, geometry_encoding,
+                                       precision, tolerance, zoom,
+                                       simplification))
 
 
-    def to_dict(self):
+    def to_dict(self, segment_geometries=None, geometry_encoding=GEOJSON,
+                precision=None, tolerance=None, zoom=None,
+                simplification=DOUGLAS_PEUCKER):
         """
         For more information about GeoJSON, refer to http://geojson.org
+
+        segment_geometries is the prefetched way points of path segments
+        returned by SegmentGeometryResolver.resolve(). Segments missing in it
+        are fetched one by one.
+
+        geometry_encoding is geojson, polyline or quantized, see encoding.py.
+        It only changes the geometries of the path features, encoded with
+        precision decimal digits or the default of the encoding.
+
+        The paths are simplified before encoding if a tolerance in meters
+        or a zoom level is given, with the douglas_peucker or visvalingam
+        simplification, see simplify.py.
         """
         rd                     = {}
         rd["existence"]        = self.is_existent
@@ -420,7 +679,9 @@ class RoutingResult(object):
         rd["duration"]         = self.time
         rd["walking_duration"] = self.walking_time
         rd["walking_distance"] = self.walking_length
-        rd["switch_points"]    = self.switch_points
+        # The resolved switch points are kept for the next calls, so the
+        # dict gets its own copies
+        rd["switch_points"]    = copy.deepcopy(self.switch_points)
         rd["geojson"]          = {"type": "FeatureCollection", "features": []}
         for i, mp in enumerate(self.mode_paths):
             line_style = {
@@ -431,7 +692,10 @@ class RoutingResult(object):
             line_feature = {
                 "type": "Feature",
                 "properties": self._merge_dicts(mp.properties, line_style),
-                "geometry": mp.to_geojson()
+                "geometry": encode_geometry(
+                    mp.to_geojson(segment_geometries, tolerance, zoom,
+                                  simplification),
+                    geometry_encoding, precision)
             }
             # Set the name of public transit lines according to the start
             # station switch point information
@@ -461,7 +725,8 @@ class RoutingResult(object):
                 #self.switch_points[i]['properties']['marker-size'] = 'medium'
                 #self.switch_points[i]['properties']['marker-symbol'] = \
                     #SWITCH_SYMBOL[self.switch_points[i]["properties"]["switch_type"]]
-                rd["geojson"]["features"].append(self.switch_points[i])
+                rd["geojson"]["features"].append(
+                    copy.deepcopy(self.switch_points[i]))
         return rd
 
     def _merge_dicts(self, x, y):
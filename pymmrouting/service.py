@@ -0,0 +1,386 @@
+"""
+HTTP routing service with an asyncio front end and a pool of worker
+processes, each of which owns one warm planner
+
+    python -m pymmrouting.service --port 8080 --processes 4
+
+POST /route takes the routing options accepted by
+RoutingPlanInferer.load_routing_options and returns the result document of
+batch_find_path. The query string may give the geometry options of
+RoutingResult.to_dict, e.g. /route?geometry_encoding=polyline&zoom=12.
+GET /ready answers 200 once every worker has opened its planner, i.e. run
+MSPinit, and 503 before.
+
+Every request is served by one worker, from plan inference to JSON
+serialization, so the event loop never waits on the database or
+libmmspa4pg. Requests beyond max_pending, i.e. being served or queued,
+are rejected with 503. A request answered with 504 after timeout seconds
+keeps its worker busy until the search is done, and still counts as
+pending until then.
+
+Workers report to the service when their planner is open and when they
+start a request. A worker dying, e.g. on a crash of libmmspa4pg, is
+replaced by the pool, and the request it was serving is answered with 500
+and no longer counted as pending. /ready answers 503 while fewer workers
+than processes are alive and ready.
+
+asyncio needs Python 3, or trollius under Python 2.
+"""
+
+try:
+    import asyncio
+except ImportError:  # Python 2
+    import trollius as asyncio
+try:
+    from urlparse import urlparse, parse_qsl
+except ImportError:  # Python 3
+    from urllib.parse import urlparse, parse_qsl
+try:
+    from multiprocessing import SimpleQueue
+except ImportError:  # Python 2
+    from multiprocessing.queues import SimpleQueue
+from multiprocessing import Pool, cpu_count
+from .inferenceengine import RoutingPlanInferer
+from .routeplanner import MultimodalRoutePlanner
+from .spatialindex import get_street_junction_index
+from . import parallel
+import argparse
+import errno
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_PENDING = 64
+DEFAULT_TIMEOUT = 60.0
+# Seconds between two reads of the events of the workers and checks of
+# dead workers
+WATCHDOG_INTERVAL = 0.2
+MAX_HEADER_BYTES = 16384
+MAX_BODY_BYTES = 1048576
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+           405: 'Method Not Allowed', 413: 'Payload Too Large',
+           500: 'Internal Server Error', 503: 'Service Unavailable',
+           504: 'Gateway Timeout'}
+
+# Keyword arguments of RoutingResult.to_dict taken from the query string
+GEOMETRY_OPTIONS = {
+    'geometry_encoding': str,
+    'precision':         int,
+    'tolerance':         float,
+    'zoom':              float,
+    'simplification':    str
+}
+
+
+def route_request(options, geometry_options):
+    """ Infer the plans of routing options and find their routes with the
+        planner of the worker. Return the result document as JSON.
+    """
+    inferer = RoutingPlanInferer()
+    inferer.load_routing_options(options)
+    plans = inferer.generate_routing_plan()
+    return json.dumps(parallel._worker_planner.batch_find_path(
+        plans, geometry_options))
+
+
+# Queue of the events of the workers, i.e. ('ready', pid, None) and
+# ('started', pid, request id)
+_worker_events = None
+
+
+def _init_worker(events, planner_class, datasource_type, datasource_url):
+    global _worker_events
+    _worker_events = events
+    parallel._init_worker(planner_class, datasource_type, datasource_url)
+    events.put(('ready', os.getpid(), None))
+
+
+def _run_in_worker(request_id, handler, options, geometry_options):
+    _worker_events.put(('started', os.getpid(), request_id))
+    # Exceptions are returned rather than raised, because the pool of
+    # Python 2 has no error callback
+    try:
+        return 200, handler(options, geometry_options)
+    except (KeyError, ValueError, TypeError) as e:
+        logger.info("Invalid routing options: %r", e)
+        return 400, json.dumps({'error': 'Invalid routing options: %r' % e})
+    except Exception as e:
+        logger.exception("Routing failed")
+        return 500, json.dumps({'error': 'Routing failed: %r' % e})
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+def parse_geometry_options(query):
+    options = {}
+    for key, value in parse_qsl(query):
+        if key not in GEOMETRY_OPTIONS:
+            raise ValueError("Unknown option %s" % key)
+        options[key] = GEOMETRY_OPTIONS[key](value)
+    return options
+
+
+class RoutingService(object):
+
+    """ Pool of worker processes with a warm planner each, serving routing
+    requests submitted from the event loop
+
+    handler is the function run in the workers for every request, with the
+    routing options and the geometry options, returning the JSON response.
+    """
+
+    def __init__(self, loop, processes=None, max_pending=DEFAULT_MAX_PENDING,
+                 timeout=DEFAULT_TIMEOUT, datasource_type='POSTGRESQL',
+                 datasource_url=None, planner_class=MultimodalRoutePlanner,
+                 handler=route_request):
+        self.loop = loop
+        self.processes = processes or cpu_count()
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.pending = 0
+        self._handler = handler
+        # Written without any feeder thread, so that the events of a worker
+        # are not lost when it dies
+        self._events = SimpleQueue()
+        # Pids of the workers whose planner is open
+        self._ready_pids = set()
+        # Pending requests by id, as functions finishing them with a
+        # response, and the pids of the workers serving them
+        self._requests = {}
+        self._serving = {}
+        self._next_request_id = 0
+        # Whether a task of the pool died with its worker
+        self._lost_tasks = False
+        self._pool = Pool(self.processes, _init_worker,
+                          (self._events, planner_class, datasource_type,
+                           datasource_url))
+        self._watchdog = self.loop.call_later(WATCHDOG_INTERVAL,
+                                              self._watch_workers)
+
+    @property
+    def is_ready(self):
+        # The events are read by the watchdog in the event loop
+        return sum(1 for pid in list(self._ready_pids)
+                   if _is_alive(pid)) >= self.processes
+
+    def _read_events(self):
+        while not self._events.empty():
+            event, pid, request_id = self._events.get()
+            if event == 'ready':
+                self._ready_pids.add(pid)
+            elif request_id in self._requests:
+                self._serving[request_id] = pid
+
+    def _drop_dead_workers(self):
+        """ Forget the dead workers, and answer the requests they were
+            serving with 500
+        """
+        dead = set(pid for pid in self._ready_pids | set(
+            self._serving.values()) if not _is_alive(pid))
+        if not dead:
+            return
+        logger.error("Workers %s died", sorted(dead))
+        self._ready_pids -= dead
+        for request_id, pid in list(self._serving.items()):
+            if pid in dead:
+                self._lost_tasks = True
+                self._requests[request_id](500, json.dumps(
+                    {'error': 'The worker serving the request died'}))
+
+    def _watch_workers(self):
+        self._read_events()
+        self._drop_dead_workers()
+        self._watchdog = self.loop.call_later(WATCHDOG_INTERVAL,
+                                              self._watch_workers)
+
+    def submit(self, options, geometry_options, respond):
+        """ Serve a request in a worker, and call respond(status, body) in
+            the event loop with the JSON body of the response
+        """
+        if self.pending >= self.max_pending:
+            respond(503, json.dumps({'error': 'Too many pending requests'}))
+            return
+        self.pending += 1
+        request_id = self._next_request_id
+        self._next_request_id += 1
+        answered = []
+
+        def answer(status, body):
+            if not answered:
+                answered.append(status)
+                respond(status, body)
+
+        def done(status, body):
+            # Called once, with the result of the worker or when the
+            # worker died
+            if self._requests.pop(request_id, None) is None:
+                return
+            self._serving.pop(request_id, None)
+            self.pending -= 1
+            timer.cancel()
+            answer(status, body)
+
+        self._requests[request_id] = done
+        timer = self.loop.call_later(
+            self.timeout, answer, 504,
+            json.dumps({'error': 'Timeout after %s seconds' % self.timeout}))
+        self._pool.apply_async(
+            _run_in_worker,
+            (request_id, self._handler, options, geometry_options),
+            callback=lambda result: self.loop.call_soon_threadsafe(
+                done, *result))
+
+    def close(self):
+        self._watchdog.cancel()
+        # The pool waits forever for the results of the tasks lost with
+        # dead workers on closing
+        if self._lost_tasks:
+            self._pool.terminate()
+        else:
+            self._pool.close()
+        self._pool.join()
+
+
+class HttpProtocol(asyncio.Protocol):
+
+    """ Minimal HTTP/1.1 server of one request per connection """
+
+    def __init__(self, service):
+        self.service = service
+        self.transport = None
+        self._buffer = b''
+        self._head = None
+        self._closed = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        self._closed = True
+
+    def data_received(self, data):
+        if self._head is False:
+            # The request has been read already
+            return
+        self._buffer += data
+        if self._head is None:
+            end = self._buffer.find(b'\r\n\r\n')
+            if end < 0:
+                if len(self._buffer) > MAX_HEADER_BYTES:
+                    self._fail(400, 'Header too large')
+                return
+            try:
+                self._head = self._parse_head(
+                    self._buffer[:end].decode('latin-1'))
+            except ValueError as e:
+                self._fail(400, str(e))
+                return
+            self._buffer = self._buffer[end + 4:]
+        method, target, length = self._head
+        if length > MAX_BODY_BYTES:
+            self._fail(413, 'Body too large')
+            return
+        if len(self._buffer) < length:
+            return
+        self._head = False
+        self._handle(method, target, self._buffer[:length])
+
+    def _parse_head(self, head):
+        lines = head.split('\r\n')
+        parts = lines[0].split()
+        if len(parts) != 3 or not parts[2].startswith('HTTP/'):
+            raise ValueError('Malformed request line')
+        length = 0
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            if name.strip().lower() == 'content-length':
+                length = int(value.strip())
+        return parts[0].upper(), parts[1], length
+
+    def _handle(self, method, target, body):
+        url = urlparse(target)
+        if url.path == '/ready':
+            ready = self.service.is_ready
+            self.respond(200 if ready else 503, json.dumps(
+                {'ready': ready, 'pending': self.service.pending}))
+        elif url.path != '/route':
+            self._fail(404, 'Unknown path %s' % url.path)
+        elif method != 'POST':
+            self._fail(405, 'Routing options must be POSTed')
+        elif not self.service.is_ready:
+            self._fail(503, 'Planners are not ready')
+        else:
+            try:
+                options = json.loads(body.decode('utf-8'))
+                geometry_options = parse_geometry_options(url.query)
+            except ValueError as e:
+                self._fail(400, str(e))
+                return
+            self.service.submit(options, geometry_options, self.respond)
+
+    def _fail(self, status, message):
+        self._head = False
+        self.respond(status, json.dumps({'error': message}))
+
+    def respond(self, status, body):
+        if self._closed:
+            return
+        body = body.encode('utf-8') if not isinstance(body, bytes) else body
+        head = ('HTTP/1.1 %s %s\r\n'
+                'Content-Type: application/json\r\n'
+                'Content-Length: %s\r\n'
+                'Connection: close\r\n\r\n' % (
+                    status, REASONS.get(status, ''), len(body)))
+        self.transport.write(head.encode('latin-1') + body)
+        self.transport.close()
+        self._closed = True
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--max-pending', type=int,
+                        default=DEFAULT_MAX_PENDING)
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT,
+                        help="seconds")
+    parser.add_argument('--datasource-type', default='POSTGRESQL')
+    parser.add_argument('--datasource-url', default=None)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    loop = asyncio.get_event_loop()
+    # The street junction index of the config is loaded before the workers
+    # are forked, so that they share it
+    get_street_junction_index()
+    # The workers are forked before the loop opens any socket
+    service = RoutingService(loop, args.processes, args.max_pending,
+                             args.timeout, args.datasource_type,
+                             args.datasource_url)
+    server = loop.run_until_complete(loop.create_server(
+        lambda: HttpProtocol(service), args.host, args.port))
+    logger.info("Serving routes on http://%s:%s/route", args.host, args.port)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        service.close()
+        loop.close()
+
+
+if __name__ == '__main__':
+    main()
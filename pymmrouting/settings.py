@@ -1,18 +1,59 @@
 """ Read config.json file to construct the project-level settings object
+
+The file is read at the first access to a setting instead of at import time.
+Another file can be given with the environment variable PYMMROUTING_CONFIG.
 """
 
+from .lazy import LazyObject, LazyMapping
 import json
 import logging
+import os
 
 logger = logging.getLogger(__name__)
 
-# TODO: Identify the config.json file in a good way
-CONFIG_FILE = "config.json"
-with (open(CONFIG_FILE, 'r')) as conf_file:
-    conf = json.load(conf_file)
+CONFIG_FILE = os.environ.get("PYMMROUTING_CONFIG", "config.json")
+# Default file of the reflected database schema, see orm_graphmodel.py
+DEFAULT_SCHEMA_SNAPSHOT_FILE = "schema_snapshot.pickle"
+
+
+def _load_config():
+    with (open(CONFIG_FILE, 'r')) as conf_file:
+        conf = json.load(conf_file)
     logger.debug("Get config from %s: %s", CONFIG_FILE, conf)
-    PG_DB_CONF = conf["pg_datasource"]["connection"]
-    logger.debug("Content of ['pg_datasource']['connection'] section: %s", PG_DB_CONF)
-    PGBOUNCER_CONF = conf["pg_datasource"]["pgbouncer"]
-    logger.debug("Content of ['pg_datasource']['pgbouncer'] section: %s", PGBOUNCER_CONF)
-    LIB_MMSPA_CONF = conf["mmspa"]
+    return conf
+
+_CONFIG = LazyObject(_load_config)
+
+
+def get_config():
+    return _CONFIG.get()
+
+
+def _section(*keys, **kwargs):
+    default = kwargs.get('default')
+
+    def load():
+        section = get_config()
+        for key in keys:
+            section = section[key] if default is None \
+                else section.get(key, default)
+        logger.debug("Content of %s section: %s", list(keys), section)
+        return section
+    return LazyMapping(load)
+
+PG_DB_CONF = _section("pg_datasource", "connection")
+PGBOUNCER_CONF = _section("pg_datasource", "pgbouncer")
+LIB_MMSPA_CONF = _section("mmspa")
+# Optional, see get_segment_cache() in routingresult.py
+SEGMENT_CACHE_CONF = _section("segment_cache", default={})
+# Optional, see get_route_cache() in routecache.py
+ROUTE_CACHE_CONF = _section("route_cache", default={})
+
+
+def get_schema_snapshot_file():
+    return get_config().get("schema_snapshot", DEFAULT_SCHEMA_SNAPSHOT_FILE)
+
+
+def get_street_junction_index_file():
+    """ Optional, see get_street_junction_index() in spatialindex.py """
+    return get_config().get("street_junction_index")
@@ -0,0 +1,133 @@
+"""
+Simplification of the LineStrings of routes for map overviews, with a
+tolerance in meters or derived from a target zoom level
+
+The first and last points of a line are always kept, and every kept point is
+one of the original coordinates, so the paths of consecutive modes still join
+at their switch points.
+"""
+
+from heapq import heapify, heappush, heappop
+import math
+import numpy as np
+
+DOUGLAS_PEUCKER = 'douglas_peucker'
+VISVALINGAM = 'visvalingam'
+METHODS = (DOUGLAS_PEUCKER, VISVALINGAM)
+
+EARTH_RADIUS = 6378137.0
+# Meters per pixel of 256-pixel web mercator tiles at zoom 0 on the equator
+METERS_PER_PIXEL_AT_ZOOM_0 = 2 * math.pi * EARTH_RADIUS / 256
+
+
+def tolerance_for_zoom(zoom, latitude=0.0, pixels=1.0):
+    """ Return the tolerance in meters below which details of a line are
+        smaller than the given number of pixels at a zoom level
+    """
+    return pixels * METERS_PER_PIXEL_AT_ZOOM_0 * \
+        math.cos(math.radians(latitude)) / 2 ** zoom
+
+
+def _to_meters(points):
+    """ Project lon/lat onto a local equirectangular plane in meters """
+    lat0 = math.radians(points[:, 1].mean())
+    xy = np.radians(points) * EARTH_RADIUS
+    xy[:, 0] *= math.cos(lat0)
+    return xy
+
+
+def _segment_distances(points, a, b):
+    """ Distances of points to the segment from a to b """
+    ab = b - a
+    squared_length = np.dot(ab, ab)
+    if squared_length == 0.0:
+        return np.hypot(points[:, 0] - a[0], points[:, 1] - a[1])
+    t = np.clip(np.dot(points - a, ab) / squared_length, 0.0, 1.0)
+    return np.hypot(points[:, 0] - a[0] - t * ab[0],
+                    points[:, 1] - a[1] - t * ab[1])
+
+
+def douglas_peucker_mask(xy, tolerance):
+    """ Mask of the points kept by Douglas-Peucker. The distances of the
+        points of a span are computed at once.
+    """
+    n = len(xy)
+    keep = np.zeros(n, dtype=bool)
+    keep[[0, n - 1]] = True
+    spans = [(0, n - 1)]
+    while spans:
+        i, j = spans.pop()
+        if j - i < 2:
+            continue
+        distances = _segment_distances(xy[i + 1:j], xy[i], xy[j])
+        k = int(np.argmax(distances))
+        if distances[k] > tolerance:
+            k += i + 1
+            keep[k] = True
+            spans.append((i, k))
+            spans.append((k, j))
+    return keep
+
+
+def _triangle_areas(a, b, c):
+    return 0.5 * np.abs((b[:, 0] - a[:, 0]) * (c[:, 1] - a[:, 1]) -
+                        (c[:, 0] - a[:, 0]) * (b[:, 1] - a[:, 1]))
+
+
+def visvalingam_mask(xy, tolerance):
+    """ Mask of the points kept by Visvalingam-Whyatt, removing the points
+        of the smallest effective area while it is below tolerance ** 2
+    """
+    n = len(xy)
+    keep = np.ones(n, dtype=bool)
+    if n < 3:
+        return keep
+    threshold = tolerance ** 2
+    previous = list(range(-1, n - 1))
+    following = list(range(1, n + 1))
+    areas = np.full(n, np.inf)
+    areas[1:-1] = _triangle_areas(xy[:-2], xy[1:-1], xy[2:])
+    heap = [(a, i) for i, a in enumerate(areas[1:-1].tolist(), 1)]
+    heapify(heap)
+    areas = areas.tolist()
+    xs, ys = xy[:, 0].tolist(), xy[:, 1].tolist()
+    while heap:
+        area, i = heappop(heap)
+        if not keep[i] or area != areas[i]:
+            # Removed or updated since it was pushed
+            continue
+        if area >= threshold:
+            break
+        keep[i] = False
+        p, q = previous[i], following[i]
+        following[p], previous[q] = q, p
+        for k in (p, q):
+            if 0 < k < n - 1:
+                a, c = previous[k], following[k]
+                # Python floats are much faster than numpy one by one
+                a = 0.5 * abs((xs[k] - xs[a]) * (ys[c] - ys[a]) -
+                              (xs[c] - xs[a]) * (ys[k] - ys[a]))
+                # The area of a point never decreases, so that the points
+                # are removed in order
+                areas[k] = max(a, area)
+                heappush(heap, (areas[k], k))
+    return keep
+
+
+def simplify_line(coordinates, tolerance=None, zoom=None,
+                  method=DOUGLAS_PEUCKER):
+    """ Simplify a list of [lon, lat] with a tolerance in meters, or the
+        tolerance of a zoom level at the latitude of the line. The original
+        list is returned if neither is given.
+    """
+    if (tolerance is None and zoom is None) or len(coordinates) < 3:
+        return coordinates
+    if method not in METHODS:
+        raise ValueError("Unknown simplification method: %s" % method)
+    points = np.asarray(coordinates, dtype=np.float64)
+    if tolerance is None:
+        tolerance = tolerance_for_zoom(zoom, points[:, 1].mean())
+    xy = _to_meters(points)
+    keep = douglas_peucker_mask(xy, tolerance) if method == DOUGLAS_PEUCKER \
+        else visvalingam_mask(xy, tolerance)
+    return [coordinates[i] for i in np.flatnonzero(keep)]
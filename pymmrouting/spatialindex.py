@@ -0,0 +1,174 @@
+"""
+In-memory spatial index of street junctions for snapping coordinates to the
+multimodal graph without querying the database
+
+The index can be saved into a file, which is loaded by every process when
+the street_junction_index key of config.json gives it:
+
+    python -m pymmrouting.spatialindex street_junctions.npz
+"""
+
+from sqlalchemy import select, func
+from .orm_graphmodel import StreetJunction
+from .graphindex import fetch_in_batches
+from .lazy import LazyObject
+from .settings import get_street_junction_index_file
+import argparse
+import logging
+import math
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Average number of junctions per grid cell
+POINTS_PER_CELL = 4
+
+
+class StreetJunctionIndex(object):
+
+    """ Uniform grid over the coordinates of street junctions
+
+    Junctions are sorted by grid cell, so the junctions of a cell are a
+    slice of the coordinate arrays. The nearest junction of a location is
+    found by scanning rings of cells around it until no unscanned cell can
+    contain a nearer one. Distances are planar distances in the units of
+    the coordinates, the same as the KNN ordering used in the database.
+    """
+
+    def __init__(self, osm_ids, xs, ys, cell_size=None):
+        self.osm_ids = np.asarray(osm_ids, dtype=np.int64)
+        xs = np.asarray(xs, dtype=np.float64)
+        ys = np.asarray(ys, dtype=np.float64)
+        if len(self.osm_ids) == 0:
+            raise ValueError("Can not build a spatial index without points")
+        self.min_x, self.min_y = xs.min(), ys.min()
+        width = max(xs.max() - self.min_x, 1e-9)
+        height = max(ys.max() - self.min_y, 1e-9)
+        if cell_size is None:
+            cell_size = math.sqrt(
+                width * height * POINTS_PER_CELL / len(self.osm_ids))
+        self.cell_size = max(cell_size, 1e-9)
+        self.nx = int(width // self.cell_size) + 1
+        self.ny = int(height // self.cell_size) + 1
+        cells = self._cells_of(xs, ys)
+        order = np.argsort(cells, kind='mergesort')
+        self.osm_ids = self.osm_ids[order]
+        self.xs = xs[order]
+        self.ys = ys[order]
+        self.cell_starts = np.searchsorted(
+            cells[order], np.arange(self.nx * self.ny + 1))
+
+    @classmethod
+    def from_database(cls):
+        osm_ids, xs, ys = fetch_in_batches(
+            select([StreetJunction.osm_id,
+                    func.ST_X(StreetJunction.geom),
+                    func.ST_Y(StreetJunction.geom)]),
+            [np.int64, np.float64, np.float64])
+        logger.info("Loaded %s street junctions into the spatial index",
+                    len(osm_ids))
+        return cls(osm_ids, xs, ys)
+
+    @classmethod
+    def load(cls, snapshot_file):
+        with np.load(snapshot_file) as arrays:
+            return cls(arrays['osm_ids'], arrays['xs'], arrays['ys'],
+                       float(arrays['cell_size']))
+
+    def save(self, snapshot_file):
+        np.savez(snapshot_file, osm_ids=self.osm_ids, xs=self.xs, ys=self.ys,
+                 cell_size=self.cell_size)
+
+    def __len__(self):
+        return len(self.osm_ids)
+
+    def _cells_of(self, xs, ys):
+        ix = ((xs - self.min_x) // self.cell_size).astype(np.int64)
+        iy = ((ys - self.min_y) // self.cell_size).astype(np.int64)
+        return iy * self.nx + ix
+
+    def _nearest_in_grid(self, x, y):
+        ix = int((x - self.min_x) // self.cell_size)
+        iy = int((y - self.min_y) // self.cell_size)
+        best, best_dist = -1, float('inf')
+        max_ring = max(ix, self.nx - 1 - ix, iy, self.ny - 1 - iy)
+        for ring in range(max_ring + 1):
+            for cy in range(max(iy - ring, 0), min(iy + ring, self.ny - 1) + 1):
+                if cy in (iy - ring, iy + ring):
+                    cxs = range(max(ix - ring, 0),
+                                min(ix + ring, self.nx - 1) + 1)
+                else:
+                    cxs = [cx for cx in (ix - ring, ix + ring)
+                           if 0 <= cx < self.nx]
+                for cx in cxs:
+                    start = self.cell_starts[cy * self.nx + cx]
+                    end = self.cell_starts[cy * self.nx + cx + 1]
+                    if start == end:
+                        continue
+                    dist = np.hypot(self.xs[start:end] - x,
+                                    self.ys[start:end] - y)
+                    i = int(dist.argmin())
+                    if dist[i] < best_dist:
+                        best, best_dist = start + i, dist[i]
+            # Everything beyond this ring is at least ring cells away
+            if best >= 0 and best_dist <= ring * self.cell_size:
+                break
+        return best
+
+    def _nearest(self, x, y):
+        inside = (0 <= x - self.min_x < self.nx * self.cell_size) and \
+            (0 <= y - self.min_y < self.ny * self.cell_size)
+        if inside:
+            return self._nearest_in_grid(x, y)
+        # Rare case of locations out of the extent of the graph
+        return int(np.hypot(self.xs - x, self.ys - y).argmin())
+
+    def _to_point(self, i):
+        return {
+            'point_id': int(self.osm_ids[i]),
+            'geometry': {
+                'type': 'Point',
+                'coordinates': [float(self.xs[i]), float(self.ys[i])]
+            }
+        }
+
+    def nearest(self, lon, lat):
+        """ Return the id and GeoJSON geometry of the nearest junction """
+        return self._to_point(self._nearest(lon, lat))
+
+    def nearest_many(self, lons, lats):
+        """ Snap N locations in one call """
+        return [self._to_point(self._nearest(x, y))
+                for x, y in zip(np.asarray(lons, dtype=np.float64).tolist(),
+                                np.asarray(lats, dtype=np.float64).tolist())]
+
+
+def _load_configured_index():
+    index_file = get_street_junction_index_file()
+    if index_file is None:
+        return None
+    index = StreetJunctionIndex.load(index_file)
+    logger.info("Loaded %s street junctions from %s", len(index), index_file)
+    return index
+
+# Process-wide index of the file given by the config, loaded at the first
+# use, or None if the config gives no file
+_STREET_JUNCTION_INDEX = LazyObject(_load_configured_index)
+
+
+def get_street_junction_index():
+    return _STREET_JUNCTION_INDEX.get()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Save the spatial index of the street junctions into a "
+                    "file")
+    parser.add_argument('index_file', help="ending with .npz")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    StreetJunctionIndex.from_database().save(args.index_file)
+
+
+if __name__ == '__main__':
+    main()
@@ -10,6 +10,7 @@ Description:
 
 from pymmrouting.routeplanner import MultimodalRoutePlanner
 from pymmrouting.inferenceengine import RoutingPlanInferer
+from pymmrouting.resultwriter import ResultWriter
 from termcolor import colored
 import datetime
 import argparse
@@ -37,6 +38,9 @@ parser.add_argument("ROUTING_OPTIONS_FILE",
                     help="User-defined options about travelling")
 parser.add_argument("-c", "--APP-CONFIG", default="config.json",
                     help="config for client application")
+parser.add_argument("--sort-by-duration", action="store_true",
+                    help="print the routes sorted by duration, which holds "
+                         "all of them in memory")
 args = parser.parse_args()
 ROUTING_OPTIONS_FILE = args.ROUTING_OPTIONS_FILE
 CONFIG_FILE = args.APP_CONFIG
@@ -73,10 +77,13 @@ print "Routing from " + \
             str(routing_options['source']['value']['y']), 'red') + " to " + \
     colored(str(routing_options['target']['value']['x']) + ',' +
             str(routing_options['target']['value']['y']), 'red')
-final_results = route_planner.batch_find_path(routing_plans)
-print colored("Finish doing routing plan!", "green")
+# Routes are printed and written to the result file one by one as soon as
+# they are found, so the whole result document is never held in memory
 print "Final refined routing results are: "
-for i, r in enumerate(final_results["routes"]):
+result_file = open("tmp/multimodal_routing_results.json", 'w')
+result_writer = ResultWriter(result_file)
+for i, r in enumerate(route_planner.iter_find_path(
+        routing_plans, sort_by_duration=args.sort_by_duration)):
     print "== " + str(i + 1) + ". " + r["summary"] + " =="
     print "Does it exist? ",
     if r["existence"] is True:
@@ -99,6 +106,10 @@ for i, r in enumerate(final_results["routes"]):
     for sp in r["switch_points"]:
         print colored((sp['properties']['switch_type'] + ": "), "blue")
         print str(sp)
-with (open("tmp/multimodal_routing_results.json", 'w')) as result_file:
-    result_file.write(json.dumps(final_results))
+    result_writer.write_route(r)
+if routing_plans:
+    result_writer.write_endpoints(routing_plans[0])
+result_writer.close()
+result_file.close()
+print colored("Finish doing routing plan!", "green")
 route_planner.cleanup()
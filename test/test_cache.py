@@ -0,0 +1,56 @@
+import unittest
+import time
+from pymmrouting.cache import LRUCache
+
+
+class LRUCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = LRUCache(5, weigher=len)
+
+    def test_get_and_put(self):
+        self.assertIsNone(self.cache.get('a'))
+        self.cache.put('a', (1, 2))
+        self.assertEqual((1, 2), self.cache.get('a'))
+        self.assertIn('a', self.cache)
+        stats = self.cache.stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+        self.assertEqual(2, stats['weight'])
+
+    def test_evict_least_recently_used(self):
+        self.cache.put('a', (1, 2))
+        self.cache.put('b', (3, 4))
+        self.cache.get('a')
+        self.cache.put('c', (5, 6))
+        self.assertIn('a', self.cache)
+        self.assertNotIn('b', self.cache)
+        self.assertIn('c', self.cache)
+        self.assertEqual(1, self.cache.stats()['evictions'])
+        self.assertLessEqual(self.cache.stats()['weight'], 5)
+
+    def test_skip_values_heavier_than_the_cache(self):
+        self.cache.put('a', (1, 2))
+        self.cache.put('b', tuple(range(6)))
+        self.assertNotIn('b', self.cache)
+        self.assertIn('a', self.cache)
+
+    def test_get_many(self):
+        self.cache.put('a', (1,))
+        self.cache.put('b', (2,))
+        self.assertEqual({'a': (1,), 'b': (2,)},
+                         self.cache.get_many(['a', 'b', 'c']))
+        self.assertEqual(2, self.cache.stats()['hits'])
+        self.assertEqual(1, self.cache.stats()['misses'])
+
+    def test_expire_entries(self):
+        cache = LRUCache(5, ttl=0.01)
+        cache.put('a', 1)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(1, cache.stats()['expirations'])
+        self.assertEqual(0, len(cache))
+
+
+if __name__ == "__main__":
+    unittest.main()
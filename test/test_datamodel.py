@@ -0,0 +1,46 @@
+import unittest
+import pickle
+from ctypes import pointer
+from pymmrouting.datamodel import CVertex, MaxDistance, MaxDuration, \
+    MaxWalking, And, Or
+
+
+class ConstraintTestCase(unittest.TestCase):
+
+    def vertex(self, distance, elapsed_time, walking_distance):
+        return pointer(CVertex(distance=distance, elapsed_time=elapsed_time,
+                               walking_distance=walking_distance))
+
+    def test_max_distance(self):
+        checker = MaxDistance(1000).to_checker()
+        self.assertEqual(0, checker(self.vertex(1000.0, 99.0, 99.0)))
+        self.assertEqual(-1, checker(self.vertex(1000.1, 0.0, 0.0)))
+
+    def test_compile_conjunction_to_bounds(self):
+        c = MaxDistance(1000) & MaxDuration(30) & MaxWalking(500) & \
+            MaxDistance(800)
+        self.assertEqual((800.0, 30.0, 500.0), c.bounds())
+        checker = c.to_checker()
+        self.assertEqual(0, checker(self.vertex(800.0, 30.0, 500.0)))
+        self.assertEqual(-1, checker(self.vertex(800.0, 30.0, 501.0)))
+        self.assertEqual(-1, checker(self.vertex(800.0, 31.0, 0.0)))
+
+    def test_disjunction(self):
+        c = Or(MaxDistance(1000), MaxWalking(200))
+        self.assertIsNone(c.bounds())
+        checker = c.to_checker()
+        self.assertEqual(0, checker(self.vertex(2000.0, 0.0, 100.0)))
+        self.assertEqual(0, checker(self.vertex(900.0, 0.0, 300.0)))
+        self.assertEqual(-1, checker(self.vertex(2000.0, 0.0, 300.0)))
+
+    def test_pickle(self):
+        c = And(MaxDistance(1000), Or(MaxDuration(10), MaxWalking(200)))
+        copied = pickle.loads(pickle.dumps(c))
+        self.assertEqual(c, copied)
+        self.assertEqual(hash(c), hash(copied))
+        self.assertNotEqual(c, And(MaxDistance(1000)))
+        self.assertNotEqual(MaxDistance(10), MaxWalking(10))
+
+
+if __name__ == "__main__":
+    unittest.main()
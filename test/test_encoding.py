@@ -0,0 +1,49 @@
+import unittest
+import numpy as np
+from pymmrouting.encoding import encode_polyline, decode_polyline, \
+    quantize_coordinates, dequantize_coordinates, encode_geometry
+
+
+class EncodingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # Sample of the polyline algorithm documentation, as [lon, lat]
+        self.coordinates = [[-120.2, 38.5], [-120.95, 40.7],
+                            [-126.453, 43.252]]
+
+    def test_encode_polyline(self):
+        self.assertEqual('_p~iF~ps|U_ulLnnqC_mqNvxq`@',
+                         encode_polyline(self.coordinates))
+        self.assertEqual('', encode_polyline([]))
+        self.assertEqual('??', encode_polyline([[0.0, 0.0]]))
+
+    def test_polyline_round_trip(self):
+        np.random.seed(7)
+        points = np.cumsum(np.random.randn(1000, 2) * 1.0e-3, axis=0) + \
+            [11.5, 48.1]
+        for precision in (5, 6):
+            decoded = decode_polyline(encode_polyline(points, precision),
+                                      precision)
+            self.assertLessEqual(np.abs(np.array(decoded) - points).max(),
+                                 0.5 * 10 ** -precision + 1.0e-9)
+
+    def test_quantized_round_trip(self):
+        values = quantize_coordinates(self.coordinates)
+        self.assertEqual([-120200000, 38500000, -750000, 2200000,
+                          -5503000, 2552000], values)
+        np.testing.assert_allclose(self.coordinates,
+                                   dequantize_coordinates(values))
+
+    def test_encode_geometry(self):
+        line = {'type': 'LineString', 'coordinates': self.coordinates}
+        self.assertIs(line, encode_geometry(line))
+        self.assertEqual({'type': 'EncodedPolyline', 'precision': 5,
+                          'polyline': '_p~iF~ps|U_ulLnnqC_mqNvxq`@'},
+                         encode_geometry(line, 'polyline'))
+        self.assertEqual(2, encode_geometry(line, 'quantized', 2)[
+            'precision'])
+        self.assertRaises(ValueError, encode_geometry, line, 'wkb')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import unittest
+from pymmrouting.graphindex import VertexModeIndex, EdgeIndex
+
+
+class VertexModeIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.index = VertexModeIndex(
+            [31000003, 12000001, 12000002, 31000001, 31000002, 11000001],
+            [3, 2, 2, 3, 3, 1])
+
+    def test_lookup(self):
+        self.assertEqual(6, len(self.index))
+        self.assertIn(31000002, self.index)
+        self.assertNotIn(99, self.index)
+        self.assertEqual(3, self.index.mode_of(31000003))
+        self.assertListEqual([2, 3, 1],
+                             self.index.lookup(
+                                 [12000002, 31000001, 11000001]).tolist())
+
+    def test_split_by_mode(self):
+        runs = self.index.split_by_mode(
+            [12000001, 12000002, 31000001, 31000002, 31000003, 12000001])
+        self.assertListEqual([(2, [12000001, 12000002]),
+                              (3, [31000001, 31000002, 31000003]),
+                              (2, [12000001])], runs)
+        self.assertListEqual([], self.index.split_by_mode([]))
+
+    def test_reject_mode_ids_out_of_range(self):
+        self.assertRaises(ValueError, VertexModeIndex, [1], [300])
+
+
+class EdgeIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.index = EdgeIndex(
+            [12000001, 12000002, 12000002, 12000003],
+            [12000002, 12000003, 12000001, 12000002],
+            [1, 2, 3, 4],
+            [101, 102, 101, EdgeIndex.NO_LINK],
+            [10.0, 20.0, 10.0, 20.0],
+            [75.0, 75.0, 75.0, 75.0])
+
+    def test_translate_path(self):
+        path = [12000001, 12000002, 12000003, 12000002, 12000001]
+        self.assertListEqual([1, 2, 4, 3], self.index.edge_ids_of_path(path))
+        self.assertListEqual([101, 102, None, 101],
+                             self.index.link_ids_of_path(path))
+        lengths = self.index.path_attributes(path)[2]
+        self.assertAlmostEqual(60.0, lengths.sum())
+
+    def test_translate_short_path(self):
+        self.assertListEqual([], self.index.edge_ids_of_path([12000001]))
+        self.assertListEqual([], self.index.edge_ids_of_path([]))
+
+    def test_find(self):
+        pos, found = self.index.find([12000001, 12000003, 99],
+                                     [12000002, 12000001, 12000002])
+        self.assertListEqual([True, False, False], found.tolist())
+        self.assertEqual(1, self.index.edge_ids[pos[0]])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+import unittest
+import os
+import shutil
+import tempfile
+import numpy as np
+from pymmrouting.graphsnapshot import GraphSnapshot, build_csr, \
+    write_graph_snapshot, ARRAY_DTYPES
+
+
+class GraphSnapshotTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.snapshot_file = os.path.join(self.tmp_dir, 'graph.mmgs')
+        self.vertex_ids = np.array([10, 20, 30, 40], dtype=np.int64)
+        from_ids = np.array([30, 10, 10, 20, 99])
+        to_ids = np.array([40, 30, 20, 30, 10])
+        self.offsets, self.targets, order = build_csr(
+            self.vertex_ids, from_ids, to_ids)
+        arrays = dict((name, np.empty(0, dtype=dtype))
+                      for name, dtype in ARRAY_DTYPES)
+        arrays.update({
+            'vertex_ids':         self.vertex_ids,
+            'vertex_modes':       [2, 2, 1, 1],
+            'vertex_xs':          [0.0, 1.0, 2.0, 3.0],
+            'vertex_ys':          [0.0, 0.0, 0.0, 0.0],
+            'offsets':            self.offsets,
+            'edge_targets':       self.targets,
+            'edge_ids':           np.array([1, 2, 3, 4, 5])[order],
+            'edge_link_ids':      np.array([-1, 7, 8, 9, 6])[order],
+            'edge_lengths':       np.array([5.0, 1.5, 2.5, 3.5, 9.0])[order],
+            'edge_speed_factors': np.ones(len(order))
+        })
+        write_graph_snapshot(self.snapshot_file, arrays, {'modes': {'foot': 2}})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_build_csr(self):
+        self.assertListEqual([0, 2, 3, 4, 4], self.offsets.tolist())
+        # Targets of every vertex are sorted and the edge of the unknown
+        # vertex 99 is dropped
+        self.assertListEqual([1, 2, 2, 3], self.targets.tolist())
+
+    def test_open_snapshot(self):
+        snapshot = GraphSnapshot.open(self.snapshot_file)
+        self.assertEqual(4, len(snapshot))
+        self.assertEqual({'foot': 2}, snapshot.modes)
+        self.assertListEqual([10, 20, 30, 40], snapshot.vertex_ids.tolist())
+        self.assertEqual(np.float32, snapshot.edge_lengths.dtype)
+        self.assertEqual(2, snapshot.position_of(30))
+        self.assertEqual(-1, snapshot.position_of(35))
+        self.assertEqual(0, len(snapshot.switch_from_ids))
+        self.assertListEqual([3, 4], snapshot.edge_index().edge_ids_of_path(
+            [10, 20, 30]))
+        self.assertEqual(1, snapshot.vertex_mode_index().mode_of(30))
+        snapshot.close()
+
+    def test_reject_other_files(self):
+        other_file = os.path.join(self.tmp_dir, 'other')
+        with open(other_file, 'wb') as f:
+            f.write(b'{"type": "FeatureCollection"}')
+        self.assertRaises(ValueError, GraphSnapshot.open, other_file)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,4 +1,5 @@
 import unittest
+import pickle
 from pymmrouting.inferenceengine import RoutingPlan, RoutingPlanInferer
 from pymmrouting.datamodel import VERTEX_VALIDATION_CHECKER
 from pymmrouting.orm_graphmodel import SwitchType, Mode, Session
@@ -158,6 +159,15 @@ class RoutingPlanInfererTestCase(unittest.TestCase):
         self.assertNotIn([self.modes["private_car"]],
                          [i.mode_list for i in test_plans3])
 
+    def test_generated_plans_are_picklable(self):
+        self.inferer.load_routing_options_from_file(self.routing_options_file2)
+        plans = self.inferer.generate_routing_plan()
+        copied_plans = pickle.loads(pickle.dumps(plans))
+        self.assertEqual([p.mode_list for p in plans],
+                         [p.mode_list for p in copied_plans])
+        self.assertEqual([p.switch_constraint_list for p in plans],
+                         [p.switch_constraint_list for p in copied_plans])
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,46 @@
+import unittest
+from pymmrouting.lazy import LazyObject, LazyMapping
+
+
+class LazyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.loads = 0
+
+    def load(self):
+        self.loads += 1
+        return {'foot': 2, 'private_car': 1}
+
+    def test_load_mapping_once_at_first_access(self):
+        modes = LazyMapping(self.load)
+        self.assertEqual(0, self.loads)
+        self.assertEqual(2, modes['foot'])
+        self.assertIn('private_car', modes)
+        self.assertEqual(2, len(modes))
+        self.assertEqual(1, self.loads)
+        modes.reset()
+        self.assertEqual(1, modes['private_car'])
+        self.assertEqual(2, self.loads)
+
+    def test_reset_derived_mappings(self):
+        modes = LazyMapping(self.load)
+        inv_modes = LazyMapping(
+            lambda: ((v, k) for k, v in modes.items()), derived_from=[modes])
+        self.assertEqual('foot', inv_modes[2])
+        modes.set({'foot': 3})
+        self.assertEqual('foot', inv_modes[3])
+        self.assertNotIn(2, inv_modes)
+        modes.reset()
+        self.assertEqual('private_car', inv_modes[1])
+        self.assertEqual(2, self.loads)
+
+    def test_build_object_once(self):
+        obj = LazyObject(self.load)
+        self.assertFalse(obj.is_built)
+        self.assertIs(obj.get(), obj.get())
+        self.assertTrue(obj.is_built)
+        self.assertEqual(1, self.loads)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,116 @@
+import unittest
+from sqlalchemy import create_engine
+from pymmrouting import metrics
+from pymmrouting.cache import LRUCache
+try:
+    from urllib2 import urlopen
+except ImportError:  # Python 3
+    from urllib.request import urlopen
+
+
+class MetricsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        metrics.REGISTRY.reset()
+
+    def tearDown(self):
+        metrics.disable()
+        metrics.REGISTRY.reset()
+
+    def test_record_nothing_while_disabled(self):
+        with metrics.stage('to_dict', 'Walking'):
+            pass
+        with metrics.native_call('MSPfindPath'):
+            pass
+        metrics.count_route('Walking', True)
+        self.assertEqual(0, metrics.STAGE_SECONDS.count(stage='to_dict',
+                                                        plan='Walking'))
+        self.assertEqual(0, metrics.NATIVE_CALL_SECONDS.count(
+            call='MSPfindPath'))
+        self.assertEqual(0, metrics.ROUTES.value(plan='Walking',
+                                                 existent='true'))
+
+    def test_time_stages_by_plan(self):
+        metrics.enable()
+        for _ in range(3):
+            with metrics.stage('to_dict', 'Walking'):
+                pass
+        with metrics.stage('to_dict', 'Driving'):
+            pass
+        self.assertEqual(3, metrics.STAGE_SECONDS.count(stage='to_dict',
+                                                        plan='Walking'))
+        self.assertEqual(1, metrics.STAGE_SECONDS.count(stage='to_dict',
+                                                        plan='Driving'))
+
+    def test_timed_decorator_keeps_the_result(self):
+        @metrics.timed('double')
+        def double(x):
+            return 2 * x
+        self.assertEqual(4, double(2))
+        metrics.enable()
+        self.assertEqual(6, double(3))
+        self.assertEqual(1, metrics.STAGE_SECONDS.count(stage='double'))
+
+    def test_count_queries_of_the_innermost_stage(self):
+        engine = create_engine('sqlite://')
+        metrics.enable()
+        with metrics.stage('generate_routing_plan'):
+            engine.execute('select 1')
+            with metrics.stage('snap_locations'):
+                self.assertEqual('snap_locations', metrics.current_stage())
+                engine.execute('select 1')
+                engine.execute('select 1')
+        engine.execute('select 1')
+        self.assertEqual(1, metrics.DB_QUERIES.value(
+            stage='generate_routing_plan'))
+        self.assertEqual(2, metrics.DB_QUERIES.value(stage='snap_locations'))
+        self.assertEqual(1, metrics.DB_QUERIES.value(stage=metrics.NO_STAGE))
+
+    def test_render_prometheus_text(self):
+        metrics.enable()
+        metrics.STAGE_SECONDS.observe(0.003, stage='search', plan='Walking')
+        metrics.count_route('Driving, parking and walking', False)
+        text = metrics.render()
+        self.assertIn('# TYPE pymmrouting_stage_seconds histogram', text)
+        self.assertIn('pymmrouting_stage_seconds_bucket{stage="search",'
+                      'plan="Walking",le="0.0025"} 0', text)
+        self.assertIn('pymmrouting_stage_seconds_bucket{stage="search",'
+                      'plan="Walking",le="0.005"} 1', text)
+        self.assertIn('pymmrouting_stage_seconds_bucket{stage="search",'
+                      'plan="Walking",le="+Inf"} 1', text)
+        self.assertIn('pymmrouting_stage_seconds_count{stage="search",'
+                      'plan="Walking"} 1', text)
+        self.assertIn('pymmrouting_routes_total{plan="Driving, parking and '
+                      'walking",existent="false"} 1', text)
+
+    def test_render_cache_statistics(self):
+        caches = [LRUCache(10), LRUCache(10)]
+        caches[0].put('a', 1)
+        caches[0].get('a')
+        caches[0].get('b')
+        metrics.register_cache('test_a', caches[0].stats)
+        metrics.register_cache('test_b', caches[1].stats)
+        metrics.register_cache('test_unbuilt', lambda: None)
+        text = metrics.render()
+        self.assertEqual(1, text.count('# TYPE pymmrouting_cache_hit_ratio'))
+        self.assertIn('pymmrouting_cache_hit_ratio{cache="test_a"} 0.5', text)
+        self.assertIn('pymmrouting_cache_hits_total{cache="test_b"} 0', text)
+        self.assertNotIn('test_unbuilt', text)
+
+    def test_serve_over_http(self):
+        server = metrics.enable(port=0)
+        try:
+            metrics.native_call('MSPfindPath').__enter__().__exit__(
+                None, None, None)
+            response = urlopen('http://127.0.0.1:%s/metrics' %
+                               server.server_address[1])
+            self.assertEqual(200, response.getcode())
+            self.assertIn(b'pymmrouting_native_call_seconds_count'
+                          b'{call="MSPfindPath"} 1', response.read())
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == '__main__':
+    unittest.main()
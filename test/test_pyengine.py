@@ -0,0 +1,177 @@
+import unittest
+import os
+import shutil
+import tempfile
+import numpy as np
+from pymmrouting.pyengine import PythonRoutePlanner, switch_condition_mask
+from pymmrouting.parallel import PlannerPool
+from pymmrouting.graphsnapshot import build_csr, write_graph_snapshot, \
+    ARRAY_DTYPES
+from pymmrouting.graphindex import set_vertex_mode_index, set_edge_index
+from pymmrouting.inferenceengine import RoutingPlan
+from pymmrouting.orm_graphmodel import MODES, INV_MODES, SWITCH_TYPES
+from pymmrouting.datamodel import MaxDistance
+
+CAR, FOOT = 1, 2
+CAR_PARKING, GEO_CONNECTION = 1, 2
+
+
+def write_fixture_graph(snapshot_file):
+    """ Foot and car networks reproducing the distances of the paths found
+        in test_routeplanner.py
+    """
+    vertices = {101: FOOT, 102: FOOT, 103: FOOT, 104: FOOT,
+                201: CAR, 202: CAR, 203: CAR}
+    edges = [
+        # from, to, length, speed
+        (101, 102, 2000.0, 4.5),
+        (102, 103, 3567.744, 4.5),
+        (104, 103, 522.534, 4.5),
+        (201, 203, 3000.0, 30.0),
+        (203, 202, 3178.141, 30.0),
+    ]
+    switch_points = [
+        # from, to, type, cost
+        (202, 104, CAR_PARKING, 0.876698),
+        (203, 103, GEO_CONNECTION, 0.0),
+    ]
+    vertex_ids = np.array(sorted(vertices), dtype=np.int64)
+    from_ids, to_ids, lengths, speeds = [np.array(c) for c in zip(*edges)]
+    offsets, targets, order = build_csr(vertex_ids, from_ids, to_ids)
+    arrays = dict((name, np.empty(0, dtype=dtype))
+                  for name, dtype in ARRAY_DTYPES)
+    arrays.update({
+        'vertex_ids':         vertex_ids,
+        'vertex_modes':       [vertices[v] for v in vertex_ids],
+        'vertex_xs':          np.zeros(len(vertex_ids)),
+        'vertex_ys':          np.zeros(len(vertex_ids)),
+        'offsets':            offsets,
+        'edge_targets':       targets,
+        'edge_ids':           np.arange(1, len(edges) + 1)[order],
+        'edge_link_ids':      np.full(len(edges), -1)[order],
+        'edge_lengths':       lengths[order],
+        'edge_speed_factors': speeds[order],
+        'switch_from_ids':    [s[0] for s in switch_points],
+        'switch_to_ids':      [s[1] for s in switch_points],
+        'switch_from_modes':  [vertices[s[0]] for s in switch_points],
+        'switch_to_modes':    [vertices[s[1]] for s in switch_points],
+        'switch_type_ids':    [s[2] for s in switch_points],
+        'switch_costs':       [s[3] for s in switch_points],
+        'switch_ref_poi_ids': [-1] * len(switch_points)
+    })
+    write_graph_snapshot(snapshot_file, arrays, {
+        'modes': {'private_car': CAR, 'foot': FOOT,
+                  'public_transportation': 9},
+        'switch_types': {'car_parking': CAR_PARKING,
+                         'geo_connection': GEO_CONNECTION}
+    })
+
+
+def point(vertex_id):
+    return {'type': 'Feature', 'geometry': {}, 'properties': {'id': vertex_id}}
+
+
+class VertexInferer(object):
+
+    """ Inferer snapping the locations to the foot vertices given in order
+    """
+
+    def __init__(self, vertex_ids):
+        self.vertex_ids = vertex_ids
+
+    def snap_locations(self, locations):
+        return [{'point_id': v} for v in self.vertex_ids[:len(locations)]]
+
+    def find_candidate_vertices_of_points(self, point_ids):
+        return dict((p, {FOOT: p}) for p in point_ids)
+
+
+class PythonEngineTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.snapshot_file = os.path.join(self.tmp_dir, 'graph.mmgs')
+        write_fixture_graph(self.snapshot_file)
+        self.planner = PythonRoutePlanner('SNAPSHOT', self.snapshot_file)
+
+    def tearDown(self):
+        self.planner.cleanup()
+        shutil.rmtree(self.tmp_dir)
+        # Do not leave the fixture graph to the other tests, the mappings
+        # derived from MODES are reset along with it
+        MODES.reset()
+        SWITCH_TYPES.reset()
+        set_vertex_mode_index(None)
+        set_edge_index(None)
+
+    def test_modes_of_the_snapshot(self):
+        self.assertEqual(CAR, MODES['private_car'])
+        self.assertEqual('private_car', INV_MODES[CAR])
+        self.assertEqual(CAR_PARKING, SWITCH_TYPES['car_parking'])
+
+    def car_foot_plan(self):
+        return RoutingPlan(
+            'By car first, then walking', point(201), point(103),
+            [CAR, FOOT], 'speed', [CAR_PARKING],
+            ["type_id=%s AND is_available=true" % CAR_PARKING])
+
+    def test_walking_plan(self):
+        plan = RoutingPlan('Walking', point(101), point(103), [FOOT], 'speed')
+        result = self.planner.find_routing_result(plan)
+        self.assertTrue(result.is_existent)
+        self.assertListEqual([101, 102, 103], result.path_by_vertices)
+        self.assertAlmostEqual(5567.744, result.length, places=3)
+        self.assertAlmostEqual(74.237, result.time, places=3)
+        self.assertEqual(result.length, result.walking_length)
+        self.assertEqual(result.time, result.walking_time)
+
+    def test_driving_and_walking_plan(self):
+        result = self.planner.find_routing_result(self.car_foot_plan())
+        self.assertTrue(result.is_existent)
+        self.assertListEqual([CAR, FOOT], result.unfolded_mode_list)
+        self.assertListEqual([201, 203, 202], result.mode_paths[0].vertex_id_list)
+        self.assertListEqual([104, 103], result.mode_paths[1].vertex_id_list)
+        self.assertAlmostEqual(6700.675, result.length, places=3)
+        self.assertAlmostEqual(20.2001, result.time, places=3)
+        self.assertAlmostEqual(522.534, result.walking_length, places=3)
+        self.assertAlmostEqual(6.967, result.walking_time, places=3)
+
+    def test_switch_constraint(self):
+        plan = self.car_foot_plan()
+        plan.switch_constraint_list = [MaxDistance(5000)]
+        self.assertFalse(self.planner.find_routing_result(plan).is_existent)
+
+    def test_unreachable_target(self):
+        plan = RoutingPlan('Walking', point(103), point(101), [FOOT], 'speed')
+        self.assertFalse(self.planner.find_routing_result(plan).is_existent)
+
+    def test_planner_pool(self):
+        plans = [RoutingPlan('Walking', point(101), point(103), [FOOT],
+                             'speed'), self.car_foot_plan()]
+        with PlannerPool(1, 'SNAPSHOT', self.snapshot_file,
+                         planner_class=PythonRoutePlanner) as pool:
+            results = pool.find_routing_results(plans)
+        self.assertListEqual([101, 102, 103], results[0].path_by_vertices)
+        self.assertListEqual([CAR, FOOT], results[1].unfolded_mode_list)
+
+    def test_cost_matrix(self):
+        matrix = self.planner.cost_matrix([(11.5, 48.1), (11.6, 48.2)],
+                                          [(11.7, 48.3)],
+                                          RoutingPlan('Walking', point(0),
+                                                      point(0), [FOOT],
+                                                      'speed'),
+                                          VertexInferer([101, 103, 103]))
+        self.assertAlmostEqual(5567.744, matrix['distance'][0, 0], places=3)
+        self.assertEqual(0.0, matrix['distance'][1, 0])
+
+    def test_switch_condition_mask(self):
+        graph = self.planner.graph_snapshot
+        self.assertListEqual([True, False], switch_condition_mask(
+            graph, "type_id=1 AND is_available=true").tolist())
+        self.assertListEqual([False, True], switch_condition_mask(
+            graph, "type_id != 1").tolist())
+        self.assertRaises(ValueError, switch_condition_mask, graph, "cost<1")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+import unittest
+from sqlalchemy import create_engine
+from pymmrouting import queryprofile
+from pymmrouting.queryprofile import profile_queries, query_budget, \
+    statement_shape, QueryBudgetExceeded
+
+
+class QueryProfileTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        self.engine.execute('CREATE TABLE vertices (vertex_id INTEGER, '
+                            'mode_id INTEGER)')
+        self.engine.execute('INSERT INTO vertices VALUES (1, 11), (2, 12)')
+
+    def find_mode(self, vertex_id):
+        return self.engine.execute(
+            'SELECT mode_id FROM vertices WHERE vertex_id = ?',
+            vertex_id).scalar()
+
+    def test_statement_shape(self):
+        self.assertEqual(
+            "SELECT * FROM edges WHERE from_id = ? AND to_id IN (?, ...)",
+            statement_shape("SELECT * FROM edges\n WHERE from_id = "
+                            "%(from_id_1)s AND to_id IN (%(to_id_1)s, "
+                            "%(to_id_2)s, %(to_id_3)s)"))
+        self.assertEqual(
+            "SELECT ST_AsGeoJSON(geom, ?)::json FROM lines WHERE name = ?",
+            statement_shape("SELECT ST_AsGeoJSON(geom, 4326)::json FROM lines "
+                            "WHERE name = 'U3'"))
+
+    def test_count_queries_of_the_scope(self):
+        self.find_mode(1)
+        with profile_queries() as profile:
+            self.find_mode(1)
+            self.find_mode(2)
+        self.find_mode(2)
+        self.assertEqual(2, profile.count)
+        self.assertEqual(1, len(profile.shapes()))
+        self.assertGreaterEqual(profile.seconds, 0.0)
+
+    def test_flag_repeated_statements_with_call_site(self):
+        with profile_queries() as profile:
+            for vertex_id in [1, 2, 1]:
+                self.find_mode(vertex_id)
+            self.engine.execute('SELECT count(*) FROM vertices')
+        repeated = profile.suspected_n_plus_one()
+        self.assertEqual(1, len(repeated))
+        self.assertEqual(3, repeated[0]['count'])
+        call_site, n = repeated[0]['call_sites'][0]
+        self.assertEqual(3, n)
+        self.assertIn('test_queryprofile.py', call_site)
+        self.assertIn('find_mode', call_site)
+        self.assertIn('3 times at', profile.report())
+        self.assertEqual(1, len(profile.to_dict()['repeated']))
+
+    def test_nested_scopes(self):
+        with profile_queries() as outer:
+            self.find_mode(1)
+            with profile_queries() as inner:
+                self.find_mode(2)
+            with profile_queries(inner):
+                self.find_mode(1)
+        self.assertEqual(3, outer.count)
+        self.assertEqual(2, inner.count)
+
+    def test_query_budget(self):
+        with query_budget(2):
+            self.find_mode(1)
+            self.find_mode(2)
+        with self.assertRaises(QueryBudgetExceeded):
+            with query_budget(1):
+                self.find_mode(1)
+                self.find_mode(2)
+        with self.assertRaises(QueryBudgetExceeded):
+            with query_budget(10, max_repeats=1):
+                self.find_mode(1)
+                self.find_mode(2)
+
+    def test_debug_scope(self):
+        with queryprofile.debug_scope() as profile:
+            self.find_mode(1)
+        self.assertIsNone(profile)
+        queryprofile.set_debug(True)
+        try:
+            with queryprofile.debug_scope(name='Walking') as profile:
+                self.find_mode(1)
+        finally:
+            queryprofile.set_debug(False)
+        self.assertEqual(1, profile.count)
+        self.assertEqual('Walking', profile.name)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import unittest
+import json
+from pymmrouting.inferenceengine import RoutingPlan
+from pymmrouting.resultwriter import ResultWriter, FeatureCollectionWriter, \
+    endpoint_features
+
+
+def make_route(summary, duration):
+    return {
+        'existence': True,
+        'summary':   summary,
+        'duration':  duration,
+        'geojson':   {'type': 'FeatureCollection', 'features': [
+            {'type': 'Feature',
+             'properties': {'type': 'path', 'mode': 'foot'},
+             'geometry': {'type': 'LineString',
+                          'coordinates': [[11.5, 48.1], [11.6, 48.2]]}}]}
+    }
+
+
+class TextStream(object):
+
+    """ Stream collecting what is written, as str under Python 2 and 3 """
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, s):
+        self.chunks.append(s)
+
+    def getvalue(self):
+        return ''.join(self.chunks)
+
+
+class ResultWriterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.plan = RoutingPlan(
+            'Walking',
+            {'type': 'Feature', 'properties': {'id': 1},
+             'geometry': {'type': 'Point', 'coordinates': [11.5, 48.1]}},
+            {'type': 'Feature', 'properties': {'id': 2},
+             'geometry': {'type': 'Point', 'coordinates': [11.6, 48.2]}},
+            [2], 'speed')
+        self.routes = [make_route('Walking', 30.0),
+                       make_route('Driving', 10.0)]
+
+    def test_write_result_document(self):
+        stream = TextStream()
+        with ResultWriter(stream) as writer:
+            for r in self.routes:
+                writer.write_route(r)
+            writer.write_endpoints(self.plan)
+        self.assertEqual(2, writer.count)
+        results = json.loads(stream.getvalue())
+        self.assertEqual(self.routes, results['routes'])
+        self.assertEqual({}, results['source']['properties'])
+        self.assertEqual([11.6, 48.2], results['target']['geometry'][
+            'coordinates'])
+        # The plan keeps its vertex ids
+        self.assertEqual(1, self.plan.source['properties']['id'])
+
+    def test_write_empty_document(self):
+        stream = TextStream()
+        ResultWriter(stream).close()
+        self.assertEqual({'routes': []}, json.loads(stream.getvalue()))
+
+    def test_write_feature_collection(self):
+        stream = TextStream()
+        with FeatureCollectionWriter(stream) as writer:
+            for r in self.routes:
+                writer.write_route(r)
+        collection = json.loads(stream.getvalue())
+        self.assertEqual('FeatureCollection', collection['type'])
+        self.assertEqual([0, 1], [f['properties']['route']
+                                  for f in collection['features']])
+        self.assertEqual('Driving',
+                         collection['features'][1]['properties']['summary'])
+        self.assertNotIn('route', self.routes[0]['geojson']['features'][0][
+            'properties'])
+
+    def test_endpoint_features(self):
+        source, target = endpoint_features(self.plan)
+        self.assertEqual({}, source['properties'])
+        self.assertEqual(self.plan.target['geometry'], target['geometry'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,293 @@
+import unittest
+import os
+import shutil
+import tempfile
+from pymmrouting.datamodel import MaxDistance, VERTEX_VALIDATION_CHECKER
+from pymmrouting.inferenceengine import RoutingPlan
+from pymmrouting.routecache import RouteCache, DiskRouteCache, DataVersion, \
+    plan_signature, route_key
+from pymmrouting.routeplanner import MultimodalRoutePlanner, assemble_result
+from pymmrouting.routingresult import RoutingResult, PUBLIC_TRANSIT_MODES
+from pymmrouting.orm_graphmodel import MODES, INV_MODES
+from pymmrouting import metrics
+
+
+def make_plan(source=1, target=2, modes=None, target_constraint=None):
+    return RoutingPlan(
+        'Walking', {'type': 'Feature', 'properties': {'id': source}},
+        {'type': 'Feature', 'properties': {'id': target}},
+        modes or [2], 'speed', target_constraint=target_constraint)
+
+
+class CountingPlanner(MultimodalRoutePlanner):
+
+    """ Planner finding no path without libmmspa4pg, counting the plans it
+    searches
+    """
+
+    def __init__(self, route_cache):
+        self.route_cache = route_cache
+        self.searched = []
+
+    def find_routing_results(self, plans):
+        self.searched.extend(plans)
+        return [assemble_result(p, None, None) for p in plans]
+
+
+class StubModePath(object):
+
+    segments = []
+
+    def __init__(self, mode, vertex_ids):
+        self.mode = mode
+        self.vertex_id_list = vertex_ids
+
+
+class StubResult(RoutingResult):
+
+    """ Existent result whose route is built without any geometry query """
+
+    def __init__(self, plan, mode_paths):
+        RoutingResult.__init__(self)
+        self.is_existent = True
+        self.description = plan.description
+        self.mode_paths = [StubModePath(m, v) for m, v in mode_paths]
+
+    def to_dict(self, segment_geometries=None, **kwargs):
+        return {'existence': True, 'summary': self.description,
+                'duration': 1.0, 'geojson': {'features': [
+                    {'properties': {'type': 'path',
+                                    'mode': INV_MODES[mp.mode]}}
+                    for mp in self.mode_paths]}}
+
+
+class PathPlanner(CountingPlanner):
+
+    """ Planner finding the mode paths given by the target of the plans """
+
+    def __init__(self, route_cache, paths):
+        CountingPlanner.__init__(self, route_cache)
+        self.paths = paths
+
+    def find_routing_results(self, plans):
+        self.searched.extend(plans)
+        return [StubResult(p, self.paths[p.target['properties']['id']])
+                for p in plans]
+
+
+class RouteKeyTestCase(unittest.TestCase):
+
+    def test_same_plans_share_the_key(self):
+        self.assertEqual(route_key(make_plan()), route_key(make_plan()))
+        self.assertEqual(
+            route_key(make_plan(target_constraint=MaxDistance(500.0))),
+            route_key(make_plan(target_constraint=MaxDistance(500.0))))
+
+    def test_different_plans_have_different_keys(self):
+        keys = set([
+            route_key(make_plan()),
+            route_key(make_plan(target=3)),
+            route_key(make_plan(modes=[1])),
+            route_key(make_plan(target_constraint=MaxDistance(500.0))),
+            route_key(make_plan(), {'geometry_encoding': 'polyline'})])
+        self.assertEqual(5, len(keys))
+
+    def test_raw_callbacks_are_not_cached(self):
+        checker = VERTEX_VALIDATION_CHECKER(lambda v: 0)
+        plan = make_plan(target_constraint=checker)
+        self.assertIsNone(plan_signature(plan))
+        self.assertIsNone(route_key(plan))
+
+
+class RouteCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.version = 'v1'
+        self.cache = RouteCache(1000, data_version=lambda: self.version)
+
+    def test_get_a_copy_of_the_route(self):
+        self.assertIsNone(self.cache.get('a'))
+        self.cache.put('a', {'duration': 1.0, 'switch_points': []})
+        route = self.cache.get('a')
+        route['switch_points'].append({})
+        self.assertEqual({'duration': 1.0, 'switch_points': []},
+                         self.cache.get('a'))
+        self.assertEqual(2, self.cache.stats()['hits'])
+
+    def test_bounded_by_bytes(self):
+        self.cache.put('a', {'summary': 'x' * 600})
+        self.cache.put('b', {'summary': 'y' * 600})
+        self.assertIsNone(self.cache.get('a'))
+        self.assertIsNotNone(self.cache.get('b'))
+        self.assertLessEqual(self.cache.stats()['weight'], 1000)
+
+    def test_clear_when_data_version_changes(self):
+        self.cache.put('a', {'duration': 1.0})
+        self.assertIsNotNone(self.cache.get('a'))
+        self.version = 'v2'
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(1, self.cache.stats()['invalidations'])
+
+    def test_check_data_version_at_intervals(self):
+        calls = []
+        data_version = DataVersion(lambda: calls.append(1) or len(calls),
+                                   interval=3600.0)
+        self.assertEqual(1, data_version())
+        self.assertEqual(1, data_version())
+        data_version.refresh()
+        self.assertEqual(2, data_version())
+
+
+class DiskRouteCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'routes.sqlite')
+        self.version = 'v1'
+        self.cache = self.open_cache()
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.directory)
+
+    def open_cache(self, max_bytes=100000):
+        return DiskRouteCache(self.path, max_bytes,
+                              data_version=lambda: self.version)
+
+    def test_shared_by_caches_of_the_same_file(self):
+        self.assertIsNone(self.cache.get('a'))
+        route = {'summary': 'Walking', 'switch_points': [], 'duration': 1.5}
+        self.cache.put('a', route)
+        other = self.open_cache()
+        self.assertEqual(route, other.get('a'))
+        other.close()
+        stats = self.cache.stats()
+        self.assertEqual(1, stats['entries'])
+        self.assertEqual(1, stats['misses'])
+
+    def test_never_serve_other_data_versions(self):
+        self.cache.put('a', {'duration': 1.0})
+        self.version = 'v2'
+        self.assertIsNone(self.cache.get('a'))
+        self.cache.put('b', {'duration': 2.0})
+        self.assertEqual(1, self.cache.sweep())
+        self.assertEqual(1, self.cache.stats()['entries'])
+
+    def test_sweep_least_recently_used_beyond_max_bytes(self):
+        for key in 'abc':
+            self.cache.put(key, {'summary': key * 1000})
+        size = self.cache.stats()['weight'] // 3
+        self.cache.max_bytes = 2 * size
+        self.assertEqual(1, self.cache.sweep())
+        self.assertIsNone(self.cache.get('a'))
+        self.assertIsNotNone(self.cache.get('c'))
+        self.assertEqual(1, self.cache.stats()['evictions'])
+
+    def test_second_tier_of_memory_cache(self):
+        memory = RouteCache(1000, disk=self.cache)
+        memory.put('a', {'duration': 1.0})
+        fresh = RouteCache(1000, disk=self.open_cache())
+        self.assertEqual({'duration': 1.0}, fresh.get('a'))
+        self.assertEqual(1, len(fresh))
+        fresh.disk.close()
+
+
+class PlannerRouteCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.planner = CountingPlanner(RouteCache(100000))
+
+    def test_cached_routes_skip_the_search(self):
+        routes = self.planner.find_routes([make_plan(), make_plan(target=3)])
+        self.assertEqual(2, len(self.planner.searched))
+        again = self.planner.find_routes([make_plan(target=4), make_plan()])
+        self.assertEqual(3, len(self.planner.searched))
+        self.assertEqual(routes[0], again[1])
+
+    def test_iter_routes_skip_the_search(self):
+        self.planner.find_routes([make_plan()])
+        routes = list(self.planner._iter_routes(
+            [make_plan(target=3), make_plan()], None))
+        self.assertEqual(2, len(self.planner.searched))
+        self.assertEqual(2, len(routes))
+        list(self.planner._iter_routes([make_plan(target=3)], None))
+        self.assertEqual(2, len(self.planner.searched))
+
+    def test_pruned_routes_skip_the_search(self):
+        self.assertEqual([None], self.planner.find_routes([make_plan()],
+                                                          refine=True))
+        self.assertEqual([None], self.planner.find_routes([make_plan()],
+                                                          refine=True))
+        self.assertEqual(1, len(self.planner.searched))
+        # The unrefined route was never materialized
+        route = self.planner.find_routes([make_plan()])[0]
+        self.assertFalse(route['existence'])
+        self.assertEqual(2, len(self.planner.searched))
+
+    def test_count_pruned_and_cached_routes(self):
+        metrics.REGISTRY.reset()
+        metrics.enable()
+        try:
+            for _ in range(2):
+                self.assertEqual([None, None], self.planner.find_routes(
+                    [make_plan(), make_plan(target=3)], refine=True))
+            self.assertEqual(2, len(self.planner.searched))
+            self.assertEqual(4, metrics.ROUTES.value(plan='Walking',
+                                                     existent='false'))
+        finally:
+            metrics.disable()
+            metrics.REGISTRY.reset()
+
+    def test_find_path_without_cache(self):
+        self.planner.route_cache = None
+        self.planner.find_path(make_plan())
+        result = self.planner.find_path(make_plan())
+        self.assertEqual(2, len(self.planner.searched))
+        self.assertEqual({}, result['source']['properties'])
+
+
+class PlannerRouteCachePruningTestCase(unittest.TestCase):
+
+    def setUp(self):
+        MODES.set({'foot': 2, 'bus': 3, 'tram': 4, 'underground': 5,
+                   'suburban': 6, 'public_transportation': 9})
+        # Every target is reached on foot through the same vertices
+        self.paths = {2: [(2, [1, 2])], 3: [(2, [1, 2])]}
+
+    def tearDown(self):
+        for mapping in [MODES, INV_MODES, PUBLIC_TRANSIT_MODES]:
+            mapping.reset()
+
+    def routes(self, plans, route_cache):
+        planner = PathPlanner(route_cache, self.paths)
+        return [r and r['summary'] for r in planner.find_routes(
+            plans, refine=True)]
+
+    def public_transit_plan(self):
+        plan = make_plan(modes=[9])
+        plan.description = 'Walking and taking public transit'
+        return plan
+
+    def test_cached_route_without_public_transit_leg(self):
+        plans = [self.public_transit_plan(), make_plan()]
+        expected = [None, 'Walking']
+        self.assertEqual(expected, self.routes(plans, None))
+        cache = RouteCache(100000)
+        # Cached without refine, e.g. by find_path
+        PathPlanner(cache, self.paths).find_routes(plans[:1])
+        self.assertEqual(expected, self.routes(plans, cache))
+
+    def test_duplicates_pruned_in_plan_order(self):
+        plans = [make_plan(), make_plan(target=3)]
+        plans[1].description = 'Walking elsewhere'
+        expected = ['Walking', None]
+        self.assertEqual(expected, self.routes(plans, None))
+        cache = RouteCache(100000)
+        PathPlanner(cache, self.paths).find_routes(plans[1:])
+        self.assertEqual(expected, self.routes(plans, cache))
+        # The pruned duplicate is served again once the first route is gone
+        self.assertEqual(['Walking elsewhere'], self.routes(plans[1:], cache))
+
+
+if __name__ == '__main__':
+    unittest.main()
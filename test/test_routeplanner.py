@@ -1,7 +1,11 @@
 import unittest
-from pymmrouting.routeplanner import MultimodalRoutePlanner
-from pymmrouting.inferenceengine import RoutingPlanInferer
-from pymmrouting.orm_graphmodel import SwitchType, Mode, Session
+from pymmrouting.routeplanner import MultimodalRoutePlanner, group_plans, \
+    prune_results
+from pymmrouting.routingresult import RoutingResult, ModePath, \
+    PUBLIC_TRANSIT_MODES
+from pymmrouting.inferenceengine import RoutingPlanInferer, RoutingPlan
+from pymmrouting.orm_graphmodel import SwitchType, Mode, Session, MODES, \
+    INV_MODES
 
 class RoutePlannerTestCase(unittest.TestCase):
 
@@ -98,5 +102,273 @@ class RoutePlannerTestCase(unittest.TestCase):
     def test_batch_find_paths(self):
         pass
 
+    def test_group_plans_sharing_source(self):
+        def point(vertex_id):
+            return {'type': 'Feature', 'geometry': {}, 'properties': {'id': vertex_id}}
+        pt_modes = [self.modes['underground'], self.modes['tram']]
+        plans = []
+        for target in [12672741190, 32672741190, 22672741190]:
+            p = RoutingPlan('Walking and taking public transit',
+                            point(12618163561), point(target),
+                            [self.modes['public_transportation']], 'speed')
+            p.public_transit_set = pt_modes
+            plans.append(p)
+        plans.insert(1, RoutingPlan('Walking', point(12618163561),
+                                    point(12672741190), [self.modes['foot']],
+                                    'speed'))
+        self.assertListEqual([[0, 2, 3], [1]], group_plans(plans))
+
+    def test_cost_matrix(self):
+        for p in self.plans:
+            if p.mode_list == [self.modes["foot"]]:
+                plan = p
+        origins = [(11.5682317, 48.1500053)]
+        destinations = [(11.5036395, 48.1583208), (11.5682317, 48.1500053)]
+        with MultimodalRoutePlanner() as planner:
+            matrix = planner.cost_matrix(origins, destinations, plan,
+                                         inferer=self.inferer)
+        self.assertEqual((1, 2), matrix["distance"].shape)
+        self.assertAlmostEqual(5567.744, matrix["distance"][0, 0], places=3)
+        self.assertAlmostEqual(74.237, matrix["duration"][0, 0], places=3)
+        self.assertEqual(matrix["distance"][0, 0],
+                         matrix["walking_distance"][0, 0])
+
+
+class NullPath(object):
+
+    """ NULL pointer to the paths of libmmspa4pg, i.e. no path found """
+
+    def __getitem__(self, index):
+        raise ValueError("NULL pointer access")
+
+
+class RecordingPlanner(MultimodalRoutePlanner):
+
+    """ Planner recording the calls into libmmspa4pg instead of making them
+    """
+
+    RETURN_VALUES = {'msp_assemblegraphs': 0, 'msp_findpath': NullPath(),
+                     'msp_getfinalpath': NullPath(), 'msp_getfinalcost': 1.0}
+
+    def __init__(self, reuse_routing_plan=False):
+        self.calls = []
+        self.reuse_routing_plan = reuse_routing_plan
+        self.data_source_type = 'POSTGRESQL'
+        self.graph_snapshot = None
+        self._constraint_checkers = []
+        for name in ['msp_createroutingplan', 'msp_setmode',
+                     'msp_setpublictransit', 'msp_setswitchcondition',
+                     'msp_setswitchconstraint', 'msp_settargetconstraint',
+                     'msp_setcostfactor', 'msp_assemblegraphs', 'msp_twoq',
+                     'msp_findpath', 'msp_getfinalpath', 'msp_getfinalcost',
+                     'msp_clearpaths', 'msp_cleargraphs',
+                     'msp_clearroutingplan', 'msp_finalize']:
+            setattr(self, name, self._recorder(name))
+
+    def _recorder(self, name):
+        def record(*args):
+            self.calls.append(name)
+            return self.RETURN_VALUES.get(name)
+        return record
+
+    def searches(self):
+        """ Calls from the preparation of the plan on, without the calls
+            setting its modes and constraints
+        """
+        return [c for c in self.calls if not c.startswith('msp_set')]
+
+
+class GridInferer(object):
+
+    """ Inferer snapping every location to a point of its own, whose only
+    candidate vertex is a foot vertex of the same id
+    """
+
+    def snap_locations(self, locations):
+        return [{'point_id': i + 1} for i in range(len(locations))]
+
+    def find_candidate_vertices_of_points(self, point_ids):
+        return dict((p, {2: p}) for p in point_ids)
+
+
+class RoutingPlanReuseTestCase(unittest.TestCase):
+
+    def setUp(self):
+        MODES.set({'private_car': 1, 'foot': 2, 'public_transportation': 9})
+
+    def tearDown(self):
+        MODES.reset()
+
+    def plan(self, target, modes=(2,)):
+        return RoutingPlan('Walking', {'properties': {'id': 1}},
+                           {'properties': {'id': target}}, list(modes),
+                           'speed')
+
+    def test_reuse_plan_of_same_configuration(self):
+        planner = RecordingPlanner(reuse_routing_plan=True)
+        planner.find_routing_result(self.plan(2))
+        planner.find_routing_result(self.plan(3))
+        self.assertEqual(1, planner.calls.count('msp_createroutingplan'))
+        # The graphs assembled by MSPfindPath are searched again by MSPtwoq
+        self.assertEqual(['msp_createroutingplan', 'msp_findpath',
+                          'msp_twoq', 'msp_getfinalpath'],
+                         planner.searches())
+        self.assertNotIn('msp_cleargraphs', planner.calls)
+        self.assertEqual(1, planner.routing_plan_builds)
+        self.assertEqual(1, planner.routing_plan_reuses)
+
+    def test_assemble_graphs_once_for_reused_plan(self):
+        planner = RecordingPlanner(reuse_routing_plan=True)
+        planner._find_routing_results_from_source([self.plan(2),
+                                                   self.plan(3)])
+        planner.find_routing_result(self.plan(4))
+        planner.find_routing_result(self.plan(5))
+        self.assertEqual(1, planner.calls.count('msp_assemblegraphs'))
+        self.assertNotIn('msp_findpath', planner.calls)
+        self.assertEqual(3, planner.calls.count('msp_twoq'))
+        self.assertEqual(2, planner.routing_plan_reuses)
+
+    def test_clear_plan_after_search_without_reuse(self):
+        planner = RecordingPlanner()
+        planner.find_routing_result(self.plan(2))
+        planner.find_routing_result(self.plan(3))
+        self.assertEqual(2, planner.calls.count('msp_createroutingplan'))
+        self.assertEqual(['msp_findpath', 'msp_cleargraphs',
+                          'msp_clearroutingplan'], planner.calls[-3:])
+        self.assertEqual(0, planner.routing_plan_reuses)
+        self.assertIsNone(planner.assembled_configuration)
+        planner.cleanup()
+        self.assertEqual(2, planner.calls.count('msp_cleargraphs'))
+
+    def test_rebuild_plan_of_other_configuration(self):
+        planner = RecordingPlanner(reuse_routing_plan=True)
+        planner.prepare_routingplan(self.plan(2))
+        planner.prepare_routingplan(self.plan(2, modes=(1,)))
+        self.assertEqual(2, planner.calls.count('msp_createroutingplan'))
+        self.assertEqual(['msp_cleargraphs', 'msp_clearroutingplan',
+                          'msp_createroutingplan'],
+                         planner.calls[4:7])
+        self.assertEqual(0, planner.routing_plan_reuses)
+        planner.cleanup()
+        self.assertEqual(['msp_cleargraphs', 'msp_clearroutingplan',
+                          'msp_finalize'], planner.calls[-3:])
+        self.assertIsNone(planner.assembled_configuration)
+
+
+class RoutePruningTestCase(unittest.TestCase):
+
+    def setUp(self):
+        MODES.set({'private_car': 1, 'foot': 2, 'bus': 3, 'tram': 4,
+                   'underground': 5, 'suburban': 6,
+                   'public_transportation': 9})
+
+    def tearDown(self):
+        for mapping in [MODES, INV_MODES, PUBLIC_TRANSIT_MODES]:
+            mapping.reset()
+
+    def plan(self, modes):
+        return RoutingPlan('Plan', {'properties': {'id': 1}},
+                           {'properties': {'id': 4}}, modes, 'speed')
+
+    def result(self, *mode_paths):
+        result = RoutingResult()
+        result.is_existent = bool(mode_paths)
+        result.mode_paths = [ModePath(m, vertices)
+                             for m, vertices in mode_paths]
+        return result
+
+    def test_prune_before_materialization(self):
+        walking = self.plan([2])
+        public_transit = self.plan([9])
+        results = [
+            self.result((2, [1, 2, 4])),
+            self.result(),
+            self.result((2, [1, 3, 4])),
+            # Duplicate of the first route
+            self.result((2, [1, 2, 4])),
+            # Claims public transit without any leg of it
+            self.result((2, [1, 2, 4])),
+            self.result((2, [1, 2]), (5, [2, 3]), (2, [3, 4]))]
+        plans = [walking] * 4 + [public_transit] * 2
+        pruned = prune_results(plans, results)
+        self.assertEqual([True, False, True, False, False, True],
+                         [r is not None for r in pruned])
+
+    def test_same_vertices_with_other_modes_are_kept(self):
+        results = [self.result((2, [1, 2, 4])), self.result((1, [1, 2, 4]))]
+        self.assertEqual(results, prune_results(
+            [self.plan([2]), self.plan([1])], results))
+        self.assertNotEqual(results[0].path_fingerprint(),
+                            results[1].path_fingerprint())
+
+
+class NativeSearchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        MODES.set({'private_car': 1, 'foot': 2, 'public_transportation': 9})
+
+    def tearDown(self):
+        MODES.reset()
+
+    def plan(self, target):
+        return RoutingPlan('Walking', {'properties': {'id': 1}},
+                           {'properties': {'id': target}}, [2], 'speed')
+
+    def test_assemble_graphs_before_searching_from_source(self):
+        planner = RecordingPlanner()
+        results = planner._find_routing_results_from_source(
+            [self.plan(2), self.plan(3)])
+        self.assertEqual([False, False], [r.is_existent for r in results])
+        self.assertEqual(['msp_createroutingplan', 'msp_assemblegraphs',
+                          'msp_twoq', 'msp_getfinalpath', 'msp_getfinalpath'],
+                         planner.searches()[:5])
+
+    def cost_matrix(self, planner, origins=1):
+        return planner.cost_matrix([(11.5, 48.1)] * origins,
+                                   [(11.6, 48.2)] * 2, self.plan(2),
+                                   GridInferer())
+
+    def test_assemble_graphs_before_final_costs(self):
+        planner = RecordingPlanner()
+        matrix = self.cost_matrix(planner)
+        self.assertEqual([[1.0, 1.0]], matrix['distance'].tolist())
+        self.assertEqual(['msp_createroutingplan', 'msp_assemblegraphs',
+                          'msp_twoq', 'msp_getfinalcost'],
+                         planner.searches()[:4])
+
+    def test_assemble_graphs_once_for_all_origins(self):
+        planner = RecordingPlanner()
+        self.assertEqual((3, 2), self.cost_matrix(planner, 3)[
+            'duration'].shape)
+        self.assertEqual(1, planner.calls.count('msp_createroutingplan'))
+        self.assertEqual(1, planner.calls.count('msp_assemblegraphs'))
+        self.assertEqual(3, planner.calls.count('msp_twoq'))
+        self.assertEqual(['msp_cleargraphs', 'msp_clearroutingplan'],
+                         planner.calls[-2:])
+        self.assertEqual(1, planner.calls.count('msp_cleargraphs'))
+
+    def test_find_path_assembles_graphs_itself(self):
+        planner = RecordingPlanner()
+        self.assertFalse(planner.find_routing_result(self.plan(2)).is_existent)
+        self.assertNotIn('msp_assemblegraphs', planner.calls)
+        self.assertEqual(['msp_createroutingplan', 'msp_findpath'],
+                         planner.searches()[:2])
+
+    def test_failed_assembly(self):
+        planner = RecordingPlanner()
+        planner.RETURN_VALUES = dict(RecordingPlanner.RETURN_VALUES,
+                                     msp_assemblegraphs=-1)
+        self.assertRaises(Exception, self.cost_matrix, planner)
+        self.assertNotIn('msp_twoq', planner.calls)
+        # The routing plan is released all the same
+        self.assertEqual('msp_clearroutingplan', planner.calls[-1])
+
+    def test_reject_graph_snapshots(self):
+        planner = RecordingPlanner()
+        with self.assertRaises(ValueError) as context:
+            planner.open_datasource('snapshot', 'graph.mmgs')
+        self.assertIn('PythonRoutePlanner', str(context.exception))
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,168 @@
+import unittest
+from ctypes import POINTER, c_longlong
+from pymmrouting.routeplanner import MultimodalRoutePlanner
+from pymmrouting.inferenceengine import RoutingPlanInferer
+from pymmrouting.routingresult import RoutingResult, RawPath, \
+    SegmentGeometryResolver
+from pymmrouting.orm_graphmodel import Mode, Session, MODES
+from pymmrouting.encoding import decode_polyline
+from pymmrouting.queryprofile import profile_queries, query_budget
+
+
+class RoutingResultTestCase(unittest.TestCase):
+
+    def setUp(self):
+        routing_options_file = \
+            "test/routing_options_driving_parking_and_go.json"
+        self.inferer = RoutingPlanInferer()
+        self.inferer.load_routing_options_from_file(routing_options_file)
+        self.plans = self.inferer.generate_routing_plan()
+        self.modes = {
+            str(m_name): m_id
+            for m_name, m_id in
+            Session.query(Mode.mode_name, Mode.mode_id)
+        }
+        for p in self.plans:
+            if p.mode_list == [self.modes["private_car"], self.modes["foot"]]:
+                self.plan = p
+        with MultimodalRoutePlanner() as planner:
+            self.result = planner.find_routing_result(self.plan)
+
+    def test_switch_points_are_resolved_once(self):
+        with profile_queries() as profile:
+            switch_points = self.result.switch_points
+        # One query for all the switch points of the route plus one query
+        # for each switch point poi
+        self.assertEqual(1, len(switch_points))
+        self.assertLessEqual(profile.count, 1 + len(switch_points))
+        with query_budget(0):
+            self.result.switch_points
+            self.result.switch_points
+
+    def test_to_dict_does_not_resolve_switch_points_repeatedly(self):
+        resolver = SegmentGeometryResolver()
+        resolver.add_result(self.result)
+        segment_geometries = resolver.resolve()
+        with profile_queries() as profile:
+            rd = self.result.to_dict(segment_geometries)
+        self.assertEqual(3, len(rd["geojson"]["features"]))
+        self.assertLessEqual(profile.count, 1 + len(rd["switch_points"]))
+        with query_budget(0):
+            self.result.to_dict(segment_geometries)
+
+    def test_to_dict_with_encoded_geometries(self):
+        resolver = SegmentGeometryResolver()
+        resolver.add_result(self.result)
+        segment_geometries = resolver.resolve()
+        rd = self.result.to_dict(segment_geometries)
+        encoded = self.result.to_dict(segment_geometries,
+                                      geometry_encoding='polyline')
+        for f, e in zip(rd["geojson"]["features"],
+                        encoded["geojson"]["features"]):
+            self.assertEqual(f["properties"], e["properties"])
+            if f["properties"]["type"] == "path":
+                self.assertEqual("EncodedPolyline", e["geometry"]["type"])
+                decoded = decode_polyline(e["geometry"]["polyline"])
+                self.assertEqual(len(f["geometry"]["coordinates"]),
+                                 len(decoded))
+            else:
+                self.assertEqual(f["geometry"], e["geometry"])
+        self.assertEqual(rd["switch_points"], encoded["switch_points"])
+
+    def test_to_dict_with_simplified_geometries(self):
+        resolver = SegmentGeometryResolver()
+        resolver.add_result(self.result)
+        segment_geometries = resolver.resolve()
+        rd = self.result.to_dict(segment_geometries)
+        simplified = self.result.to_dict(segment_geometries, zoom=10)
+        for f, s in zip(rd["geojson"]["features"],
+                        simplified["geojson"]["features"]):
+            if f["properties"]["type"] == "path":
+                full = f["geometry"]["coordinates"]
+                coordinates = s["geometry"]["coordinates"]
+                self.assertLessEqual(len(coordinates), len(full))
+                self.assertEqual(full[0], coordinates[0])
+                self.assertEqual(full[-1], coordinates[-1])
+
+    def test_changing_mode_paths_invalidates_switch_points(self):
+        self.assertEqual(1, len(self.result.switch_points))
+        self.result.mode_paths = self.result.mode_paths[:1]
+        with query_budget(0):
+            self.assertEqual([], self.result.switch_points)
+
+
+
+def raw_path(vertex_ids):
+    """ Build the RawPath of libmmspa4pg over a ctypes array """
+    vertices = (c_longlong * len(vertex_ids))(*vertex_ids)
+    path = RawPath(vertex_list=vertices if vertex_ids else
+                   POINTER(c_longlong)(), vertex_list_length=len(vertex_ids))
+    return path, vertices
+
+
+class RawPathTestCase(unittest.TestCase):
+
+    def test_no_vertex(self):
+        path, _ = raw_path([])
+        self.assertFalse(path.vertex_list)
+        self.assertEqual([], path.vertex_ids())
+
+    def test_one_vertex(self):
+        path, _ = raw_path([12618163561])
+        self.assertEqual([12618163561], path.vertex_ids())
+
+    def test_many_vertices(self):
+        vertex_ids = [12618163561 + i for i in range(1000)]
+        path, vertices = raw_path(vertex_ids)
+        copied = path.vertex_ids()
+        self.assertEqual(vertex_ids, copied)
+        # The vertex ids are copied out of the native buffer
+        vertices[0] = 0
+        self.assertEqual(12618163561, copied[0])
+
+
+class StubModePath(object):
+
+    def __init__(self, mode, mode_name):
+        self.mode = mode
+        self.properties = {'type': 'path', 'mode': mode_name}
+
+    def to_geojson(self, *args):
+        return {'type': 'LineString', 'coordinates': [[11.5, 48.1]] * 2}
+
+
+class SwitchPointCopyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        MODES.set({'private_car': 1, 'foot': 2, 'bus': 3, 'tram': 4,
+                   'underground': 5, 'suburban': 6,
+                   'public_transportation': 9})
+        self.result = RoutingResult()
+        self.result.mode_paths = [StubModePath(1, 'private_car'),
+                                  StubModePath(2, 'foot')]
+        # Resolved switch point, as kept by the switch_points property
+        self.result._switch_points = [{
+            'type': 'Feature',
+            'properties': {'type': 'switch_point',
+                           'switch_type': 'car_parking', 'title': 'P1'},
+            'geometry': {'type': 'Point', 'coordinates': [11.5, 48.1]}}]
+
+    def tearDown(self):
+        MODES.reset()
+
+    def test_to_dict_copies_the_switch_points(self):
+        rd = self.result.to_dict()
+        self.assertEqual(self.result.switch_points, rd["switch_points"])
+        rd["switch_points"][0]["properties"]["title"] = 'changed'
+        rd["geojson"]["features"][1]["geometry"]["coordinates"][0] = 0.0
+        self.assertEqual('P1', rd["geojson"]["features"][1]["properties"][
+            "title"])
+        again = self.result.to_dict()
+        self.assertEqual('P1', again["switch_points"][0]["properties"][
+            "title"])
+        self.assertEqual([11.5, 48.1], again["geojson"]["features"][1][
+            "geometry"]["coordinates"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,206 @@
+import unittest
+import json
+import os
+import threading
+import time
+from os import path
+try:
+    from pymmrouting.service import asyncio, RoutingService, HttpProtocol, \
+        route_request
+except ImportError:  # Python 2 without trollius
+    asyncio = None
+try:
+    from httplib import HTTPConnection
+except ImportError:  # Python 3
+    from http.client import HTTPConnection
+from pymmrouting import parallel
+from pymmrouting.inferenceengine import RoutingPlanInferer
+from pymmrouting.orm_graphmodel import MODES, INV_MODES
+from pymmrouting.routingresult import PUBLIC_TRANSIT_MODES
+
+
+def echo_handler(options, geometry_options):
+    if options.get('exit'):
+        # Worker dying as on a crash of libmmspa4pg
+        os._exit(1)
+    time.sleep(options.get('sleep', 0))
+    return json.dumps({'routes': [], 'options': options,
+                       'geometry_options': geometry_options})
+
+
+class DummyPlanner(object):
+
+    def __init__(self, datasource_type, datasource_url):
+        pass
+
+    def cleanup(self):
+        pass
+
+
+class SlowPlanner(DummyPlanner):
+
+    def __init__(self, datasource_type, datasource_url):
+        time.sleep(1.0)
+
+
+@unittest.skipIf(asyncio is None, "The service needs asyncio")
+class RoutingServiceTestCase(unittest.TestCase):
+
+    def start(self, **kwargs):
+        self.loop = asyncio.new_event_loop()
+        kwargs.setdefault('planner_class', DummyPlanner)
+        self.service = RoutingService(self.loop, processes=1,
+                                      handler=echo_handler, **kwargs)
+        self.server = self.loop.run_until_complete(self.loop.create_server(
+            lambda: HttpProtocol(self.service), '127.0.0.1', 0))
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.start()
+        while not self.service.is_ready:
+            time.sleep(0.01)
+
+    def tearDown(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.server.close()
+        self.service.close()
+        self.loop.close()
+
+    def request(self, method, path, body=None):
+        connection = HTTPConnection('127.0.0.1', self.port, timeout=10)
+        connection.request(method, path, body)
+        response = connection.getresponse()
+        result = response.status, json.loads(response.read().decode('utf-8'))
+        connection.close()
+        return result
+
+    def test_route(self):
+        self.start()
+        status, body = self.request('GET', '/ready')
+        self.assertEqual(200, status)
+        self.assertTrue(body['ready'])
+        status, body = self.request(
+            'POST', '/route?geometry_encoding=polyline&zoom=12',
+            json.dumps({'objective': 'fastest'}))
+        self.assertEqual(200, status)
+        self.assertEqual({'objective': 'fastest'}, body['options'])
+        self.assertEqual({'geometry_encoding': 'polyline', 'zoom': 12.0},
+                         body['geometry_options'])
+
+    def test_reject_bad_requests(self):
+        self.start()
+        self.assertEqual(404, self.request('GET', '/routes')[0])
+        self.assertEqual(405, self.request('GET', '/route')[0])
+        self.assertEqual(400, self.request('POST', '/route', '{')[0])
+        self.assertEqual(400, self.request('POST', '/route?color=red',
+                                           '{}')[0])
+
+    def test_reject_requests_beyond_max_pending(self):
+        self.start(max_pending=1)
+        statuses = []
+
+        def slow_request():
+            statuses.append(self.request('POST', '/route',
+                                         json.dumps({'sleep': 0.5}))[0])
+        slow = threading.Thread(target=slow_request)
+        slow.start()
+        while self.service.pending == 0:
+            time.sleep(0.01)
+        self.assertEqual(503, self.request('POST', '/route', '{}')[0])
+        slow.join()
+        self.assertEqual([200], statuses)
+        self.assertEqual(200, self.request('POST', '/route', '{}')[0])
+
+    def test_worker_dying(self):
+        self.start(planner_class=SlowPlanner)
+        status, body = self.request('POST', '/route',
+                                    json.dumps({'exit': True}))
+        self.assertEqual(500, status)
+        self.assertIn('died', body['error'])
+        self.assertEqual(0, self.service.pending)
+        # Not ready until the worker replacing the dead one is
+        self.assertEqual(503, self.request('GET', '/ready')[0])
+        while not self.service.is_ready:
+            time.sleep(0.01)
+        self.assertEqual(200, self.request('POST', '/route', '{}')[0])
+
+    def test_timeout(self):
+        self.start(timeout=0.1)
+        status, body = self.request('POST', '/route',
+                                    json.dumps({'sleep': 0.5}))
+        self.assertEqual(504, status)
+        self.assertIn('error', body)
+
+
+class BatchPlanner(object):
+
+    """ Worker planner answering with the plans it is given """
+
+    def batch_find_path(self, plans, geometry_options=None):
+        return {'routes': [{'summary': p.description,
+                            'source': p.source['properties']['id'],
+                            'target': p.target['properties']['id'],
+                            'modes': p.mode_list,
+                            'public_transit': sorted(p.public_transit_set)}
+                           for p in plans],
+                'geometry_options': geometry_options}
+
+
+def snap_locations(inferer, locations):
+    return [{'point_id': i + 1, 'geometry': {
+        'type': 'Point', 'coordinates': [l['lon'], l['lat']]}}
+        for i, l in enumerate(locations)]
+
+
+def find_candidate_vertices(inferer, raw_point_id):
+    # Every point has a foot vertex, the target a tram vertex too
+    candidates = {MODES['foot']: raw_point_id * 10 + MODES['foot']}
+    if raw_point_id == 2:
+        candidates[MODES['tram']] = raw_point_id * 10 + MODES['tram']
+    return candidates
+
+
+@unittest.skipIf(asyncio is None, "The service needs asyncio")
+class RouteRequestTestCase(unittest.TestCase):
+
+    """ route_request from the routing options to the JSON response, with
+    the database lookups of RoutingPlanInferer and the planner stubbed
+    """
+
+    def setUp(self):
+        MODES.set({'private_car': 1, 'foot': 2, 'bus': 3, 'tram': 4,
+                   'underground': 5, 'suburban': 6,
+                   'public_transportation': 9})
+        self.lookups = (RoutingPlanInferer.snap_locations,
+                        RoutingPlanInferer._find_candidate_vertices)
+        RoutingPlanInferer.snap_locations = snap_locations
+        RoutingPlanInferer._find_candidate_vertices = find_candidate_vertices
+        self.worker_planner = parallel._worker_planner
+        parallel._worker_planner = BatchPlanner()
+
+    def tearDown(self):
+        RoutingPlanInferer.snap_locations, \
+            RoutingPlanInferer._find_candidate_vertices = self.lookups
+        parallel._worker_planner = self.worker_planner
+        for mapping in [MODES, INV_MODES, PUBLIC_TRANSIT_MODES]:
+            mapping.reset()
+
+    def test_take_public_transit(self):
+        options_file = path.join(path.dirname(__file__),
+                                 'routing_options_take_public_transit.json')
+        with open(options_file) as f:
+            options = json.load(f)
+        response = json.loads(route_request(options, {'zoom': 12.0}))
+        self.assertEqual({'zoom': 12.0}, response['geometry_options'])
+        self.assertEqual([
+            {'summary': 'Walking', 'source': 12, 'target': 22,
+             'modes': [2], 'public_transit': []},
+            {'summary': 'Walking and taking public transit', 'source': 12,
+             'target': 24, 'modes': [9], 'public_transit': [4, 5, 6]},
+            {'summary': 'Walking and taking public transit', 'source': 12,
+             'target': 22, 'modes': [9], 'public_transit': [4, 5, 6]}],
+            response['routes'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import unittest
+import numpy as np
+from pymmrouting.simplify import simplify_line, tolerance_for_zoom, \
+    DOUGLAS_PEUCKER, VISVALINGAM
+
+
+class SimplifyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # A noisy line of about 2 km heading east in Munich, with a detour
+        # of about 200 m to the north in the middle
+        np.random.seed(3)
+        lons = np.linspace(11.50, 11.53, 301)
+        lats = 48.14 + np.random.randn(301) * 1.0e-6
+        lats[140:161] += 0.0018
+        self.line = np.column_stack([lons, lats]).tolist()
+
+    def test_keep_line_without_tolerance(self):
+        self.assertIs(self.line, simplify_line(self.line))
+        self.assertEqual(self.line[:2], simplify_line(self.line[:2], 10.0))
+
+    def test_keep_end_points_and_original_coordinates(self):
+        for method in (DOUGLAS_PEUCKER, VISVALINGAM):
+            simplified = simplify_line(self.line, 5.0, method=method)
+            self.assertLess(len(simplified), 20)
+            self.assertEqual(self.line[0], simplified[0])
+            self.assertEqual(self.line[-1], simplified[-1])
+            for p in simplified:
+                self.assertIn(p, self.line)
+
+    def test_keep_details_larger_than_tolerance(self):
+        for method in (DOUGLAS_PEUCKER, VISVALINGAM):
+            simplified = simplify_line(self.line, 5.0, method=method)
+            self.assertGreater(max(p[1] for p in simplified), 48.1415)
+            flat = simplify_line(self.line, 1000.0, method=method)
+            self.assertLess(len(flat), len(simplified))
+        self.assertEqual([self.line[0], self.line[-1]],
+                         simplify_line(self.line, 1000.0))
+
+    def test_tolerance_for_zoom(self):
+        self.assertAlmostEqual(156543.03, tolerance_for_zoom(0), 2)
+        self.assertAlmostEqual(tolerance_for_zoom(12) / 2,
+                               tolerance_for_zoom(13))
+        self.assertLess(tolerance_for_zoom(12, 48.14), tolerance_for_zoom(12))
+        self.assertLess(len(simplify_line(self.line, zoom=10)),
+                        len(simplify_line(self.line, zoom=18)))
+
+    def test_unknown_method(self):
+        self.assertRaises(ValueError, simplify_line, self.line, 5.0,
+                          method='radial')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import unittest
+import shutil
+import tempfile
+import numpy as np
+from os import path
+from pymmrouting.spatialindex import StreetJunctionIndex, \
+    _STREET_JUNCTION_INDEX
+from pymmrouting.inferenceengine import RoutingPlanInferer
+from pymmrouting import settings
+
+
+class StreetJunctionIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        rs = np.random.RandomState(42)
+        self.xs = 11.4 + rs.rand(2000) * 0.3
+        self.ys = 48.0 + rs.rand(2000) * 0.2
+        self.osm_ids = np.arange(2000) + 1000
+        self.index = StreetJunctionIndex(self.osm_ids, self.xs, self.ys)
+
+    def _brute_force(self, x, y):
+        return int(self.osm_ids[np.hypot(self.xs - x, self.ys - y).argmin()])
+
+    def test_nearest(self):
+        nearest = self.index.nearest(11.5682, 48.1500)
+        self.assertEqual(self._brute_force(11.5682, 48.1500),
+                         nearest['point_id'])
+        self.assertEqual('Point', nearest['geometry']['type'])
+        self.assertEqual(2, len(nearest['geometry']['coordinates']))
+
+    def test_nearest_out_of_extent(self):
+        nearest = self.index.nearest(12.0, 47.5)
+        self.assertEqual(self._brute_force(12.0, 47.5), nearest['point_id'])
+
+    def test_nearest_many(self):
+        lons = [11.45, 11.5038, 11.6, 11.69]
+        lats = [48.01, 48.1583, 48.1, 48.19]
+        snapped = self.index.nearest_many(lons, lats)
+        self.assertListEqual([self._brute_force(x, y)
+                              for x, y in zip(lons, lats)],
+                             [p['point_id'] for p in snapped])
+
+    def test_snapshot(self):
+        snapshot_dir = tempfile.mkdtemp()
+        try:
+            snapshot_file = path.join(snapshot_dir, 'junctions.npz')
+            self.index.save(snapshot_file)
+            loaded = StreetJunctionIndex.load(snapshot_file)
+        finally:
+            shutil.rmtree(snapshot_dir)
+        self.assertEqual(len(self.index), len(loaded))
+        self.assertEqual(self.index.nearest(11.5, 48.1),
+                         loaded.nearest(11.5, 48.1))
+
+
+class ConfiguredIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.index_dir = tempfile.mkdtemp()
+        self.index_file = path.join(self.index_dir, 'junctions.npz')
+        StreetJunctionIndex([1, 2], [11.5, 11.6], [48.1, 48.2]).save(
+            self.index_file)
+
+    def tearDown(self):
+        settings._CONFIG.reset()
+        _STREET_JUNCTION_INDEX.reset()
+        shutil.rmtree(self.index_dir)
+
+    def test_inferer_loads_the_index_of_the_config(self):
+        settings._CONFIG.set({'street_junction_index': self.index_file})
+        inferer = RoutingPlanInferer()
+        self.assertEqual(2, len(inferer.junction_index))
+        self.assertIs(inferer.junction_index,
+                      RoutingPlanInferer().junction_index)
+        snapped = inferer.snap_locations([{'lon': 11.61, 'lat': 48.19},
+                                          {'lon': 11.4, 'lat': 48.0}])
+        self.assertEqual([2, 1], [p['point_id'] for p in snapped])
+
+    def test_given_index_over_the_config(self):
+        settings._CONFIG.set({'street_junction_index': self.index_file})
+        index = StreetJunctionIndex([3], [11.5], [48.1])
+        self.assertIs(index, RoutingPlanInferer(index).junction_index)
+
+    def test_no_index_without_config_key(self):
+        settings._CONFIG.set({})
+        self.assertIsNone(RoutingPlanInferer().junction_index)
+
+
+if __name__ == "__main__":
+    unittest.main()